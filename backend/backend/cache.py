@@ -1,6 +1,14 @@
+import atexit
+from abc import ABC, abstractmethod
 import json
 import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
 import time
+import zlib
+from collections import OrderedDict
 from pathlib import Path
 from typing import Optional, Dict, Any
 from dataclasses import dataclass
@@ -14,11 +22,12 @@ class CacheEntry:
     timestamp: float
     ttl: int  # Time to live in seconds
 
-class FileBasedCache:
-    def __init__(self, cache_dir: str = "cache"):
-        self.cache_dir = Path(cache_dir)
-        self.cache_dir.mkdir(exist_ok=True)
-        logger.info(f"Cache initialized at {self.cache_dir}")
+class BaseCache(ABC):
+    """Cache interface shared by the storage backends.
+
+    Backends implement get_by_key, set_by_key, clear_expired and get_stats, the
+    keys for route matrices and their elements are derived here.
+    """
 
     def _get_cache_key(self, origins, destinations, travel_mode):
         """Create deterministic hash from request parameters"""
@@ -29,36 +38,329 @@ class FileBasedCache:
         }
         return hashlib.md5(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
 
+    def _get_element_cache_key(self, origin, destination, travel_mode, precision):
+        """Create a key for a single route matrix element.
+
+        Coordinates are rounded to `precision` decimal places, so that elements
+        whose endpoints are close enough share a cache entry.
+        """
+        key_data = (
+            f"element:{travel_mode}:"
+            f"{origin.lat:.{precision}f},{origin.lng:.{precision}f}:"
+            f"{destination.lat:.{precision}f},{destination.lng:.{precision}f}"
+        )
+        return hashlib.md5(key_data.encode()).hexdigest()
+
     def get(self, origins, destinations, travel_mode) -> Optional[Dict]:
         """Retrieve cached result if valid"""
+        return self.get_by_key(self._get_cache_key(origins, destinations, travel_mode))
+
+    def set(self, origins, destinations, travel_mode, data, ttl=3600):
+        """Store result in cache"""
         cache_key = self._get_cache_key(origins, destinations, travel_mode)
-        cache_file = self.cache_dir / f"{cache_key}.json"
+        self.set_by_key(cache_key, data, ttl=ttl)
 
-        if not cache_file.exists():
-            logger.debug(f"Cache miss for key {cache_key[:8]}...")
-            return None
+    def get_element(
+        self, origin, destination, travel_mode, precision=4
+    ) -> Optional[Dict]:
+        """Retrieve a cached route matrix element if valid"""
+        return self.get_by_key(
+            self._get_element_cache_key(origin, destination, travel_mode, precision)
+        )
+
+    def set_element(
+        self, origin, destination, travel_mode, data, precision=4, ttl=3600
+    ):
+        """Store a single route matrix element in cache"""
+        cache_key = self._get_element_cache_key(
+            origin, destination, travel_mode, precision
+        )
+        self.set_by_key(cache_key, data, ttl=ttl)
+
+    @abstractmethod
+    def get_by_key(self, cache_key: str) -> Optional[Dict]:
+        pass
+
+    @abstractmethod
+    def set_by_key(self, cache_key: str, data, ttl=3600):
+        pass
+
+    @abstractmethod
+    def clear_expired(self) -> int:
+        pass
+
+    @abstractmethod
+    def get_stats(self) -> Dict[str, Any]:
+        pass
+
+@dataclass
+class ManifestEntry:
+    size: int
+    expires_at: float
+    last_access: float
+    hits: int = 0
+
+class FileBasedCache(BaseCache):
+    MANIFEST_NAME = "MANIFEST"
+
+    def __init__(
+        self,
+        cache_dir: str = "cache",
+        max_size_bytes: Optional[int] = None,
+        eviction_policy: str = "lru",
+        manifest_flush_interval: int = 100,
+    ):
+        """A cache with one JSON file per entry.
+
+        A manifest with the size, expiry and usage of every entry is kept in
+        memory and flushed to disk every `manifest_flush_interval` writes and at
+        exit, so stats and expiry don't have to read the cache directory. Reads
+        only update the usage in memory. Flushing merges in the manifest on disk,
+        so other caches on the same directory don't lose each other's entries.
+        The directory is created on the first write.
+
+        Processes sharing the directory, like several server workers, only see
+        each other's entries as of their last manifest flush: stats differ
+        between them, and the budget is enforced on what each of them knows of.
+        Use SQLiteCache when the cache has to be exact across processes.
 
+        Args:
+            cache_dir: The directory to store the entries in.
+            max_size_bytes: The disk budget. When it's exceeded, the manifest on
+                disk is merged in, then expired entries are removed, then
+                entries according to `eviction_policy`. None means unlimited.
+            eviction_policy: "lru" evicts the least recently used entries, "lfu"
+                the least frequently used ones.
+            manifest_flush_interval: How many writes and removals to batch
+                between manifest writes.
+        """
+        if eviction_policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown eviction policy: {eviction_policy}")
+
+        self.cache_dir = Path(cache_dir)
+        self.max_size_bytes = max_size_bytes
+        self.eviction_policy = eviction_policy
+        self.manifest_flush_interval = manifest_flush_interval
+
+        self._lock = threading.RLock()
+        self._manifest: Dict[str, ManifestEntry] = {}
+        self._total_size = 0
+        self._n_unflushed = 0
+        # Whether hits changed the usage of entries since the last flush
+        self._has_unflushed_reads = False
+        # Keys written and removed since the last flush, to merge with the
+        # manifest on disk
+        self._written: set[str] = set()
+        self._removed: set[str] = set()
+        self._load_manifest()
+        atexit.register(self.flush)
+
+        logger.info(f"Cache initialized at {self.cache_dir}")
+
+    def _get_cache_file(self, cache_key: str) -> Path:
+        return self.cache_dir / f"{cache_key}.json"
+
+    def _load_manifest(self):
+        manifest_file = self.cache_dir / self.MANIFEST_NAME
         try:
-            with open(cache_file, 'r') as f:
-                entry_data = json.load(f)
-                entry = CacheEntry(**entry_data)
+            with open(manifest_file, 'r') as f:
+                manifest_data = json.load(f)
+            self._manifest = {
+                k: ManifestEntry(**v) for k, v in manifest_data["entries"].items()
+            }
+        except FileNotFoundError:
+            self.rebuild_manifest()
+            return
+        except Exception as e:
+            logger.warning(f"Cache manifest is corrupted, rebuilding: {e}")
+            self.rebuild_manifest()
+            return
+
+        self._total_size = sum(entry.size for entry in self._manifest.values())
+
+    def rebuild_manifest(self):
+        """Rebuild the manifest by reading every entry in the cache directory.
+
+        It's written with the next flush, not right away, so that opening a
+        cache doesn't write to the disk.
+        """
+        with self._lock:
+            self._manifest = {}
+            self._total_size = 0
+            for cache_file in self.cache_dir.glob("*.json"):
+                try:
+                    entry, size = self._read_entry(cache_file.stem)
+                except FileNotFoundError:
+                    continue
+                except Exception:
+                    # Remove corrupted cache files
+                    cache_file.unlink(missing_ok=True)
+                    continue
+                self._adopt(cache_file.stem, entry, size)
+            self._n_unflushed = len(self._manifest)
+
+    def _read_entry(self, cache_key: str) -> tuple[CacheEntry, int]:
+        """Read an entry file and its size. Doesn't need the lock."""
+        with open(self._get_cache_file(cache_key), 'r') as f:
+            size = os.fstat(f.fileno()).st_size
+            return CacheEntry(**json.load(f)), size
+
+    def _adopt(self, cache_key: str, entry: CacheEntry, size: int) -> ManifestEntry:
+        """Add an entry written without the manifest, e.g. by another process"""
+        manifest_entry = ManifestEntry(
+            size=size,
+            expires_at=entry.timestamp + entry.ttl,
+            last_access=entry.timestamp,
+        )
+        self._manifest[cache_key] = manifest_entry
+        self._total_size += size
+        return manifest_entry
 
+    def _remove(self, cache_key: str, flush: bool = True):
+        manifest_entry = self._manifest.pop(cache_key, None)
+        if manifest_entry is not None:
+            self._total_size -= manifest_entry.size
+        self._get_cache_file(cache_key).unlink(missing_ok=True)
+        self._written.discard(cache_key)
+        self._removed.add(cache_key)
+        self._mark_changed(flush)
+
+    def _mark_changed(self, flush: bool = True):
+        """Count a change of the manifest, flushing it if it's due.
+
+        Args:
+            flush: False when removing many entries at once, to flush once after
+                them with _flush_if_due() instead of every N of them.
+        """
+        self._n_unflushed += 1
+        if flush:
+            self._flush_if_due()
+
+    def _flush_if_due(self):
+        if self._n_unflushed >= self.manifest_flush_interval:
+            self.flush()
+
+    def flush(self, force: bool = False):
+        """Write the manifest to disk atomically"""
+        with self._lock:
+            if self._n_unflushed == 0 and not self._has_unflushed_reads and not force:
+                return
+            if not self.cache_dir.exists():
+                # The cache directory was deleted, nothing to keep track of
+                return
+
+            self._merge_disk_manifest()
+            manifest_data = {
+                "entries": {k: v.__dict__ for k, v in self._manifest.items()}
+            }
+            try:
+                with tempfile.NamedTemporaryFile(
+                    'w',
+                    dir=self.cache_dir,
+                    prefix=f".{self.MANIFEST_NAME}.",
+                    suffix=".tmp",
+                    delete=False,
+                ) as f:
+                    json.dump(manifest_data, f)
+                os.replace(f.name, self.cache_dir / self.MANIFEST_NAME)
+                self._n_unflushed = 0
+                self._has_unflushed_reads = False
+                self._written.clear()
+                self._removed.clear()
+            except Exception as e:
+                logger.warning(f"Cache manifest write error: {e}")
+
+    def _merge_disk_manifest(self):
+        """Merge in the manifest written by other caches on the same directory.
+
+        Entries only on disk are added, unless they were removed here since the
+        last flush. Entries missing from it that weren't written here since the
+        last flush were possibly removed elsewhere, so they're kept only if their
+        file still exists. Of entries in both, the later write and the most
+        usage win.
+        """
+        try:
+            with open(self.cache_dir / self.MANIFEST_NAME, 'r') as f:
+                disk_manifest = {
+                    k: ManifestEntry(**v) for k, v in json.load(f)["entries"].items()
+                }
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Cache manifest is corrupted, replacing it: {e}")
+            return
+
+        for cache_key, theirs in disk_manifest.items():
+            if cache_key in self._removed:
+                continue
+            ours = self._manifest.get(cache_key)
+            if ours is None:
+                self._manifest[cache_key] = theirs
+                self._total_size += theirs.size
+                continue
+            if theirs.expires_at > ours.expires_at:
+                self._total_size += theirs.size - ours.size
+                ours.size = theirs.size
+                ours.expires_at = theirs.expires_at
+            ours.last_access = max(ours.last_access, theirs.last_access)
+            ours.hits = max(ours.hits, theirs.hits)
+
+        for cache_key in [
+            k
+            for k in self._manifest
+            if k not in disk_manifest and k not in self._written
+        ]:
+            if not self._get_cache_file(cache_key).exists():
+                self._total_size -= self._manifest.pop(cache_key).size
+
+    def get_by_key(self, cache_key: str) -> Optional[Dict]:
+        """Retrieve cached result for an arbitrary key if valid"""
+        with self._lock:
+            manifest_entry = self._manifest.get(cache_key)
             # Check if cache entry is still valid
-            if time.time() - entry.timestamp > entry.ttl:
-                cache_file.unlink()  # Remove expired cache
+            if manifest_entry is not None and time.time() > manifest_entry.expires_at:
+                self._remove(cache_key)  # Remove expired cache
                 logger.debug(f"Cache expired for key {cache_key[:8]}...")
                 return None
 
-            logger.info(f"Cache hit for key {cache_key[:8]}...")
-            return entry.data
+        # Read outside the lock, so that concurrent readers don't wait for each other
+        try:
+            entry, size = self._read_entry(cache_key)
+        except FileNotFoundError:
+            if manifest_entry is not None:
+                # Removed by another process
+                with self._lock:
+                    if self._manifest.get(cache_key) is manifest_entry:
+                        self._remove(cache_key)
+            logger.debug(f"Cache miss for key {cache_key[:8]}...")
+            return None
         except Exception as e:
             logger.warning(f"Cache read error for key {cache_key[:8]}...: {e}")
+            with self._lock:
+                self._remove(cache_key)
             return None
 
-    def set(self, origins, destinations, travel_mode, data, ttl=3600):
-        """Store result in cache"""
-        cache_key = self._get_cache_key(origins, destinations, travel_mode)
-        cache_file = self.cache_dir / f"{cache_key}.json"
+        with self._lock:
+            manifest_entry = self._manifest.get(cache_key)
+            if manifest_entry is None:
+                manifest_entry = self._adopt(cache_key, entry, size)
+            if time.time() > manifest_entry.expires_at:
+                self._remove(cache_key)
+                logger.debug(f"Cache expired for key {cache_key[:8]}...")
+                return None
+
+            # Flushed with the next write or at exit, rewriting the manifest
+            # on reads would make every hit O(entries).
+            manifest_entry.last_access = time.time()
+            manifest_entry.hits += 1
+            self._has_unflushed_reads = True
+
+        logger.debug(f"Cache hit for key {cache_key[:8]}...")
+        return entry.data
+
+    def set_by_key(self, cache_key: str, data, ttl=3600):
+        """Store result in cache under an arbitrary key"""
+        cache_file = self._get_cache_file(cache_key)
 
         entry = CacheEntry(
             data=data,
@@ -67,42 +369,435 @@ class FileBasedCache:
         )
 
         try:
-            with open(cache_file, 'w') as f:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first so that readers never see a
+            # partially written entry. Its name is unique across processes.
+            with tempfile.NamedTemporaryFile(
+                'w',
+                dir=self.cache_dir,
+                prefix=f".{cache_key}.",
+                suffix=".tmp",
+                delete=False,
+            ) as f:
                 json.dump(entry.__dict__, f)
-            logger.info(f"Cached result for key {cache_key[:8]}...")
+            size = os.stat(f.name).st_size
+            os.replace(f.name, cache_file)
+            logger.debug(f"Cached result for key {cache_key[:8]}...")
         except Exception as e:
             logger.warning(f"Cache write error for key {cache_key[:8]}...: {e}")
+            return
+
+        with self._lock:
+            previous = self._manifest.get(cache_key)
+            if previous is not None:
+                self._total_size -= previous.size
+            self._manifest[cache_key] = ManifestEntry(
+                size=size,
+                expires_at=entry.timestamp + ttl,
+                last_access=entry.timestamp,
+                hits=previous.hits if previous is not None else 0,
+            )
+            self._total_size += size
+            self._written.add(cache_key)
+            self._removed.discard(cache_key)
+            self._mark_changed()
+
+            max_size_bytes = self.max_size_bytes
+            if max_size_bytes is not None and self._total_size > max_size_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Evict entries until the cache is comfortably below its budget"""
+        # Evict a bit more than necessary so that we don't evict on every write
+        target_size = 0.9 * self.max_size_bytes
+        # Count the entries other processes flushed since our last flush
+        self._merge_disk_manifest()
+        expired_count = self._clear_expired()
+
+        if self.eviction_policy == "lru":
+            order = sorted(self._manifest, key=lambda k: self._manifest[k].last_access)
+        else:
+            order = sorted(
+                self._manifest,
+                key=lambda k: (self._manifest[k].hits, self._manifest[k].last_access),
+            )
+
+        removed_count = 0
+        for cache_key in order:
+            if self._total_size <= target_size:
+                break
+            self._remove(cache_key, flush=False)
+            removed_count += 1
+        self._flush_if_due()
+
+        logger.info(
+            f"Evicted {expired_count} expired and {removed_count} other cache "
+            "entries to fit the size budget"
+        )
 
     def clear_expired(self):
         """Remove all expired cache entries"""
+        with self._lock:
+            removed_count = self._clear_expired()
+            self._flush_if_due()
+
+        logger.info(f"Removed {removed_count} expired cache entries")
+        return removed_count
+
+    def _clear_expired(self) -> int:
+        """Remove all expired cache entries without flushing the manifest"""
         current_time = time.time()
-        removed_count = 0
-        
-        for cache_file in self.cache_dir.glob("*.json"):
-            try:
-                with open(cache_file, 'r') as f:
-                    entry_data = json.load(f)
-                    entry = CacheEntry(**entry_data)
-                
-                if current_time - entry.timestamp > entry.ttl:
-                    cache_file.unlink()
-                    removed_count += 1
-            except Exception:
-                # Remove corrupted cache files
-                cache_file.unlink()
-                removed_count += 1
-        
+        expired = [k for k, v in self._manifest.items() if current_time > v.expires_at]
+        for cache_key in expired:
+            self._remove(cache_key, flush=False)
+        return len(expired)
+
+    def get_stats(self):
+        """Get cache statistics"""
+        with self._lock:
+            total_entries = len(self._manifest)
+            total_size = self._total_size
+
+        return {
+            "total_entries": total_entries,
+            "total_size_bytes": total_size,
+            "total_size_mb": total_size / (1024 * 1024),
+            "max_size_bytes": self.max_size_bytes,
+            "eviction_policy": self.eviction_policy,
+            "cache_dir": str(self.cache_dir),
+            "backend": "file",
+        }
+
+class SQLiteCache(BaseCache):
+    def __init__(self, db_path: str = "cache/cache.sqlite3"):
+        """A cache in a single SQLite database, safe to share between processes.
+
+        The database runs in WAL mode, so readers don't block the writer, and every
+        write is atomic. Payloads are stored zlib-compressed, expiry is indexed and
+        the entry count and size are kept up to date by triggers, so clear_expired
+        and get_stats don't scan the entries.
+        """
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # sqlite3 connections can't be shared between threads
+        self._local = threading.local()
+
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    expires_at REAL NOT NULL,
+                    size INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at);
+
+                CREATE TABLE IF NOT EXISTS stats (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    total_entries INTEGER NOT NULL,
+                    total_size INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO stats VALUES (0, 0, 0);
+
+                CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries
+                BEGIN
+                    UPDATE stats SET total_entries = total_entries + 1,
+                        total_size = total_size + new.size;
+                END;
+                CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries
+                BEGIN
+                    UPDATE stats SET total_entries = total_entries - 1,
+                        total_size = total_size - old.size;
+                END;
+                CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE ON entries
+                BEGIN
+                    UPDATE stats SET total_size = total_size - old.size + new.size;
+                END;
+                """
+            )
+        logger.info(f"SQLite cache initialized at {self.db_path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_by_key(self, cache_key: str) -> Optional[Dict]:
+        """Retrieve cached result for an arbitrary key if valid"""
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT data, expires_at FROM entries WHERE key = ?", (cache_key,)
+            ).fetchone()
+
+            if row is None:
+                logger.debug(f"Cache miss for key {cache_key[:8]}...")
+                return None
+
+            data, expires_at = row
+            if time.time() > expires_at:
+                with conn:
+                    conn.execute("DELETE FROM entries WHERE key = ?", (cache_key,))
+                logger.debug(f"Cache expired for key {cache_key[:8]}...")
+                return None
+
+            logger.debug(f"Cache hit for key {cache_key[:8]}...")
+            return json.loads(zlib.decompress(data))
+        except Exception as e:
+            logger.warning(f"Cache read error for key {cache_key[:8]}...: {e}")
+            return None
+
+    def set_by_key(self, cache_key: str, data, ttl=3600):
+        """Store result in cache under an arbitrary key"""
+        try:
+            payload = zlib.compress(json.dumps(data).encode())
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    """
+                    INSERT INTO entries (key, data, expires_at, size)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET data = excluded.data,
+                        expires_at = excluded.expires_at, size = excluded.size
+                    """,
+                    (cache_key, payload, time.time() + ttl, len(payload)),
+                )
+            logger.debug(f"Cached result for key {cache_key[:8]}...")
+        except Exception as e:
+            logger.warning(f"Cache write error for key {cache_key[:8]}...: {e}")
+
+    def clear_expired(self):
+        """Remove all expired cache entries"""
+        conn = self._connect()
+        with conn:
+            removed_count = conn.execute(
+                "DELETE FROM entries WHERE expires_at < ?", (time.time(),)
+            ).rowcount
+
         logger.info(f"Removed {removed_count} expired cache entries")
         return removed_count
 
     def get_stats(self):
         """Get cache statistics"""
-        cache_files = list(self.cache_dir.glob("*.json"))
-        total_size = sum(f.stat().st_size for f in cache_files)
-        
+        total_entries, total_size = (
+            self._connect()
+            .execute("SELECT total_entries, total_size FROM stats")
+            .fetchone()
+        )
+
         return {
-            "total_entries": len(cache_files),
+            "total_entries": total_entries,
             "total_size_bytes": total_size,
             "total_size_mb": total_size / (1024 * 1024),
-            "cache_dir": str(self.cache_dir)
-        } 
\ No newline at end of file
+            "cache_dir": str(self.db_path.parent),
+            "backend": "sqlite",
+        }
+
+
+class MemoryCache(BaseCache):
+    def __init__(
+        self,
+        backend: BaseCache,
+        max_entries: int = 100_000,
+        max_bytes: int = 64 * 1024 * 1024,
+        read_through_ttl: int = 300,
+    ):
+        """A size-bounded in-process LRU cache in front of a persistent backend.
+
+        Reads go to memory first and fall back to the backend, writes go to both.
+        Cached objects are shared between callers, so they must not be mutated.
+
+        Args:
+            backend: The persistent cache.
+            max_entries: The maximum number of entries kept in memory.
+            max_bytes: The maximum total size of the entries kept in memory,
+                measured as the length of their JSON serialization.
+            read_through_ttl: How long to keep entries read from the backend, since
+                the backend doesn't report when they expire.
+        """
+        self.backend = backend
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.read_through_ttl = read_through_ttl
+
+        # key -> (data, expires_at, size)
+        self._entries: OrderedDict[str, tuple[Any, float, int]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _put(self, cache_key: str, data, ttl: float):
+        size = len(json.dumps(data))
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            self._pop(cache_key)
+            self._entries[cache_key] = (data, time.time() + ttl, size)
+            self._size += size
+
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+    def _pop(self, cache_key: str):
+        entry = self._entries.pop(cache_key, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+    def get_by_key(self, cache_key: str) -> Optional[Dict]:
+        """Retrieve cached result from memory, or from the backend on a miss"""
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and time.time() <= entry[1]:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[0]
+            self._pop(cache_key)
+            self.misses += 1
+
+        data = self.backend.get_by_key(cache_key)
+        if data is not None:
+            self._put(cache_key, data, self.read_through_ttl)
+        return data
+
+    def set_by_key(self, cache_key: str, data, ttl=3600):
+        """Store result in memory and in the backend"""
+        self.backend.set_by_key(cache_key, data, ttl=ttl)
+        self._put(cache_key, data, min(ttl, self.read_through_ttl))
+
+    def clear_expired(self):
+        """Remove all expired cache entries, in memory and in the backend"""
+        now = time.time()
+        with self._lock:
+            for cache_key in [k for k, v in self._entries.items() if now > v[1]]:
+                self._pop(cache_key)
+        return self.backend.clear_expired()
+
+    def get_stats(self):
+        """Get cache statistics, including the memory tier's hit rate"""
+        with self._lock:
+            n_lookups = self.hits + self.misses
+            memory_stats = {
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / n_lookups if n_lookups else 0.0,
+            }
+        return {**self.backend.get_stats(), "memory": memory_stats}
+
+
+class BlobStore:
+    def __init__(self, root_dir: str, suffix: str = ""):
+        """A content-addressed store for binary blobs, such as map images.
+
+        Each blob is stored once, in a file named by the SHA-256 of its content,
+        so identical content requested under different keys shares the file and
+        the digest can double as an HTTP ETag. Map request keys to digests with a
+        regular cache. The directory is created when the first blob is stored.
+
+        Args:
+            root_dir: The directory of the blobs.
+            suffix: The file extension of the blobs, e.g. ".png".
+        """
+        self.root_dir = Path(root_dir)
+        self.suffix = suffix
+
+    def _get_path(self, digest: str) -> Path:
+        # Shard by the first two characters to keep directories small
+        return self.root_dir / digest[:2] / f"{digest}{self.suffix}"
+
+    def put(self, data: bytes) -> str:
+        """Store the data if it's not there yet, and return its digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._get_path(digest)
+        if path.exists():
+            return digest
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # A unique name, so that concurrent writers, even in other processes,
+        # don't write into the same temporary file
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, prefix=f".{digest}.", suffix=".tmp", delete=False
+        ) as f:
+            f.write(data)
+        os.replace(f.name, path)
+        return digest
+
+    def get(self, digest: str) -> Optional[bytes]:
+        path = self._get_path(digest)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        # Remember the last use, for clear_unused()
+        os.utime(path)
+        return data
+
+    def contains(self, digest: str) -> bool:
+        return self._get_path(digest).exists()
+
+    def clear_unused(self, max_age: float) -> int:
+        """Remove blobs that weren't stored or read in the last `max_age` seconds."""
+        cutoff = time.time() - max_age
+        removed = 0
+        for path in self.root_dir.glob(f"*/*{self.suffix}"):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def get_stats(self) -> Dict[str, Any]:
+        sizes = [x.stat().st_size for x in self.root_dir.glob(f"*/*{self.suffix}")]
+        return {
+            "blob_dir": str(self.root_dir),
+            "blobs": len(sizes),
+            "total_size_mb": sum(sizes) / (1024 * 1024),
+        }
+
+
+def create_cache(backend: Optional[str] = None) -> BaseCache:
+    """Create the cache selected by `backend` or the CACHE_BACKEND env variable.
+
+    The backend is either "file" (the default) or "sqlite". CACHE_DIR sets the
+    directory the cache lives in, and CACHE_MAX_MB the disk budget of the file
+    cache (unlimited by default). The SQLite cache has no budget and ignores
+    CACHE_MAX_MB, but is the one to use when several workers share the cache: the
+    file cache's stats and budget only account for what each worker has seen of
+    the others (see FileBasedCache). Unless CACHE_MEMORY_MAX_MB is 0, the backend
+    is fronted by an in-memory LRU cache of that size (64 MB by default).
+    """
+    if backend is None:
+        backend = os.getenv("CACHE_BACKEND", "file")
+    cache_dir = os.getenv("CACHE_DIR", "cache")
+    memory_max_mb = float(os.getenv("CACHE_MEMORY_MAX_MB", "64"))
+
+    persistent_cache: BaseCache
+    if backend == "file":
+        max_mb = os.getenv("CACHE_MAX_MB")
+        persistent_cache = FileBasedCache(
+            cache_dir,
+            max_size_bytes=int(float(max_mb) * 1024 * 1024) if max_mb else None,
+        )
+    elif backend == "sqlite":
+        if os.getenv("CACHE_MAX_MB"):
+            logger.warning("CACHE_MAX_MB is ignored by the SQLite cache")
+        persistent_cache = SQLiteCache(str(Path(cache_dir) / "cache.sqlite3"))
+    else:
+        raise ValueError(f"Unknown cache backend: {backend}")
+
+    if memory_max_mb <= 0:
+        return persistent_cache
+    return MemoryCache(persistent_cache, max_bytes=int(memory_max_mb * 1024 * 1024))
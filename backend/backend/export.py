@@ -5,9 +5,13 @@ import shutil
 import subprocess
 import tempfile
 import argparse
+from typing import Union
 
-from backend import gmaps
-from backend.grid import Grid
+from backend import gmaps, mosaic
+from backend.grid import DEFAULT_TARGET_ERROR, Grid
+from backend.grid_format import save_grid_data
+from backend.local_routing import LocalRouter
+from backend.quadtree import make_quadtree_grid
 from backend.location import Location
 
 ASSETS_DIR = Path(__file__).parents[2] / "frontend" / "src" / "assets"
@@ -52,6 +56,12 @@ def main(
     max_normalized_distance: float,
     preview: bool,
     travel_mode: gmaps.TravelMode,
+    binary: bool = False,
+    size_pixels: int = 640,
+    target_error: Union[float, None] = None,
+    max_elements: Union[int, None] = None,
+    n_landmarks: Union[int, None] = None,
+    quadtree_points: Union[int, None] = None,
 ):
     output_dir = ASSETS_DIR / output_name
 
@@ -61,9 +71,8 @@ def main(
             print("Aborting.")
             exit(1)
 
-    size_pixels = 640
-
-    unmarked_image = gmaps.get_static_map(
+    # Above 640 pixels, the map is stitched from several static maps
+    unmarked_image = mosaic.get_mosaic(
         center, zoom, markers=[], size_pixels=size_pixels
     )
     unmarked_image_path = save_image_bytes(unmarked_image)
@@ -76,17 +85,27 @@ def main(
             )
             input()
 
-    grid = Grid(
-        center,
-        zoom=zoom,
-        size=grid_size,
-        snap_to_roads=True,
-        size_pixels=size_pixels,
-        travel_mode=travel_mode,
-    )
+    if quadtree_points is None:
+        grid = Grid(
+            center,
+            zoom=zoom,
+            size=grid_size,
+            snap_to_roads=True,
+            size_pixels=size_pixels,
+            travel_mode=travel_mode,
+        )
+    else:
+        grid = make_quadtree_grid(
+            center,
+            zoom,
+            max_points=quadtree_points,
+            snap_to_roads=True,
+            size_pixels=size_pixels,
+            travel_mode=travel_mode,
+        )
 
     if preview:
-        marked_image = gmaps.get_static_map(
+        marked_image = mosaic.get_mosaic(
             center,
             zoom,
             markers=grid.get_snapped_locations(),
@@ -101,14 +120,27 @@ def main(
             )
             input()
 
-    grid.compute_sparsified_distance_matrix(
-        max_normalized_distance=max_normalized_distance
-    )
+    if n_landmarks is not None:
+        grid.compute_landmark_distance_matrix(n_landmarks)
+    elif target_error is None:
+        grid.compute_sparsified_distance_matrix(
+            max_normalized_distance=max_normalized_distance
+        )
+    else:
+        grid.compute_adaptive_distance_matrix(
+            max_normalized_distance=max_normalized_distance,
+            target_error=target_error,
+            max_elements=max_elements,
+        )
 
     output_dir.mkdir(exist_ok=True)
 
+    grid_data = grid.to_json()
     with open(output_dir / "grid_data.json", "w") as f:
-        json.dump(grid.to_json(), f)
+        json.dump(grid_data, f)
+
+    if binary:
+        save_grid_data(grid_data, output_dir / "grid_data.bin")
 
     shutil.copy(unmarked_image_path, output_dir / "map.png")
 
@@ -147,19 +179,78 @@ if __name__ == "__main__":
         "The other travel times are approximated from the sparse ones "
         "using a all-pairs shortest path algorithm.",
     )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Query the travel times between neighbors first and only query the "
+        "other nearby pairs where filling them in is estimated to be inaccurate. "
+        "Uses far fewer Routes API elements.",
+    )
+    parser.add_argument(
+        "--target-error",
+        type=float,
+        default=DEFAULT_TARGET_ERROR,
+        help="With --adaptive, the acceptable relative error of a filled-in "
+        "travel time.",
+    )
+    parser.add_argument(
+        "--max-elements",
+        type=int,
+        default=None,
+        help="With --adaptive, the maximum number of Routes API elements to use.",
+    )
+    parser.add_argument(
+        "--landmarks",
+        type=int,
+        default=None,
+        help="Instead of querying nearby pairs, query the travel times from this "
+        "many landmarks to all locations and between neighbors, and approximate "
+        "the rest. Scales to large grids.",
+    )
+    parser.add_argument(
+        "--quadtree-points",
+        type=int,
+        default=None,
+        help="Instead of a uniform grid of --grid-size rows, place at most this many "
+        "locations, more of them where travel times are irregular. Can be combined "
+        "with the other options, which then start from the mesh of the grid.",
+    )
     parser.add_argument(
         "--no-preview",
         action="store_true",
         help="Do not show map preview before generating",
     )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="Also write the grid data in the compact binary format (grid_data.bin)",
+    )
+    parser.add_argument(
+        "--size-pixels",
+        type=int,
+        default=640,
+        help="The size of the map image. Larger maps cover a larger area at the "
+        f"same zoom, up to {mosaic.MAX_MOSAIC_SIZE_PIXELS} pixels.",
+    )
     parser.add_argument(
         "--travel-mode",
         type=gmaps.TravelMode,
         choices=list(gmaps.TravelMode),
         default=gmaps.TravelMode.DRIVE,
     )
+    parser.add_argument(
+        "--routing-graph",
+        type=Path,
+        default=None,
+        help="Compute the travel times offline on this road graph, made with "
+        "scripts/convert_osm_graph.py, instead of with the Routes API. The map "
+        "image still comes from the Static Maps API.",
+    )
     args = parser.parse_args()
 
+    if args.routing_graph is not None:
+        gmaps.set_routing_provider(LocalRouter.load(args.routing_graph))
+
     main(
         output_name=args.output_name,
         center=Location(lat=args.center[0], lng=args.center[1]),
@@ -168,4 +259,10 @@ if __name__ == "__main__":
         max_normalized_distance=args.max_normalized_distance,
         preview=not args.no_preview,
         travel_mode=args.travel_mode,
+        binary=args.binary,
+        size_pixels=args.size_pixels,
+        target_error=args.target_error if args.adaptive else None,
+        max_elements=args.max_elements,
+        n_landmarks=args.landmarks,
+        quadtree_points=args.quadtree_points,
     )
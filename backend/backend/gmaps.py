@@ -1,38 +1,412 @@
+import asyncio
+import email.utils
+import hashlib
+import heapq
 import logging
 import os
+import random
+import threading
 import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from enum import Enum
-from typing import Callable, Iterable, TypedDict, Union
+from typing import Awaitable, Callable, Iterable, TypedDict, TypeVar, Union
 
+import numpy as np
 import requests
 import tqdm.auto as tqdm
+from requests.adapters import HTTPAdapter
 
-from .cache import FileBasedCache
+from .cache import BaseCache, BlobStore, create_cache
 from .location import Location
 
 logger = logging.getLogger(__name__)
 
-# Initialize global cache instance
-cache = FileBasedCache()
+T = TypeVar("T")
+
+# The cache of all Maps API calls. Created on first use by get_cache(), so that
+# importing this module doesn't open a cache that set_cache() then replaces.
+cache: Union[BaseCache, None] = None
+_cache_lock = threading.Lock()
+# Static map images, by content. The cache maps requests to their digests.
+static_map_store = BlobStore(
+    os.path.join(os.getenv("CACHE_DIR", "cache"), "static_maps"), suffix=".png"
+)
+
+# Default quota of the Compute Route Matrix method of the Routes API.
+# https://developers.google.com/maps/documentation/routes/usage-and-billing#quotas
+ROUTE_MATRIX_ELEMENTS_PER_MINUTE = 3000
+# How many route matrix requests can be in flight at the same time.
+MAX_CONCURRENT_REQUESTS = 8
+# Limits of a single Compute Route Matrix request. The number of elements
+# (origins x destinations) is also limited, see get_max_route_matrix_elements().
+# https://developers.google.com/maps/documentation/routes/choose_endpoint#compare
+ROUTE_MATRIX_MAX_WAYPOINTS = 50
+
+# (connect, read) timeouts in seconds for the different endpoints.
+STATIC_MAP_TIMEOUT = (5, 30)
+ROUTE_MATRIX_TIMEOUT = (5, 120)
+GEOCODE_TIMEOUT = (5, 15)
+
+# Route matrix elements are cached by origin and destination rounded to this many
+# decimal places, so overlapping requests share elements. 4 is about 10 meters.
+ELEMENT_CACHE_PRECISION = 4
+ROUTE_MATRIX_CACHE_TTL = 3600
+
+# Snap results are cached by location rounded to this many decimal places,
+# i.e. about 10 meters. Roads don't move, so they can be kept for a long time.
+SNAP_CACHE_PRECISION = 4
+SNAP_CACHE_TTL = 30 * 24 * 3600
+
+STATIC_MAP_STYLE = "feature:poi|visibility:off"
+STATIC_MAP_CACHE_TTL = 30 * 24 * 3600
 
 
 class TravelMode(str, Enum):
     DRIVE = "DRIVE"
     TRANSIT = "TRANSIT"
     WALK = "WALK"
+    BICYCLE = "BICYCLE"
+    # Not a Routes API travel mode, only local routing supports it
+    RUN = "RUN"
+
+
+GOOGLE_TRAVEL_MODES = [
+    TravelMode.DRIVE,
+    TravelMode.TRANSIT,
+    TravelMode.WALK,
+    TravelMode.BICYCLE,
+]
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        """A thread-safe token bucket rate limiter.
+
+        Args:
+            rate: How many tokens are added per second.
+            capacity: The maximum number of tokens, i.e. the largest allowed burst.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.last_refill) * self.rate
+        )
+        self.last_refill = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """Take `tokens` tokens if they are available.
+
+        Returns 0 if the tokens were taken, otherwise how many seconds to wait
+        before trying again.
+        """
+        if tokens > self.capacity:
+            raise ValueError(
+                f"Cannot acquire {tokens} tokens, the capacity is {self.capacity}"
+            )
+
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens: float = 1) -> None:
+        """Block until `tokens` tokens are available, then take them."""
+        while wait_seconds := self.try_acquire(tokens):
+            time.sleep(wait_seconds)
+
+    async def acquire_async(self, tokens: float = 1) -> None:
+        """Like acquire(), but waits without blocking the event loop.
+
+        Shares the tokens with acquire(), so sync and async callers in one process
+        stay within the same quota.
+        """
+        while wait_seconds := self.try_acquire(tokens):
+            await asyncio.sleep(wait_seconds)
+
+
+class BaseMapsClient:
+    # Rate limiting and transient server errors are worth retrying.
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        """The retry policy shared by the sync and async Maps clients.
+
+        Args:
+            max_retries: How many times to retry a request before giving up.
+            backoff_base: The delay before the first retry, in seconds.
+            backoff_max: The maximum delay between retries, in seconds.
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def get_backoff(self, attempt: int) -> float:
+        """Exponential backoff with "full jitter"."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def get_retry_after(self, response) -> Union[float, None]:
+        """Parse the Retry-After header, which is either seconds or an HTTP date."""
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is None:
+            return None
+
+        try:
+            seconds = float(retry_after)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+            except (TypeError, ValueError):
+                return None
+            seconds = retry_at.timestamp() - time.time()
+
+        return min(self.backoff_max, max(0.0, seconds))
+
+
+class MapsClient(BaseMapsClient):
+    def __init__(
+        self,
+        pool_maxsize: int = MAX_CONCURRENT_REQUESTS,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        """An HTTP client for the Google Maps APIs.
+
+        Connections are kept alive and reused, so bulk requests don't pay for a new
+        TCP and TLS handshake every time. Failed requests are retried with
+        exponential backoff and jitter, honoring the Retry-After header.
+
+        Args:
+            pool_maxsize: How many connections to keep open per host.
+            max_retries: How many times to retry a request before giving up.
+            backoff_base: The delay before the first retry, in seconds.
+            backoff_max: The maximum delay between retries, in seconds.
+        """
+        super().__init__(max_retries, backoff_base, backoff_max)
+
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=pool_maxsize))
+        self.session.headers["Accept-Encoding"] = "gzip"
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        timeout: tuple[float, float],
+        **kwargs,
+    ) -> requests.Response:
+        """Send a request, retrying on connection errors and retryable statuses.
+
+        The last response is returned even if its status is an error, so callers
+        decide what to do with it.
+        """
+        for attempt in range(self.max_retries + 1):
+            is_last_attempt = attempt == self.max_retries
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if is_last_attempt:
+                    raise
+                delay = self.get_backoff(attempt)
+                reason = str(e)
+            else:
+                if response.status_code not in self.RETRY_STATUS_CODES:
+                    return response
+                if is_last_attempt:
+                    return response
+                delay = self.get_retry_after(response)
+                if delay is None:
+                    delay = self.get_backoff(attempt)
+                reason = f"status {response.status_code}"
+
+            logger.warning(f"Request failed ({reason}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+        raise AssertionError("Unreachable")
+
+    def get(self, url: str, timeout: tuple[float, float], **kwargs):
+        return self.request("GET", url, timeout=timeout, **kwargs)
+
+    def post(self, url: str, timeout: tuple[float, float], **kwargs):
+        return self.request("POST", url, timeout=timeout, **kwargs)
+
+
+class SingleFlight:
+    def __init__(self):
+        """Coalesce concurrent calls with the same key into a single call.
+
+        The first caller of a key runs the function. Callers with the same key that
+        arrive while it is still running wait for its result instead of running it
+        again. The callers share a concurrent.futures.Future, so this works across
+        threads and asyncio tasks alike.
+        """
+        self.lock = threading.Lock()
+        self.in_flight: dict[str, Future] = {}
+        # The running calls of do_async()
+        self.tasks: set[asyncio.Task] = set()
+        # How many calls were answered by another call's result
+        self.n_shared = 0
+
+    def _join(self, key: str) -> tuple[Future, bool]:
+        """Get the future for the key, and whether the caller has to resolve it."""
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.n_shared += 1
+                return future, False
+
+            future = Future()
+            self.in_flight[key] = future
+            return future, True
+
+    def _finish(self, key: str, future: Future, result=None, exception=None):
+        # Callers that arrive from now on start a new call.
+        with self.lock:
+            del self.in_flight[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def do(
+        self,
+        key: str,
+        fn: Callable[[], T],
+        copy: Callable[[T], T] = lambda x: x,
+    ) -> T:
+        """Call `fn`, or wait for the result of a call with the same key.
+
+        Args:
+            key: Calls with equal keys must have interchangeable results.
+            fn: The function to call.
+            copy: Applied to the shared result for each caller, so that callers
+                can modify what they get without affecting each other.
+        """
+        future, is_leader = self._join(key)
+        if not is_leader:
+            return copy(future.result())
+
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, result=result)
+        return copy(result)
+
+    async def do_async(
+        self,
+        key: str,
+        fn: Callable[[], Awaitable[T]],
+        copy: Callable[[T], T] = lambda x: x,
+    ) -> T:
+        """Like do(), but awaits `fn()` and waits without blocking the event loop.
+
+        The call runs in its own task, so cancelling the caller that started it,
+        e.g. when a streaming client disconnects, doesn't cancel it for the
+        other callers.
+        """
+        future, is_leader = self._join(key)
+        if is_leader:
+            task = asyncio.ensure_future(fn())
+            # The event loop only keeps weak references to tasks
+            self.tasks.add(task)
+            task.add_done_callback(lambda x: self._finish_task(key, future, x))
+
+        # Cancelling a waiter must not cancel the shared future
+        return copy(await asyncio.shield(asyncio.wrap_future(future)))
+
+    def _finish_task(self, key: str, future: Future, task: asyncio.Task):
+        self.tasks.discard(task)
+        if task.cancelled():
+            with self.lock:
+                del self.in_flight[key]
+            future.cancel()
+        elif task.exception() is not None:
+            self._finish(key, future, exception=task.exception())
+        else:
+            self._finish(key, future, result=task.result())
+
+
+class RoutingProvider(ABC):
+    """Computes route matrices locally, instead of the Routes API.
+
+    See set_routing_provider() and backend.local_routing.LocalRouter.
+    """
+
+    travel_modes: list[TravelMode] = []
+
+    @abstractmethod
+    def get_route_matrix(
+        self,
+        origins: list[Location],
+        destinations: list[Location],
+        travel_mode: TravelMode,
+    ) -> list[dict]:
+        """Get the entries for all pairs, in the format of the Routes API."""
+
+    def get_route_matrix_pairs(
+        self,
+        origins: list[Location],
+        destinations: list[Location],
+        pairs: np.ndarray,
+        travel_mode: TravelMode,
+    ) -> list[dict]:
+        """Get the entries for (origin index, destination index) pairs only."""
+        wanted = set(map(tuple, np.asarray(pairs).reshape(-1, 2).tolist()))
+        return [
+            entry
+            for entry in self.get_route_matrix(origins, destinations, travel_mode)
+            if (entry["originIndex"], entry["destinationIndex"]) in wanted
+        ]
+
+    @abstractmethod
+    def snap_to_road(self, location: Location) -> "ResolvedLocation":
+        pass
+
+
+client = MapsClient()
+
+single_flight = SingleFlight()
+
+# If set, route matrices and snapping are computed by this provider instead of
+# the Google APIs, see set_routing_provider().
+routing_provider: Union[RoutingProvider, None] = None
+
+route_matrix_rate_limiter = TokenBucket(
+    rate=ROUTE_MATRIX_ELEMENTS_PER_MINUTE / 60,
+    capacity=ROUTE_MATRIX_ELEMENTS_PER_MINUTE,
+)
 
 
 def get_api_key():
     return os.getenv("GMAPS_API_KEY")
 
 
-def get_static_map(
+def get_static_map_params(
     center: Location,
     zoom: int,
     markers: Union[list[Location], None] = None,
     size_pixels: int = 400,
     scale: int = 2,
-) -> bytes:
+) -> dict:
+    """The parameters of a Static Maps API request, except for the API key."""
     if not 0 <= zoom <= 21:
         raise ValueError("Zoom must be between 0 and 21")
 
@@ -42,22 +416,83 @@ def get_static_map(
     if markers is None:
         markers = []
 
-    params = {
+    return {
         "center": center,
         "zoom": zoom,
         "size": f"{size_pixels}x{size_pixels}",
-        "key": get_api_key(),
         "markers": "|" + "|".join(str(x) for x in markers),
         "scale": scale,
-        "style": "feature:poi|visibility:off",
+        "style": STATIC_MAP_STYLE,
     }
+
+
+def get_static_map_url(params: dict) -> str:
+    params = {**params, "key": get_api_key()}
     params_s = "&".join([f"{k}={v}" for k, v in params.items()])
-    response = requests.get(
-        f"https://maps.googleapis.com/maps/api/staticmap?{params_s}"
-    )
-    response.raise_for_status()
+    return f"https://maps.googleapis.com/maps/api/staticmap?{params_s}"
+
+
+def get_static_map_cache_key(params: dict) -> str:
+    params_s = "&".join([f"{k}={v}" for k, v in params.items()])
+    return "static_map:" + hashlib.md5(params_s.encode()).hexdigest()
+
+
+def load_cached_static_map(cache_key: str) -> Union[tuple[bytes, str], None]:
+    """Get the cached image and its digest, or None if it's not cached."""
+    cached = get_cache().get_by_key(cache_key)
+    if cached is None:
+        return None
+    image = static_map_store.get(cached["digest"])
+    if image is None:
+        return None
+    return image, cached["digest"]
 
-    return response.content
+
+def store_static_map(cache_key: str, image: bytes) -> str:
+    """Cache the image under the request key and return its digest."""
+    digest = static_map_store.put(image)
+    get_cache().set_by_key(cache_key, {"digest": digest}, ttl=STATIC_MAP_CACHE_TTL)
+    return digest
+
+
+def get_static_map_with_digest(
+    center: Location,
+    zoom: int,
+    markers: Union[list[Location], None] = None,
+    size_pixels: int = 400,
+    scale: int = 2,
+) -> tuple[bytes, str]:
+    """Get a static map image and the SHA-256 digest of its content.
+
+    Images are cached in `static_map_store` by their content, and requests map to
+    images by their parameters, so repeated requests don't hit the API.
+    """
+    params = get_static_map_params(center, zoom, markers, size_pixels, scale)
+    cache_key = get_static_map_cache_key(params)
+
+    def fetch() -> tuple[bytes, str]:
+        cached = load_cached_static_map(cache_key)
+        if cached is not None:
+            return cached
+
+        response = client.get(get_static_map_url(params), timeout=STATIC_MAP_TIMEOUT)
+        response.raise_for_status()
+        image = response.content
+        return image, store_static_map(cache_key, image)
+
+    # Identical concurrent requests only call the API once.
+    return single_flight.do(cache_key, fetch)
+
+
+def get_static_map(
+    center: Location,
+    zoom: int,
+    markers: Union[list[Location], None] = None,
+    size_pixels: int = 400,
+    scale: int = 2,
+) -> bytes:
+    image, _ = get_static_map_with_digest(center, zoom, markers, size_pixels, scale)
+    return image
 
 
 def get_distance_matrix_api_payload(
@@ -65,6 +500,11 @@ def get_distance_matrix_api_payload(
     destinations: list[Location],
     travel_mode: TravelMode = TravelMode.DRIVE,
 ):
+    if travel_mode not in GOOGLE_TRAVEL_MODES:
+        raise ValueError(
+            f"The Routes API doesn't support {travel_mode}, use local routing."
+        )
+
     payload = {
         "origins": [l.to_route_matrix_location() for l in origins],
         "destinations": [l.to_route_matrix_location() for l in destinations],
@@ -86,7 +526,18 @@ def get_distance_matrix_api_payload(
     return payload
 
 
+def get_max_route_matrix_elements(travel_mode: TravelMode) -> int:
+    """The maximum number of elements (origins x destinations) in one request."""
+    if travel_mode == TravelMode.TRANSIT:
+        return 100
+    return 625
+
+
 def confirm_if_expensive_from_n(n: int):
+    if routing_provider is not None:
+        # Local routing is free
+        return
+
     # Note: 1000 elements = 5 dollars
     # https://developers.google.com/maps/documentation/routes/usage-and-billing#rm-basic
     DOLLARS_PER_ELEMENT = 0.005
@@ -111,161 +562,505 @@ def call_distance_matrix_api(
     destinations: list[Location],
     confirm: bool = True,
     travel_mode: TravelMode = TravelMode.DRIVE,
-):
-    # Check cache first
-    cached_result = cache.get(origins, destinations, travel_mode)
-    if cached_result:
+) -> list[dict]:
+    """Get the route matrix entries for all pairs of origins and destinations.
+
+    Each element is cached on its own, keyed by its origin and destination rounded
+    to ELEMENT_CACHE_PRECISION decimal places. Only the elements missing from the
+    cache are requested, packed into as few API calls as possible. Identical
+    concurrent calls share a single set of requests.
+
+    With a routing provider, the entries are computed locally and not cached.
+    """
+    if routing_provider is not None:
+        return routing_provider.get_route_matrix(origins, destinations, travel_mode)
+
+    return single_flight.do(
+        get_route_matrix_flight_key(origins, destinations, travel_mode),
+        lambda: _call_distance_matrix_api(origins, destinations, confirm, travel_mode),
+        copy=copy_route_matrix,
+    )
+
+
+def _call_distance_matrix_api(
+    origins: list[Location],
+    destinations: list[Location],
+    confirm: bool,
+    travel_mode: TravelMode,
+) -> list[dict]:
+    matrix_entries, missing = get_cached_elements(origins, destinations, travel_mode)
+    n_missing = int(missing.sum())
+    if n_missing == 0:
+        return matrix_entries
+
+    if confirm:
+        confirm_if_expensive_from_n(n_missing)
+
+    blocks = plan_route_matrix_requests(
+        missing, max_elements=get_max_route_matrix_elements(travel_mode)
+    )
+    for origin_indices, destination_indices in blocks:
+        matrix_request = RouteMatrixRequest(
+            origins=[origins[i] for i in origin_indices],
+            destinations=[destinations[i] for i in destination_indices],
+            origin_indices=origin_indices,
+            destination_indices=destination_indices,
+        )
+        new_entries = matrix_request.reindex(
+            request_route_matrix(
+                matrix_request.origins,
+                matrix_request.destinations,
+                travel_mode=travel_mode,
+            )
+        )
+        cache_elements(origins, destinations, travel_mode, new_entries)
+        matrix_entries.extend(new_entries)
+
+    print(f"💾 Cached {n_missing} elements in {len(blocks)} requests")
+
+    return matrix_entries
+
+
+def get_route_matrix_flight_key(
+    origins: list[Location],
+    destinations: list[Location],
+    travel_mode: TravelMode,
+) -> str:
+    """Calls whose locations are equal up to the element cache precision match."""
+
+    def quantize(locations: list[Location]) -> str:
+        return ";".join(
+            f"{x.lat:.{ELEMENT_CACHE_PRECISION}f},{x.lng:.{ELEMENT_CACHE_PRECISION}f}"
+            for x in locations
+        )
+
+    travel_mode = TravelMode(travel_mode)
+    key = f"{travel_mode.value}|{quantize(origins)}|{quantize(destinations)}"
+    return "route_matrix:" + hashlib.md5(key.encode()).hexdigest()
+
+
+def copy_route_matrix(matrix_entries: list[dict]) -> list[dict]:
+    """Copy the entries, since callers reindex them in place."""
+    return [dict(entry) for entry in matrix_entries]
+
+
+def get_cached_elements(
+    origins: list[Location],
+    destinations: list[Location],
+    travel_mode: TravelMode = TravelMode.DRIVE,
+) -> tuple[list[dict], np.ndarray]:
+    """Look up all pairs of origins and destinations in the element cache.
+
+    Returns the cached entries and a boolean mask of the missing elements.
+    """
+    matrix_entries = []
+    missing = np.zeros((len(origins), len(destinations)), dtype=bool)
+    for i, origin in enumerate(origins):
+        for j, destination in enumerate(destinations):
+            cached_entry = get_cache().get_element(
+                origin, destination, travel_mode, precision=ELEMENT_CACHE_PRECISION
+            )
+            if cached_entry is None:
+                missing[i, j] = True
+            else:
+                matrix_entries.append(
+                    {**cached_entry, "originIndex": i, "destinationIndex": j}
+                )
+
+    n_missing = int(missing.sum())
+    if n_missing < missing.size:
         print(
-            f"🎯 Cache hit! Saved API call for {len(origins)}x{len(destinations)} matrix"
+            f"🎯 Cache hit! Saved {missing.size - n_missing} of {missing.size} "
+            f"elements of a {len(origins)}x{len(destinations)} matrix"
         )
-        # Create a mock response object that behaves like requests.Response
-        class MockResponse:
-            def json(self):
-                return cached_result
+    return matrix_entries, missing
 
-        return MockResponse()
 
-    if confirm:
-        confirm_if_expensive(origins, destinations)
+def cache_elements(
+    origins: list[Location],
+    destinations: list[Location],
+    travel_mode: TravelMode,
+    matrix_entries: list[dict],
+) -> None:
+    """Cache route matrix entries indexed into origins and destinations."""
+    for entry in matrix_entries:
+        # Don't cache elements that failed, e.g. because of a timeout
+        if entry.get("status") or "originIndex" not in entry:
+            continue
+        if "destinationIndex" not in entry:
+            continue
+        get_cache().set_element(
+            origins[entry["originIndex"]],
+            destinations[entry["destinationIndex"]],
+            travel_mode,
+            {
+                k: v
+                for k, v in entry.items()
+                if k not in ("originIndex", "destinationIndex")
+            },
+            precision=ELEMENT_CACHE_PRECISION,
+            ttl=ROUTE_MATRIX_CACHE_TTL,
+        )
+
+
+ROUTE_MATRIX_URL = "https://routes.googleapis.com/distanceMatrix/v2:computeRouteMatrix"
 
+
+def get_route_matrix_headers() -> dict[str, str]:
+    return {
+        "X-Goog-Api-Key": get_api_key(),
+        "X-Goog-FieldMask": "originIndex,destinationIndex,"
+        "duration,distanceMeters,status,condition",
+    }
+
+
+def request_route_matrix(
+    origins: list[Location],
+    destinations: list[Location],
+    travel_mode: TravelMode = TravelMode.DRIVE,
+) -> list[dict]:
+    """Make a single, uncached request to the Routes API."""
     # Note that here we're not checking that the number of matrix elements
     # doesn't exceed the maximum allowed by the API.
     data = get_distance_matrix_api_payload(
         origins, destinations, travel_mode=travel_mode
     )
 
-    for attempt in range(3):
-        response = requests.post(
-            "https://routes.googleapis.com/distanceMatrix/v2:computeRouteMatrix",
-            json=data,
-            headers={
-                "X-Goog-Api-Key": get_api_key(),
-                "X-Goog-FieldMask": "originIndex,destinationIndex,"
-                "duration,distanceMeters,status,condition",
-            },
-        )
-        if response.status_code == 429:
-            print("Rate limit exceeded, retrying...")
-            time.sleep(30)
-            continue
+    # Only requests that actually hit the API count towards the quota.
+    route_matrix_rate_limiter.acquire(len(origins) * len(destinations))
 
-        response.raise_for_status()
+    response = client.post(
+        ROUTE_MATRIX_URL,
+        timeout=ROUTE_MATRIX_TIMEOUT,
+        json=data,
+        headers=get_route_matrix_headers(),
+    )
+    if response.status_code == 429:
+        raise RuntimeError("Rate limit exceeded")
+
+    response.raise_for_status()
+
+    return response.json()
+
+
+def get_cache() -> BaseCache:
+    """The cache used for all Maps API calls, see create_cache() for the backend."""
+    global cache
+    with _cache_lock:
+        if cache is None:
+            cache = create_cache()
+        return cache
 
-        # Cache the successful result
-        result = response.json()
-        cache.set(origins, destinations, travel_mode, result)
-        print(f"💾 Cached result for {len(origins)}x{len(destinations)} matrix")
 
-        return response
+def set_cache(new_cache: BaseCache):
+    """Replace the cache used for all Maps API calls."""
+    global cache
+    cache = new_cache
 
-    raise RuntimeError("Rate limit exceeded")
+
+def set_routing_provider(provider: Union[RoutingProvider, None]):
+    """Compute route matrices with a local provider, or with the Routes API if None."""
+    global routing_provider
+    routing_provider = provider
+
+
+def get_supported_travel_modes() -> list[TravelMode]:
+    if routing_provider is not None:
+        return list(routing_provider.travel_modes)
+    return list(GOOGLE_TRAVEL_MODES)
 
 
 def get_cache_stats():
     """Get cache statistics for monitoring"""
-    return cache.get_stats()
+    return get_cache().get_stats()
 
 
 def clear_expired_cache():
-    """Clear expired cache entries"""
-    return cache.clear_expired()
+    """Clear expired cache entries and the static map images no longer in use"""
+    removed = get_cache().clear_expired()
+    return removed + static_map_store.clear_unused(STATIC_MAP_CACHE_TTL)
+
+
+@dataclass
+class RouteMatrixRequest:
+    """A single call to the Routes API, plus where its entries belong.
+
+    The API indexes its results relative to the request, so `origin_indices[i]`
+    is the index of `origins[i]` in the full matrix, and the same for destinations.
+    """
+
+    origins: list[Location]
+    destinations: list[Location]
+    origin_indices: list[int]
+    destination_indices: list[int]
+
+    def reindex(self, matrix_entries: list[dict]) -> list[dict]:
+        """Reindex the entries of the API response to match the full matrix."""
+        for entry in matrix_entries:
+            # TODO: Some requests returned entries that didn't have
+            # originIndex or destinationIndex, but I couldn't reproduce.
+            if "originIndex" in entry:
+                entry["originIndex"] = self.origin_indices[entry["originIndex"]]
+            if "destinationIndex" in entry:
+                entry["destinationIndex"] = self.destination_indices[
+                    entry["destinationIndex"]
+                ]
+        return matrix_entries
+
+
+def fetch_route_matrices(
+    matrix_requests: list[RouteMatrixRequest],
+    travel_mode: TravelMode = TravelMode.DRIVE,
+    max_workers: int = MAX_CONCURRENT_REQUESTS,
+    desc: str = "Computing travel times",
+) -> Iterable[dict]:
+    """Run route matrix requests concurrently and yield the reindexed entries.
+
+    The throughput is bounded by `route_matrix_rate_limiter` rather than by the
+    latency of the individual requests. The entries are yielded in the order of
+    `matrix_requests`, regardless of the order in which the requests finish.
+    """
+
+    def fetch(matrix_request: RouteMatrixRequest) -> list[dict]:
+        matrix_entries = call_distance_matrix_api(
+            matrix_request.origins,
+            matrix_request.destinations,
+            confirm=False,  # Callers confirm the total cost upfront
+            travel_mode=travel_mode,
+        )
+        return matrix_request.reindex(matrix_entries)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for matrix_entries in tqdm.tqdm(
+            executor.map(fetch, matrix_requests),
+            total=len(matrix_requests),
+            desc=desc,
+        ):
+            yield from matrix_entries
+
+
+def plan_route_matrix_requests(
+    mask: Union[np.ndarray, Iterable[tuple[int, int]]],
+    max_elements: int,
+    max_waypoints: int = ROUTE_MATRIX_MAX_WAYPOINTS,
+    symmetric: bool = False,
+) -> list[tuple[list[int], list[int]]]:
+    """Pack the wanted elements of a matrix into few rectangular blocks.
+
+    Each block is a pair (origin indices, destination indices) such that every
+    element of origins x destinations is wanted, so no unwanted elements are
+    requested, and every wanted element is covered by exactly one block.
+    Blocks respect the per-request limits of the Routes API.
+
+    Finding the fewest blocks is hard in general, so this greedily grows each block
+    from the origin with the most remaining elements, adding origins that want all
+    of the block's destinations as long as that makes the block larger.
+
+    Args:
+        mask: Either a boolean matrix of shape (n_origins, n_destinations), or the
+            (origin index, destination index) pairs of the wanted elements as an
+            integer array of shape (M, 2). Pairs scale to large sparse matrices.
+        max_elements: The maximum number of elements of a block.
+        max_waypoints: The maximum number of origins plus destinations of a block.
+        symmetric: If True, (i, j) and (j, i) are interchangeable, so only one of
+            them is requested.
+    """
+    if isinstance(mask, np.ndarray) and mask.dtype == bool:
+        mask = np.argwhere(mask)
+    mask = np.asarray(mask, dtype=np.int64).reshape(-1, 2).tolist()
+
+    # The remaining elements, by origin and by destination
+    rows: dict[int, set[int]] = defaultdict(set)
+    cols: dict[int, set[int]] = defaultdict(set)
+
+    def add(i: int, j: int):
+        rows[i].add(j)
+        cols[j].add(i)
+
+    def remove(i: int, j: int):
+        rows[i].discard(j)
+        cols[j].discard(i)
+
+    for i, j in mask:
+        add(i, j)
+        if symmetric:
+            add(j, i)
+
+    # Max-heap of (-number of remaining elements, origin). Entries are updated
+    # lazily, so outdated ones are skipped when popped.
+    heap = [(-len(row), i) for i, row in rows.items()]
+    heapq.heapify(heap)
+    blocks = []
+
+    while heap:
+        n_remaining, seed = heapq.heappop(heap)
+        if -n_remaining != len(rows[seed]) or not rows[seed]:
+            continue
+
+        origins = [seed]
+        destinations = sorted(rows[seed])[: min(max_elements, max_waypoints - 1)]
+
+        overlap: dict[int, int] = defaultdict(int)
+        for destination in destinations:
+            for origin in cols[destination]:
+                overlap[origin] += 1
+        overlap.pop(seed)
+
+        for candidate in sorted(overlap, key=lambda i: (-overlap[i], i)):
+            n_origins = len(origins) + 1
+            max_destinations = min(
+                max_elements // n_origins, max_waypoints - n_origins
+            )
+            new_destinations = destinations[:max_destinations]
+            # Shrinking the block to fit another origin would leave behind fragments
+            # that need requests of their own, so only shrink to respect the limits.
+            if not all(d in rows[candidate] for d in new_destinations):
+                continue
+
+            if n_origins * len(new_destinations) > len(origins) * len(destinations):
+                origins.append(candidate)
+                destinations = new_destinations
+
+        origins.sort()
+        changed = set(origins)
+        for origin in origins:
+            for destination in destinations:
+                remove(origin, destination)
+                if symmetric:
+                    remove(destination, origin)
+                    changed.add(destination)
+
+        for i in changed:
+            if rows[i]:
+                heapq.heappush(heap, (-len(rows[i]), i))
+        blocks.append((origins, destinations))
+
+    return blocks
+
+
+def make_route_matrix_requests(
+    origins: list[Location],
+    destinations: list[Location],
+    mask: Union[np.ndarray, Iterable[tuple[int, int]]],
+    travel_mode: TravelMode = TravelMode.DRIVE,
+    symmetric: bool = False,
+) -> list[RouteMatrixRequest]:
+    """Split the masked elements of a distance matrix into API requests."""
+    blocks = plan_route_matrix_requests(
+        mask,
+        max_elements=get_max_route_matrix_elements(travel_mode),
+        symmetric=symmetric,
+    )
+    return [
+        RouteMatrixRequest(
+            origins=[origins[i] for i in origin_indices],
+            destinations=[destinations[i] for i in destination_indices],
+            origin_indices=origin_indices,
+            destination_indices=destination_indices,
+        )
+        for origin_indices, destination_indices in blocks
+    ]
 
 
 def get_distance_matrix(
-    origins: list[Location], destinations: list[Location]
+    origins: list[Location],
+    destinations: list[Location],
+    travel_mode: TravelMode = TravelMode.DRIVE,
 ) -> Iterable[dict]:
+    if routing_provider is not None:
+        # No request limits, and one search per location instead of per request
+        yield from routing_provider.get_route_matrix(origins, destinations, travel_mode)
+        return
+
     confirm_if_expensive(origins, destinations)
 
-    # This ROOT_MAX_ENTRIES assumes travel_mode=DRIVE. For TRANSIT, it's 10.
-    ROOT_MAX_ENTRIES = 25
-    MAX_ENTRIES = ROOT_MAX_ENTRIES * 2
-
-    if len(origins) * len(destinations) > MAX_ENTRIES:
-        for i in tqdm.trange(0, len(origins), ROOT_MAX_ENTRIES):
-            for j in range(0, len(destinations), ROOT_MAX_ENTRIES):
-                response = call_distance_matrix_api(
-                    origins[i : i + ROOT_MAX_ENTRIES],
-                    destinations[j : j + ROOT_MAX_ENTRIES],
-                    confirm=False,  # Already confirmed above
-                )
+    mask = np.ones((len(origins), len(destinations)), dtype=bool)
+    matrix_requests = make_route_matrix_requests(
+        origins, destinations, mask, travel_mode=travel_mode
+    )
 
-                # Reindex to match the original indices
-                matrix_entries = response.json()
-                for entry in matrix_entries:
-                    # TODO: Some requests returned entries that didn't have
-                    # originIndex or destinationIndex, but I couldn't reproduce.
-                    if "originIndex" in entry:
-                        entry["originIndex"] += i
-                    if "destinationIndex" in entry:
-                        entry["destinationIndex"] += j
-                yield from matrix_entries
-    else:
-        response = call_distance_matrix_api(origins, destinations)
-        yield from response.json()
+    yield from fetch_route_matrices(matrix_requests, travel_mode=travel_mode)
 
 
 def get_sparsified_distance_matrix(
     origins: list[Location],
     destinations: list[Location],
-    should_include: Callable[[Location, Location], bool],
+    should_include: Union[Callable[[Location, Location], bool], None] = None,
     filter_mirrored: bool = True,
     travel_mode: TravelMode = TravelMode.DRIVE,
+    pairs: Union[np.ndarray, None] = None,
+    confirm: bool = True,
 ) -> Iterable[dict]:
-    """Get a distance matrix, but only for a select subset of location pairs."""
-    mask = [
-        [should_include(origin, destination) for destination in destinations]
-        for origin in origins
-    ]
+    """Get a distance matrix, but only for a select subset of location pairs.
 
-    if filter_mirrored and origins == destinations:
-        # For a symmetrical matrix, we only need to compute one triangle.
-        for i in range(len(origins)):
-            for j in range(i):
-                mask[i][j] = False
+    The subset is given either by `should_include`, which is called for every pair,
+    or directly as (origin index, destination index) `pairs`, which scales to
+    large matrices. If origins and destinations are the same and filter_mirrored is
+    set, the matrix is assumed to be symmetric and only one of (i, j) and (j, i) is
+    computed. Set `confirm` to False if the caller already confirmed the cost.
+    """
+    symmetric = filter_mirrored and origins == destinations
+
+    if pairs is None:
+        if should_include is None:
+            raise ValueError("Either should_include or pairs must be given.")
+
+        mask = np.array(
+            [
+                [should_include(origin, destination) for destination in destinations]
+                for origin in origins
+            ],
+            dtype=bool,
+        ).reshape(len(origins), len(destinations))
+
+        if symmetric:
+            # For a symmetrical matrix, we only need to compute one triangle.
+            mask = np.triu(mask)
+        pairs = np.argwhere(mask)
+    else:
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        if symmetric:
+            pairs = np.unique(np.sort(pairs, axis=1), axis=0)
 
-    n_elements = sum(sum(x) for x in mask)
-    confirm_if_expensive_from_n(n_elements)
+    n_elements = len(pairs)
+    if confirm:
+        confirm_if_expensive_from_n(n_elements)
 
     if n_elements == 0:
         raise ValueError("No elements to include.")
 
+    if routing_provider is not None:
+        # No request limits, and one search per location instead of per request.
+        # Symmetric pairs are already in the upper triangle.
+        yield from routing_provider.get_route_matrix_pairs(
+            origins, destinations, pairs, travel_mode
+        )
+        return
+
+    # The planner is free to choose which of (i, j) and (j, i) to request.
+    matrix_requests = make_route_matrix_requests(
+        origins, destinations, pairs, travel_mode=travel_mode, symmetric=symmetric
+    )
+
     logger.info(
         f"Sparsified distance matrix has {n_elements} elements "
-        f"down from {len(origins) * len(destinations)}."
+        f"down from {len(origins) * len(destinations)}, "
+        f"packed into {len(matrix_requests)} requests."
     )
 
-    for i_origin, (origin, cur_mask) in tqdm.tqdm(
-        enumerate(zip(origins, mask)), total=len(origins), desc="Computing travel times"
-    ):
-        cur_destinations = [
-            destination
-            for destination, include in zip(destinations, cur_mask)
-            if include
-        ]
-
-        if not cur_destinations:
-            continue
-
-        reindexing = {}
-        for i, include in enumerate(cur_mask):
-            if include:
-                reindexing[len(reindexing)] = i
-
-        # We're assuming that the number of destinations is small enough that we can
-        # send them all in one request. This would break for large grids.
-        response = call_distance_matrix_api(
-            [origin], cur_destinations, confirm=False, travel_mode=travel_mode
-        )
-
-        matrix_entries = response.json()
-        for entry in matrix_entries:
-            if "originIndex" in entry:
-                assert entry["originIndex"] == 0
-                entry["originIndex"] = i_origin
-            if "destinationIndex" in entry:
-                entry["destinationIndex"] = reindexing[entry["destinationIndex"]]
-
-        yield from matrix_entries
+    for entry in fetch_route_matrices(matrix_requests, travel_mode=travel_mode):
+        if (
+            symmetric
+            and "originIndex" in entry
+            and "destinationIndex" in entry
+            and entry["originIndex"] > entry["destinationIndex"]
+        ):
+            # Report entries in the upper triangle, like for a non-packed request.
+            entry["originIndex"], entry["destinationIndex"] = (
+                entry["destinationIndex"],
+                entry["originIndex"],
+            )
+        yield entry
 
 
 class ResolvedLocation(TypedDict):
@@ -274,18 +1069,59 @@ class ResolvedLocation(TypedDict):
     types: list[str]
 
 
+def get_snap_cache_key(location: Location) -> str:
+    quantized = (
+        f"{location.lat:.{SNAP_CACHE_PRECISION}f},"
+        f"{location.lng:.{SNAP_CACHE_PRECISION}f}"
+    )
+    return hashlib.md5(f"snap:{quantized}".encode()).hexdigest()
+
+
 def snap_to_road(location: Location) -> ResolvedLocation:
     """Resolve a lan/lng pair to a location close to a road using reverse geocoding.
 
     This is useful for snapping points in unreachable locations, like bodies of water,
-    to the closest road.
+    to the closest road. Results are cached by the location rounded to
+    SNAP_CACHE_PRECISION decimal places, regardless of travel mode or grid size.
+    With a routing provider, the location is snapped to its road network instead.
     """
-    response = requests.get(
+    if routing_provider is not None:
+        return routing_provider.snap_to_road(location)
+
+    cache_key = get_snap_cache_key(location)
+    cached_result = get_cache().get_by_key(cache_key)
+    if cached_result is not None:
+        resolution = cached_result["resolution"]
+    else:
+        resolution = call_geocoding_api(location)
+        get_cache().set_by_key(
+            cache_key, {"resolution": resolution}, ttl=SNAP_CACHE_TTL
+        )
+
+    if resolution is None:
+        raise ValueError(f"No location found when resolving {location}.")
+
+    return {
+        "location": Location(**resolution["location"]),
+        "place_id": resolution["place_id"],
+        "types": resolution["types"],
+    }
+
+
+def call_geocoding_api(location: Location) -> Union[dict, None]:
+    """Reverse geocode a location and pick the result closest to a road.
+
+    Returns None if there is no suitable result.
+    """
+    response = client.get(
         f"https://maps.googleapis.com/maps/api/geocode/json?"
-        f"latlng={location}&key={get_api_key()}"
+        f"latlng={location}&key={get_api_key()}",
+        timeout=GEOCODE_TIMEOUT,
     )
     data = response.json()
 
+    if data["status"] == "ZERO_RESULTS":
+        return None
     if data["status"] != "OK":
         raise ValueError(f"Got non-OK status when resolving {location}. Got: {data}")
 
@@ -306,13 +1142,33 @@ def snap_to_road(location: Location) -> ResolvedLocation:
             break
 
     if resolution is None:
-        raise ValueError(f"No location found when resolving {location}. Got: {data}")
+        logger.warning(f"No location found when resolving {location}. Got: {data}")
+        return None
 
     return {
-        "location": Location(
-            lat=resolution["geometry"]["location"]["lat"],
-            lng=resolution["geometry"]["location"]["lng"],
-        ),
+        "location": resolution["geometry"]["location"],
         "place_id": resolution["place_id"],
         "types": resolution["types"],
     }
+
+
+def snap_locations_to_road(
+    locations: list[Location], max_workers: int = MAX_CONCURRENT_REQUESTS
+) -> list[Union[ResolvedLocation, None]]:
+    """Snap many locations to roads concurrently. Failed snaps are None."""
+
+    def snap(location: Location) -> Union[ResolvedLocation, None]:
+        try:
+            return snap_to_road(location)
+        except ValueError:
+            logger.warning(f"Failed to snap location to road: {location}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(
+            tqdm.tqdm(
+                executor.map(snap, locations),
+                total=len(locations),
+                desc="Snapping to roads",
+            )
+        )
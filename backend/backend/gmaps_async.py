@@ -0,0 +1,388 @@
+"""Asyncio versions of the Maps API calls in backend.gmaps, for the API server.
+
+A slow Google call here only suspends the request that made it, instead of
+blocking the whole event loop. The request planning, the rate limiter and the
+cache are shared with the sync functions, which are still used by the CLI.
+Cache lookups touch the disk, so they run in a worker thread.
+"""
+
+import asyncio
+import logging
+from typing import AsyncIterator, Callable, Union
+
+import httpx
+import numpy as np
+
+from . import gmaps
+from .gmaps import (
+    MAX_CONCURRENT_REQUESTS,
+    ROUTE_MATRIX_TIMEOUT,
+    ROUTE_MATRIX_URL,
+    STATIC_MAP_TIMEOUT,
+    BaseMapsClient,
+    RouteMatrixRequest,
+    TravelMode,
+    get_distance_matrix_api_payload,
+    get_max_route_matrix_elements,
+    get_route_matrix_headers,
+    copy_route_matrix,
+    get_route_matrix_flight_key,
+    get_static_map_cache_key,
+    get_static_map_params,
+    get_static_map_url,
+    make_route_matrix_requests,
+    plan_route_matrix_requests,
+)
+from .location import Location
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMapsClient(BaseMapsClient):
+    def __init__(
+        self,
+        max_connections: int = MAX_CONCURRENT_REQUESTS,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        """An asyncio HTTP client for the Google Maps APIs, see MapsClient.
+
+        The underlying httpx client is created on first use, so that it belongs to
+        the running event loop. Call aclose() when shutting down.
+
+        Args:
+            max_connections: How many connections to keep open.
+            max_retries: How many times to retry a request before giving up.
+            backoff_base: The delay before the first retry, in seconds.
+            backoff_max: The maximum delay between retries, in seconds.
+        """
+        super().__init__(max_retries, backoff_base, backoff_max)
+        self.max_connections = max_connections
+        self._session: Union[httpx.AsyncClient, None] = None
+
+    @property
+    def session(self) -> httpx.AsyncClient:
+        if self._session is None:
+            self._session = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+                headers={"Accept-Encoding": "gzip"},
+            )
+        return self._session
+
+    async def aclose(self) -> None:
+        if self._session is not None:
+            await self._session.aclose()
+            self._session = None
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        timeout: tuple[float, float],
+        **kwargs,
+    ) -> httpx.Response:
+        """Send a request, retrying on connection errors and retryable statuses.
+
+        The last response is returned even if its status is an error, so callers
+        decide what to do with it.
+        """
+        connect_timeout, read_timeout = timeout
+        httpx_timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+
+        for attempt in range(self.max_retries + 1):
+            is_last_attempt = attempt == self.max_retries
+            try:
+                response = await self.session.request(
+                    method, url, timeout=httpx_timeout, **kwargs
+                )
+            except httpx.TransportError as e:
+                if is_last_attempt:
+                    raise
+                delay = self.get_backoff(attempt)
+                reason = str(e) or type(e).__name__
+            else:
+                if response.status_code not in self.RETRY_STATUS_CODES:
+                    return response
+                if is_last_attempt:
+                    return response
+                delay = self.get_retry_after(response)
+                if delay is None:
+                    delay = self.get_backoff(attempt)
+                reason = f"status {response.status_code}"
+
+            logger.warning(f"Request failed ({reason}), retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+        raise AssertionError("Unreachable")
+
+    async def get(self, url: str, timeout: tuple[float, float], **kwargs):
+        return await self.request("GET", url, timeout=timeout, **kwargs)
+
+    async def post(self, url: str, timeout: tuple[float, float], **kwargs):
+        return await self.request("POST", url, timeout=timeout, **kwargs)
+
+
+client = AsyncMapsClient()
+
+
+async def get_static_map_with_digest(
+    center: Location,
+    zoom: int,
+    markers: Union[list[Location], None] = None,
+    size_pixels: int = 400,
+    scale: int = 2,
+) -> tuple[bytes, str]:
+    """Get a static map image and its digest, see gmaps.get_static_map_with_digest."""
+    params = get_static_map_params(center, zoom, markers, size_pixels, scale)
+    cache_key = get_static_map_cache_key(params)
+
+    async def fetch() -> tuple[bytes, str]:
+        cached = await asyncio.to_thread(gmaps.load_cached_static_map, cache_key)
+        if cached is not None:
+            return cached
+
+        response = await client.get(
+            get_static_map_url(params), timeout=STATIC_MAP_TIMEOUT
+        )
+        response.raise_for_status()
+        image = response.content
+        digest = await asyncio.to_thread(gmaps.store_static_map, cache_key, image)
+        return image, digest
+
+    # Shared with the sync get_static_map(), so identical calls coalesce.
+    return await gmaps.single_flight.do_async(cache_key, fetch)
+
+
+async def get_static_map(
+    center: Location,
+    zoom: int,
+    markers: Union[list[Location], None] = None,
+    size_pixels: int = 400,
+    scale: int = 2,
+) -> bytes:
+    image, _ = await get_static_map_with_digest(
+        center, zoom, markers, size_pixels, scale
+    )
+    return image
+
+
+async def request_route_matrix(
+    origins: list[Location],
+    destinations: list[Location],
+    travel_mode: TravelMode = TravelMode.DRIVE,
+) -> list[dict]:
+    """Make a single, uncached request to the Routes API."""
+    data = get_distance_matrix_api_payload(
+        origins, destinations, travel_mode=travel_mode
+    )
+
+    # Only requests that actually hit the API count towards the quota.
+    await gmaps.route_matrix_rate_limiter.acquire_async(
+        len(origins) * len(destinations)
+    )
+
+    response = await client.post(
+        ROUTE_MATRIX_URL,
+        timeout=ROUTE_MATRIX_TIMEOUT,
+        json=data,
+        headers=get_route_matrix_headers(),
+    )
+    if response.status_code == 429:
+        raise RuntimeError("Rate limit exceeded")
+
+    response.raise_for_status()
+
+    return response.json()
+
+
+async def call_distance_matrix_api(
+    origins: list[Location],
+    destinations: list[Location],
+    travel_mode: TravelMode = TravelMode.DRIVE,
+) -> list[dict]:
+    """Get the route matrix entries for all pairs, see gmaps.call_distance_matrix_api.
+
+    There is no cost confirmation, the server can't ask anyone. Identical
+    concurrent calls, sync or async, share a single set of requests.
+    """
+    if gmaps.routing_provider is not None:
+        # Routing locally is CPU-bound, keep the event loop free
+        return await asyncio.to_thread(
+            gmaps.routing_provider.get_route_matrix, origins, destinations, travel_mode
+        )
+
+    return await gmaps.single_flight.do_async(
+        get_route_matrix_flight_key(origins, destinations, travel_mode),
+        lambda: _call_distance_matrix_api(origins, destinations, travel_mode),
+        copy=copy_route_matrix,
+    )
+
+
+async def _call_distance_matrix_api(
+    origins: list[Location],
+    destinations: list[Location],
+    travel_mode: TravelMode,
+) -> list[dict]:
+    matrix_entries, missing = await asyncio.to_thread(
+        gmaps.get_cached_elements, origins, destinations, travel_mode
+    )
+    if not missing.any():
+        return matrix_entries
+
+    blocks = plan_route_matrix_requests(
+        missing, max_elements=get_max_route_matrix_elements(travel_mode)
+    )
+    for origin_indices, destination_indices in blocks:
+        matrix_request = RouteMatrixRequest(
+            origins=[origins[i] for i in origin_indices],
+            destinations=[destinations[i] for i in destination_indices],
+            origin_indices=origin_indices,
+            destination_indices=destination_indices,
+        )
+        new_entries = matrix_request.reindex(
+            await request_route_matrix(
+                matrix_request.origins,
+                matrix_request.destinations,
+                travel_mode=travel_mode,
+            )
+        )
+        await asyncio.to_thread(
+            gmaps.cache_elements, origins, destinations, travel_mode, new_entries
+        )
+        matrix_entries.extend(new_entries)
+
+    return matrix_entries
+
+
+async def fetch_route_matrices(
+    matrix_requests: list[RouteMatrixRequest],
+    travel_mode: TravelMode = TravelMode.DRIVE,
+    max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+    on_progress: Union[Callable[[int, int], None], None] = None,
+) -> list[dict]:
+    """Run route matrix requests concurrently, see gmaps.fetch_route_matrices.
+
+    The entries are returned in the order of `matrix_requests`.
+
+    Args:
+        on_progress: Called with (finished requests, total requests) every time
+            a request finishes.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    n_finished = 0
+
+    async def fetch(matrix_request: RouteMatrixRequest) -> list[dict]:
+        async with semaphore:
+            matrix_entries = await call_distance_matrix_api(
+                matrix_request.origins,
+                matrix_request.destinations,
+                travel_mode=travel_mode,
+            )
+
+        nonlocal n_finished
+        n_finished += 1
+        if on_progress is not None:
+            on_progress(n_finished, len(matrix_requests))
+        return matrix_request.reindex(matrix_entries)
+
+    results = await asyncio.gather(*(fetch(x) for x in matrix_requests))
+    return [entry for matrix_entries in results for entry in matrix_entries]
+
+
+async def iter_route_matrices(
+    matrix_requests: list[RouteMatrixRequest],
+    travel_mode: TravelMode = TravelMode.DRIVE,
+    max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+) -> AsyncIterator[list[dict]]:
+    """Run route matrix requests concurrently and yield the entries of each one.
+
+    Unlike fetch_route_matrices(), the entries of a request are yielded as soon as
+    it finishes, in the order the requests finish. New requests are only started
+    as earlier ones finish, so at most `max_concurrency` results are held in
+    memory at once. If the consumer stops early, the pending requests are
+    cancelled.
+    """
+    matrix_requests_iter = iter(matrix_requests)
+    pending: set[asyncio.Task] = set()
+
+    async def fetch(matrix_request: RouteMatrixRequest) -> list[dict]:
+        matrix_entries = await call_distance_matrix_api(
+            matrix_request.origins,
+            matrix_request.destinations,
+            travel_mode=travel_mode,
+        )
+        return matrix_request.reindex(matrix_entries)
+
+    def start_requests():
+        for matrix_request in matrix_requests_iter:
+            pending.add(asyncio.create_task(fetch(matrix_request)))
+            if len(pending) >= max_concurrency:
+                break
+
+    try:
+        start_requests()
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.difference_update(done)
+            start_requests()
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def make_full_route_matrix_requests(
+    origins: list[Location],
+    destinations: list[Location],
+    travel_mode: TravelMode = TravelMode.DRIVE,
+) -> list[RouteMatrixRequest]:
+    if gmaps.routing_provider is not None:
+        # Computed locally in one go, there are no request limits
+        return [
+            RouteMatrixRequest(
+                origins=origins,
+                destinations=destinations,
+                origin_indices=list(range(len(origins))),
+                destination_indices=list(range(len(destinations))),
+            )
+        ]
+
+    mask = np.ones((len(origins), len(destinations)), dtype=bool)
+    return make_route_matrix_requests(
+        origins, destinations, mask, travel_mode=travel_mode
+    )
+
+
+async def iter_distance_matrix(
+    origins: list[Location],
+    destinations: list[Location],
+    travel_mode: TravelMode = TravelMode.DRIVE,
+) -> AsyncIterator[dict]:
+    """Yield the entries of the full distance matrix as the requests finish."""
+    matrix_requests = make_full_route_matrix_requests(
+        origins, destinations, travel_mode=travel_mode
+    )
+    async for matrix_entries in iter_route_matrices(
+        matrix_requests, travel_mode=travel_mode
+    ):
+        for entry in matrix_entries:
+            yield entry
+
+
+async def get_distance_matrix(
+    origins: list[Location],
+    destinations: list[Location],
+    travel_mode: TravelMode = TravelMode.DRIVE,
+    on_progress: Union[Callable[[int, int], None], None] = None,
+) -> list[dict]:
+    matrix_requests = make_full_route_matrix_requests(
+        origins, destinations, travel_mode=travel_mode
+    )
+    return await fetch_route_matrices(
+        matrix_requests, travel_mode=travel_mode, on_progress=on_progress
+    )
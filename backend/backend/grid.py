@@ -1,16 +1,45 @@
 import logging
 import math
-from typing import Literal, TypedDict, Union
+from pathlib import Path
+from typing import Callable, Literal, TypedDict, Union
 
-import tqdm.auto as tqdm
+import numpy as np
 from pydantic import BaseModel
 
-from backend.gmaps import TravelMode, get_sparsified_distance_matrix, snap_to_road
-from backend.location import Location, NormalizedLocation, get_mercator_scale_factor
+from backend.gmaps import (
+    TravelMode,
+    confirm_if_expensive_from_n,
+    get_sparsified_distance_matrix,
+    snap_locations_to_road,
+)
+from backend.grid_format import (
+    MISSING_U32,
+    RouteMatrixColumns,
+    dense_to_array,
+    load_grid_data,
+    save_grid_data,
+)
+from backend.location import (
+    Location,
+    LocationArray,
+    NormalizedLocation,
+    find_pairs_within_radius,
+    get_mercator_scale_factor,
+)
 
 STATIC_MAP_SIZE_COEF = 0.7
 MAX_SNAP_NORMALIZED_DISTANCE = 0.05
 
+# See Grid.compute_adaptive_distance_matrix().
+# In grid spacings, so that the backbone includes the diagonal neighbors
+BACKBONE_RADIUS = 1.5
+DEFAULT_TARGET_ERROR = 0.15
+ADAPTIVE_BATCH_SIZE = 200
+TRAVEL_TIME_FIT_ITERATIONS = 3
+TRIANGLE_BOUNDS_CHUNK_SIZE = 4096
+# See Grid.compute_landmark_distance_matrix()
+DEFAULT_N_LANDMARKS = 8
+
 logger = logging.getLogger(__name__)
 
 
@@ -61,50 +90,112 @@ class Grid:
 
         self.locations: list[GridLocation] = []
         self.route_matrix: Union[list[RouteMatrixEntry], None] = None
+        # Lazily computed from route_matrix, see get_travel_times()
+        self._travel_times: Union[DenseTravelTimes, None] = None
+        # Only for grids that aren't a full lattice, see from_locations()
+        self.triangles: Union[list[tuple[int, int, int]], None] = None
+
+        raw_array = make_grid_array(center, zoom, size, size_pixels)
+        indices = np.arange(len(raw_array))
+        self._set_locations(raw_array, indices % size, indices // size, snap_to_roads)
+
+    @staticmethod
+    def from_locations(
+        center: Location,
+        zoom: int,
+        size: int,
+        raw_array: LocationArray,
+        grid_x: np.ndarray,
+        grid_y: np.ndarray,
+        triangles: list[tuple[int, int, int]],
+        snap_to_roads: bool = True,
+        size_pixels: int = 400,
+        travel_mode: TravelMode = TravelMode.DRIVE,
+    ) -> "Grid":
+        """A grid of some of the locations of a lattice, e.g. a quadtree grid.
+
+        The frontend can't triangulate such a grid by itself, so it comes with
+        its mesh.
+
+        Args:
+            size: The number of rows and columns of the lattice.
+            raw_array: The locations, before snapping.
+            grid_x: The column of each location in the lattice.
+            grid_y: The row of each location in the lattice.
+            triangles: The mesh, as triples of location indices.
+        """
+        grid = Grid.__new__(Grid)
+        grid.center = center
+        grid.zoom = zoom
+        grid.size = size
+        grid.size_pixels = size_pixels
+        grid.travel_mode = travel_mode
+        grid.locations = []
+        grid.route_matrix = None
+        grid._travel_times = None
+        grid.triangles = triangles
+        grid._set_locations(raw_array, grid_x, grid_y, snap_to_roads)
+        return grid
 
-        raw_grid = make_grid(center, zoom, size, size_pixels)
+    def _set_locations(
+        self,
+        raw_array: LocationArray,
+        grid_x: np.ndarray,
+        grid_y: np.ndarray,
+        snap_to_roads: bool,
+    ) -> None:
+        raw_locations = raw_array.to_locations()
+        if snap_to_roads:
+            snap_results = snap_locations_to_road(raw_locations)
+        else:
+            snap_results = [None] * len(raw_locations)
+
+        # Measure all the snap distances at once, failed snaps have distance 0
+        snapped_array = LocationArray.from_locations(
+            [
+                x["location"] if x is not None else location
+                for location, x in zip(raw_locations, snap_results)
+            ]
+        )
+        snap_distances = np.linalg.norm(
+            self.locations_to_normalized(snapped_array)
+            - self.locations_to_normalized(raw_array),
+            axis=1,
+        ).tolist()
 
-        for y, row in tqdm.tqdm(
-            enumerate(raw_grid),
-            total=size,
-            desc="Snapping to roads",
-            disable=not snap_to_roads,
+        for location, snap_result, snap_distance, x, y in zip(
+            raw_locations,
+            snap_results,
+            snap_distances,
+            grid_x.tolist(),
+            grid_y.tolist(),
         ):
-            for x, location in enumerate(row):
-                cur: GridLocation = GridLocation(
-                    raw_location=location,
-                    snapped_location=location,
-                    grid_x=x,
-                    grid_y=y,
-                    snap_result_types=None,
-                    snap_result_place_id=None,
-                )
-                if snap_to_roads:
-                    try:
-                        snap_result = snap_to_road(location)
-
-                        snap_distance = self.get_normalized_distance(
-                            location, snap_result["location"]
-                        )
-                        if snap_distance > MAX_SNAP_NORMALIZED_DISTANCE:
-                            logger.warning(
-                                f"Snapped location is too far from original ({snap_distance:.3f}), "
-                                "skipping: "
-                                f"{location}"
-                            )
-                        else:
-                            cur.snapped_location = snap_result["location"]
-                            cur.snap_result_types = snap_result["types"]
-                            cur.snap_result_place_id = snap_result["place_id"]
-                    except ValueError:
-                        logger.warning(f"Failed to snap location to road: {location}")
-                        # A bit of a hack since it's not actually snapped
-                        cur.snapped_location = location
-
-                self.locations.append(cur)
+            cur: GridLocation = GridLocation(
+                raw_location=location,
+                # If snapping fails, this is a bit of a hack since it's not actually
+                # snapped
+                snapped_location=location,
+                grid_x=x,
+                grid_y=y,
+                snap_result_types=None,
+                snap_result_place_id=None,
+            )
+            if snap_result is not None:
+                if snap_distance > MAX_SNAP_NORMALIZED_DISTANCE:
+                    logger.warning(
+                        f"Snapped location is too far from original ({snap_distance:.3f}), "
+                        "skipping: "
+                        f"{location}"
+                    )
+                else:
+                    cur.snapped_location = snap_result["location"]
+                    cur.snap_result_types = snap_result["types"]
+                    cur.snap_result_place_id = snap_result["place_id"]
+
+            self.locations.append(cur)
 
     def to_json(self):
-        return {
+        res = {
             "center": self.center.model_dump(mode="json"),
             "zoom": self.zoom,
             "size": self.size,
@@ -112,8 +203,98 @@ class Grid:
             "travel_mode": self.travel_mode,
             "locations": [x.model_dump(mode="json") for x in self.locations],
             "route_matrix": self.route_matrix,
-            "dense_travel_times": get_dense_travel_times(self.route_matrix),
+            "dense_travel_times": self.get_travel_times().to_list(),
         }
+        if self.triangles is not None:
+            res["triangles"] = [list(x) for x in self.triangles]
+        return res
+
+    @staticmethod
+    def from_json(grid_data: dict) -> "Grid":
+        """Create a grid from the output of to_json(), without any API calls.
+
+        The route matrix can also be a RouteMatrixColumns and the dense travel
+        times an array, as returned by load_grid_data(columnar=True).
+        """
+        grid = Grid.__new__(Grid)
+        grid.center = Location(**grid_data["center"])
+        grid.zoom = grid_data["zoom"]
+        grid.size = grid_data["size"]
+        grid.size_pixels = grid_data.get("size_pixels", 400)
+        grid.travel_mode = TravelMode(grid_data.get("travel_mode", TravelMode.DRIVE))
+        grid.locations = [GridLocation(**x) for x in grid_data["locations"]]
+        triangles = grid_data.get("triangles")
+        grid.triangles = None if triangles is None else [tuple(x) for x in triangles]
+
+        route_matrix = grid_data.get("route_matrix")
+        if isinstance(route_matrix, RouteMatrixColumns):
+            route_matrix = route_matrix.to_entries()
+        grid.route_matrix = route_matrix
+
+        grid._travel_times = None
+        dense_travel_times = grid_data.get("dense_travel_times")
+        if dense_travel_times is not None:
+            grid._travel_times = DenseTravelTimes(dense_to_array(dense_travel_times))
+
+        return grid
+
+    @staticmethod
+    def load(path: Union[str, Path]) -> "Grid":
+        """Load a grid from a grid_data.json or a binary grid_data.bin file."""
+        return Grid.from_json(load_grid_data(path, columnar=True))
+
+    def save(self, path: Union[str, Path], compression: str = "gzip") -> None:
+        """Save the grid as JSON, or in the binary format if the suffix is .bin."""
+        save_grid_data(self.to_json(), path, compression=compression)
+
+    def get_travel_times(self) -> "DenseTravelTimes":
+        """Get the dense travel times, computing them if the route matrix changed."""
+        if self.route_matrix is None:
+            raise ValueError("The route matrix hasn't been computed yet.")
+
+        if self._travel_times is None:
+            self._travel_times = DenseTravelTimes.from_route_matrix(
+                self.route_matrix, n_locations=len(self.locations)
+            )
+        return self._travel_times
+
+    def add_route_matrix_entries(self, entries: list[RouteMatrixEntry]) -> None:
+        """Add new or re-queried route matrix entries.
+
+        A re-queried entry replaces the existing one for the same pair, in either
+        direction, like in route_matrix_to_array(). If the dense travel times
+        were already computed, they're updated incrementally instead of being
+        recomputed from scratch, unless a route got slower.
+        """
+        entries = [entry for entry in entries if entry["condition"] == "ROUTE_EXISTS"]
+
+        if self.route_matrix is None:
+            self.route_matrix = []
+
+        def get_pair(entry: RouteMatrixEntry) -> tuple[int, int]:
+            a, b = entry["originIndex"], entry["destinationIndex"]
+            return min(a, b), max(a, b)
+
+        positions = {get_pair(x): k for k, x in enumerate(self.route_matrix)}
+        got_slower = False
+        for entry in entries:
+            pair = get_pair(entry)
+            k = positions.get(pair)
+            if k is None:
+                positions[pair] = len(self.route_matrix)
+                self.route_matrix.append(entry)
+                continue
+            previous = self.route_matrix[k]
+            if parse_duration(entry["duration"]) > parse_duration(previous["duration"]):
+                got_slower = True
+            self.route_matrix[k] = entry
+
+        if self._travel_times is not None:
+            if got_slower:
+                # Paths through the old route can't be updated incrementally
+                self._travel_times = None
+            else:
+                self._travel_times.add_routes(entries)
 
     def get_snapped_locations(self) -> list[Location]:
         return [x.snapped_location for x in self.locations]
@@ -121,20 +302,25 @@ class Grid:
     def get_raw_locations(self) -> list[Location]:
         return [x.raw_location for x in self.locations]
 
-    def location_to_normalized(self, location: Location) -> NormalizedLocation:
-        max_offset_lat = (
-            STATIC_MAP_SIZE_COEF
-            * self.size_pixels
-            / 2**self.zoom
-            / get_mercator_scale_factor(location.lat)
-        )
+    def get_snapped_location_array(self) -> LocationArray:
+        return LocationArray.from_locations(self.get_snapped_locations())
 
-        max_offset_lng = STATIC_MAP_SIZE_COEF * self.size_pixels / 2**self.zoom
+    def get_max_offset_lng(self) -> float:
+        """Half of the width of the static map, in degrees of longitude."""
+        return STATIC_MAP_SIZE_COEF * self.size_pixels / 2**self.zoom
 
-        x = (location.lng - self.center.lng + max_offset_lng) / (2 * max_offset_lng)
-        y = (-location.lat + self.center.lat + max_offset_lat) / (2 * max_offset_lat)
+    def location_to_normalized(self, location: Location) -> NormalizedLocation:
+        [(x, y)] = self.locations_to_normalized([location]).tolist()
         return NormalizedLocation(x=x, y=y)
 
+    def locations_to_normalized(
+        self, locations: Union[list[Location], LocationArray]
+    ) -> np.ndarray:
+        """Vectorized location_to_normalized(), returns an array of shape (N, 2)."""
+        if not isinstance(locations, LocationArray):
+            locations = LocationArray.from_locations(locations)
+        return locations.to_normalized(self.center, self.get_max_offset_lng())
+
     def compute_sparsified_distance_matrix(
         self, max_normalized_distance: float
     ) -> None:
@@ -144,21 +330,11 @@ class Grid:
         points when projected onto the map, normalized to [0, 1] along both axes.
         """
 
-        def should_include(a: Location, b: Location):
-            if a == b:
-                return False
-            a_normalized = self.location_to_normalized(a)
-            b_normalized = self.location_to_normalized(b)
-            distance = math.hypot(
-                a_normalized.x - b_normalized.x, a_normalized.y - b_normalized.y
-            )
-            return distance < max_normalized_distance
-
         distance_matrix = list(
             get_sparsified_distance_matrix(
                 self.get_snapped_locations(),
                 self.get_snapped_locations(),
-                should_include=should_include,
+                pairs=self.get_nearby_pairs(max_normalized_distance),
                 travel_mode=self.travel_mode,
             )
         )
@@ -174,6 +350,255 @@ class Grid:
             )
 
         self.route_matrix = distance_matrix
+        self._travel_times = None
+
+    def compute_adaptive_distance_matrix(
+        self,
+        max_normalized_distance: float,
+        target_error: float = DEFAULT_TARGET_ERROR,
+        max_elements: Union[int, None] = None,
+        batch_size: int = ADAPTIVE_BATCH_SIZE,
+    ) -> None:
+        """Like compute_sparsified_distance_matrix(), but only query pairs as needed.
+
+        First, only the pairs of neighboring locations (the backbone) are queried,
+        and the other travel times are filled in as shortest paths. Where a
+        filled-in time is much slower than a lower bound of the real one, from a
+        travel time model and the triangle inequality, the fill is likely a detour
+        that a direct route would avoid. The worst such pairs are queried in
+        batches until no pair is estimated to be off by more than `target_error`
+        or the budget runs out. Regular street grids need few extra pairs, while
+        rivers and highways get more.
+
+        Args:
+            max_normalized_distance: Only pairs this close are ever queried, like
+                in compute_sparsified_distance_matrix().
+            target_error: The acceptable estimated relative error of a filled-in
+                travel time, see estimate_fill_errors().
+            max_elements: The budget of Routes API elements. By default, at most as
+                many as compute_sparsified_distance_matrix() would use.
+            batch_size: How many pairs to query at most in each round.
+        """
+        backbone_pairs = self.get_backbone_pairs()
+        candidates = np.unique(
+            np.concatenate(
+                [self.get_nearby_pairs(max_normalized_distance), backbone_pairs]
+            ),
+            axis=0,
+        )
+        if max_elements is None:
+            max_elements = len(candidates)
+        max_elements = min(max_elements, len(candidates))
+        # Confirm the whole budget once instead of every round.
+        confirm_if_expensive_from_n(max_elements)
+
+        snapped = self.get_snapped_location_array()
+        a, b = snapped[candidates[:, 0]], snapped[candidates[:, 1]]
+        distances = a.distances_to(b)
+
+        points = self.locations_to_normalized(snapped)
+        normalized_distances = np.linalg.norm(
+            points[candidates[:, 0]] - points[candidates[:, 1]], axis=1
+        )
+        # The shortest pairs first, in case the budget doesn't cover the backbone
+        backbone = np.argsort(normalized_distances, kind="stable")
+        is_backbone = np.isin(
+            pairs_to_keys(candidates, len(snapped)),
+            pairs_to_keys(backbone_pairs, len(snapped)),
+        )
+        backbone = backbone[is_backbone[backbone]][:max_elements]
+
+        is_queried = np.zeros(len(candidates), dtype=bool)
+        self.route_matrix = []
+        self._travel_times = None
+
+        batch = backbone
+        n_rounds = 0
+        while len(batch) > 0:
+            is_queried[batch] = True
+            entries = self._get_route_matrix_entries(candidates[batch])
+            self.add_route_matrix_entries(entries)
+            n_rounds += 1
+            if n_rounds == 1:
+                # The later rounds query the pairs that don't fit the model, so
+                # only the backbone is a fair sample to fit it to.
+                overhead, seconds_per_meter = self.fit_travel_time_model()
+
+            travel_times = self.get_travel_times().m
+            unqueried = candidates[~is_queried]
+            lower_bounds = np.fmax(
+                overhead + distances[~is_queried] * seconds_per_meter,
+                get_triangle_lower_bounds(
+                    route_matrix_to_array(self.route_matrix, len(self.locations)),
+                    travel_times,
+                    unqueried,
+                ),
+            )
+            errors = np.zeros(len(candidates))
+            errors[~is_queried] = estimate_fill_errors(
+                travel_times[unqueried[:, 0], unqueried[:, 1]], lower_bounds
+            )
+
+            n_left = max_elements - int(is_queried.sum())
+            batch = np.argsort(-errors, kind="stable")[: min(batch_size, n_left)]
+            batch = batch[errors[batch] > target_error]
+            logger.info(
+                f"Round {n_rounds}: {is_queried.sum()} elements queried, "
+                f"max estimated error {errors.max(initial=0):.2f}, "
+                f"querying {len(batch)} more."
+            )
+
+        logger.info(
+            f"Adaptive sparsification queried {is_queried.sum()} of "
+            f"{len(candidates)} nearby elements in {n_rounds} rounds."
+        )
+
+    def compute_landmark_distance_matrix(
+        self, n_landmarks: int = DEFAULT_N_LANDMARKS
+    ) -> None:
+        """Approximate all travel times from a few landmarks and the neighbors.
+
+        The travel times from `n_landmarks` locations (the landmarks) to all the
+        others are queried, as well as the ones between neighboring locations.
+        The other travel times are filled in as shortest paths through these, so
+        this queries O(n_landmarks * N) elements instead of O(N^2) and still
+        gives dense travel times for every pair. How good they are is estimated
+        by get_travel_time_errors(), using the landmarks for lower bounds like
+        the ALT shortest path algorithm does.
+        """
+        n_locations = len(self.locations)
+        landmarks = self.pick_landmarks(n_landmarks)
+
+        others = np.arange(n_locations)
+        landmark_pairs = np.array(
+            [(landmark, j) for landmark in landmarks for j in others if j != landmark],
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        backbone = self.get_backbone_pairs()
+
+        entries = self._get_route_matrix_entries(
+            np.concatenate([landmark_pairs, backbone]), confirm=True
+        )
+        self.route_matrix = []
+        self._travel_times = None
+        self.add_route_matrix_entries(entries)
+
+        errors = self.get_travel_time_errors()[np.triu_indices(n_locations, k=1)]
+        logger.info(
+            f"Approximated {len(errors)} travel times from {len(landmarks)} "
+            f"landmarks with {len(entries)} elements. Estimated error: median "
+            f"{np.median(errors):.2f}, 90th percentile {np.quantile(errors, 0.9):.2f}."
+        )
+
+    def pick_landmarks(self, n_landmarks: int) -> list[int]:
+        """Pick landmarks that are spread out, preferring the edges of the grid.
+
+        This is farthest point sampling that also counts the center of the grid as
+        already picked. Landmarks on the edges give the best lower bounds, because
+        a landmark "behind" a pair bounds it by the difference of its distances.
+
+        Returns:
+            The indices of the landmark locations.
+        """
+        points = self.locations_to_normalized(self.get_snapped_location_array())
+        distances = np.linalg.norm(points - 0.5, axis=1)
+
+        landmarks = []
+        for _ in range(min(n_landmarks, len(points))):
+            landmark = int(np.argmax(distances))
+            landmarks.append(landmark)
+            distances = np.minimum(
+                distances, np.linalg.norm(points - points[landmark], axis=1)
+            )
+        return landmarks
+
+    def get_travel_time_errors(self) -> np.ndarray:
+        """Estimate how much each of the dense travel times may be too long.
+
+        The filled-in times are upper bounds of the real ones, and the queried
+        times give lower bounds, see get_triangle_lower_bounds(). The error is
+        the gap between them as a fraction of the filled-in time, so it's 0 for
+        queried pairs and 1 for unreachable ones.
+
+        Returns:
+            A symmetric matrix of shape (N, N).
+        """
+        travel_times = self.get_travel_times().m
+        n_locations = len(travel_times)
+        i, j = np.triu_indices(n_locations, k=1)
+        lower_bounds = get_triangle_lower_bounds(
+            route_matrix_to_array(self.route_matrix, n_locations),
+            travel_times,
+            np.stack([i, j], axis=1),
+        )
+
+        errors = np.zeros((n_locations, n_locations))
+        errors[i, j] = estimate_fill_errors(travel_times[i, j], lower_bounds)
+        errors[j, i] = errors[i, j]
+        return errors
+
+    def _get_route_matrix_entries(
+        self, pairs: np.ndarray, confirm: bool = False
+    ) -> list[RouteMatrixEntry]:
+        return list(
+            get_sparsified_distance_matrix(
+                self.get_snapped_locations(),
+                self.get_snapped_locations(),
+                pairs=pairs,
+                travel_mode=self.travel_mode,
+                confirm=confirm,
+            )
+        )
+
+    def fit_travel_time_model(self) -> tuple[float, float]:
+        """Fit the travel times of the route matrix, see fit_travel_time_model()."""
+        routes = [
+            entry
+            for entry in self.route_matrix or []
+            if entry["originIndex"] != entry["destinationIndex"]
+        ]
+        snapped = self.get_snapped_location_array()
+        origins = snapped[np.array([x["originIndex"] for x in routes], dtype=np.int64)]
+        destinations = snapped[
+            np.array([x["destinationIndex"] for x in routes], dtype=np.int64)
+        ]
+        durations = np.array(
+            [parse_duration(x["duration"]) for x in routes], dtype=np.float64
+        )
+        return fit_travel_time_model(origins.distances_to(destinations), durations)
+
+    def get_grid_spacing(self) -> float:
+        """The larger of the row and column spacing of the raw grid, normalized."""
+        points = self.locations_to_normalized(self.get_raw_locations())
+        return float(np.ptp(points, axis=0).max()) / max(self.size - 1, 1)
+
+    def get_backbone_pairs(self) -> np.ndarray:
+        """Get the pairs (i, j), i < j, of neighboring snapped locations.
+
+        These are the edges of the mesh if the grid has one, or else the pairs of
+        neighbors and diagonal neighbors in the lattice.
+        """
+        if self.triangles is None:
+            return self.get_nearby_pairs(BACKBONE_RADIUS * self.get_grid_spacing())
+
+        pairs = get_mesh_edges(self.triangles)
+        snapped = self.get_snapped_location_array()
+        a, b = snapped[pairs[:, 0]], snapped[pairs[:, 1]]
+        identical = (a.lat == b.lat) & (a.lng == b.lng)
+        return pairs[~identical]
+
+    def get_nearby_pairs(self, max_normalized_distance: float) -> np.ndarray:
+        """Get the pairs (i, j), i < j, of snapped locations that are close enough.
+
+        Pairs of locations that snapped to the same point are excluded.
+        """
+        snapped = self.get_snapped_location_array()
+        points = self.locations_to_normalized(snapped)
+        pairs = find_pairs_within_radius(points, max_normalized_distance)
+
+        a, b = snapped[pairs[:, 0]], snapped[pairs[:, 1]]
+        identical = (a.lat == b.lat) & (a.lng == b.lng)
+        return pairs[~identical]
 
     def get_normalized_distance(self, a: Location, b: Location) -> float:
         """Get the normalized distance between two locations."""
@@ -184,35 +609,243 @@ class Grid:
         )
 
 
-def get_dense_travel_times(route_matrix: list[RouteMatrixEntry]):
-    """Fills in the sparse route matrix to get a dense matrix of travel times."""
-    n_locations = (
-        max(max(x["originIndex"], x["destinationIndex"]) for x in route_matrix) + 1
+def get_mesh_edges(triangles: list[tuple[int, int, int]]) -> np.ndarray:
+    """Get the pairs (i, j), i < j, of the edges of a mesh, without duplicates."""
+    triangles_array = np.array(triangles, dtype=np.int64).reshape(-1, 3)
+    edges = np.concatenate(
+        [triangles_array[:, [a, b]] for a, b in ((0, 1), (1, 2), (0, 2))]
     )
-    m = [
-        [None if i != j else 0 for j in range(n_locations)] for i in range(n_locations)
-    ]
-    for route in route_matrix:
-        origin = route["originIndex"]
-        destination = route["destinationIndex"]
-        duration = int(route["duration"][:-1])
+    return np.unique(np.sort(edges, axis=1), axis=0)
 
-        m[origin][destination] = duration
-        m[destination][origin] = duration
 
-    # Run the Floyd-Warshall algorithm to fill in the rest of the matrix.
-    for k in tqdm.trange(len(m), desc="Computing dense matrix"):
-        for i in range(len(m)):
-            for j in range(len(m)):
-                if m[i][k] is not None and m[k][j] is not None:
-                    if m[i][j] is None or m[i][j] > m[i][k] + m[k][j]:
-                        m[i][j] = m[i][k] + m[k][j]
+def pairs_to_keys(pairs: np.ndarray, n_locations: int) -> np.ndarray:
+    """Encode pairs of indices as single integers, e.g. for np.isin()."""
+    return pairs[:, 0] * n_locations + pairs[:, 1]
+
+
+def route_matrix_to_array(
+    route_matrix: Union[list[RouteMatrixEntry], RouteMatrixColumns],
+    n_locations: Union[int, None] = None,
+) -> np.ndarray:
+    """Convert a sparse route matrix into a symmetric matrix of travel times.
+
+    Missing pairs are `np.inf`, the diagonal is 0. If a pair appears multiple times,
+    the last entry wins.
+    """
+    if isinstance(route_matrix, RouteMatrixColumns):
+        has_duration = route_matrix.duration != MISSING_U32
+        origins = route_matrix.origin_index[has_duration].astype(np.int64)
+        destinations = route_matrix.destination_index[has_duration].astype(np.int64)
+        durations = route_matrix.duration[has_duration].astype(np.float64)
+    else:
+        origins = np.array([x["originIndex"] for x in route_matrix], dtype=np.int64)
+        destinations = np.array(
+            [x["destinationIndex"] for x in route_matrix], dtype=np.int64
+        )
+        durations = np.array(
+            [parse_duration(x["duration"]) for x in route_matrix], dtype=np.float64
+        )
+
+    if n_locations is None:
+        n_locations = int(max(origins.max(), destinations.max())) + 1
+
+    m = np.full((n_locations, n_locations), np.inf)
+    np.fill_diagonal(m, 0)
+
+    # Interleave (origin, destination) and (destination, origin) so that the writes
+    # happen in the same order as when filling the matrix entry by entry.
+    rows = np.stack([origins, destinations], axis=1).ravel()
+    cols = np.stack([destinations, origins], axis=1).ravel()
+    m[rows, cols] = np.repeat(durations, 2)
 
     return m
 
 
-def linspace(a, b, n):
-    return [a + (b - a) / (n - 1) * i for i in range(n)]
+def floyd_warshall(m: np.ndarray) -> np.ndarray:
+    """All-pairs shortest paths on a matrix of edge weights, with `np.inf` for no edge.
+
+    Each step relaxes all pairs through one intermediate node at once, so this is
+    O(n^3) arithmetic but only O(n) Python-level iterations.
+    """
+    m = m.copy()
+    for k in range(len(m)):
+        np.minimum(m, m[:, k, None] + m[None, k, :], out=m)
+    return m
+
+
+def travel_times_to_list(m: np.ndarray) -> list[list[Union[int, None]]]:
+    """Convert a matrix of travel times into nested lists, with `None` for `np.inf`."""
+    reachable = np.isfinite(m)
+    res = np.where(reachable, m, 0).astype(np.int64).tolist()
+    for i, j in np.argwhere(~reachable):
+        res[i][j] = None
+    return res
+
+
+def fit_travel_time_model(
+    distances: np.ndarray, durations: np.ndarray
+) -> tuple[float, float]:
+    """Fit travel times as `overhead + distance * seconds_per_meter`.
+
+    The overhead is what every trip costs regardless of its length, e.g. waiting
+    for transit or getting out of a parking lot. It's why chaining short routes
+    overestimates longer ones.
+
+    So that routes with detours don't skew it, the line is repeatedly refit to
+    the routes that are faster than the previous fit.
+
+    Returns:
+        (overhead in seconds, seconds per meter). Both are NaN if there is nothing
+        to fit. If the fit makes no sense, the overhead is 0 and the speed is the
+        median speed.
+    """
+    valid = (distances > 0) & (durations > 0)
+    distances, durations = distances[valid], durations[valid]
+    if len(distances) == 0:
+        return math.nan, math.nan
+
+    # Detours are slower than the model, so fit the faster half of the routes.
+    is_fast = np.ones(len(distances), dtype=bool)
+    for _ in range(TRAVEL_TIME_FIT_ITERATIONS):
+        if np.ptp(distances[is_fast]) == 0:
+            break
+        seconds_per_meter, overhead = np.polyfit(
+            distances[is_fast], durations[is_fast], 1
+        )
+        residuals = durations - (overhead + distances * seconds_per_meter)
+        is_fast = residuals <= np.median(residuals)
+    else:
+        if seconds_per_meter > 0 and overhead >= 0:
+            return float(overhead), float(seconds_per_meter)
+
+    return 0.0, float(np.median(durations / distances))
+
+
+def get_triangle_lower_bounds(
+    exact: np.ndarray,
+    travel_times: np.ndarray,
+    pairs: np.ndarray,
+    chunk_size: int = TRIANGLE_BOUNDS_CHUNK_SIZE,
+) -> np.ndarray:
+    """Lower bounds of the travel times of location pairs.
+
+    If the travel time of (i, k) is known exactly and the one of (k, j) is at
+    most travel_times[k, j], the triangle inequality says that the travel time
+    of (i, j) is at least exact[i, k] - travel_times[k, j]. This is what tells
+    apart a real detour, e.g. around a river, from one that only the filled-in
+    time takes. With a landmark k whose travel times to all locations are known,
+    it's the bound of the ALT algorithm.
+
+    Args:
+        exact: The queried travel times, `np.inf` where they're not known.
+        travel_times: The filled-in travel times, upper bounds of the real ones.
+        pairs: The (i, j) pairs to bound, of shape (M, 2).
+        chunk_size: How many pairs to bound at once, to limit the memory use.
+    """
+    known = np.where(np.isfinite(exact), exact, -np.inf)
+    bounds = np.empty(len(pairs))
+    for start in range(0, len(pairs), chunk_size):
+        i = pairs[start : start + chunk_size, 0]
+        j = pairs[start : start + chunk_size, 1]
+        bounds[start : start + chunk_size] = np.maximum(
+            (known[i] - travel_times[:, j].T).max(axis=1, initial=-np.inf),
+            (known[j] - travel_times[:, i].T).max(axis=1, initial=-np.inf),
+        )
+    return bounds
+
+
+def estimate_fill_errors(
+    travel_times: np.ndarray, lower_bounds: np.ndarray
+) -> np.ndarray:
+    """Estimate how much filled-in travel times overestimate the real ones.
+
+    A filled-in time is a path through queried routes, so it can only be too
+    slow. The error is relative to an estimate of the lowest possible travel
+    time, i.e. 0.2 means that the filled-in time may be 20% too long.
+    Unreachable pairs have an error of 1.
+
+    Args:
+        travel_times: The filled-in travel times, in seconds.
+        lower_bounds: The estimated lowest travel times of the same pairs.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        errors = 1 - lower_bounds / travel_times
+    errors = np.nan_to_num(np.clip(errors, 0, 1), nan=0.0)
+    errors[np.isinf(travel_times)] = 1.0
+    return errors
+
+
+def parse_duration(duration: str) -> int:
+    """Parse a Routes API duration such as "123s" into seconds."""
+    return int(duration[:-1])
+
+
+def get_dense_travel_times(
+    route_matrix: Union[list[RouteMatrixEntry], RouteMatrixColumns]
+):
+    """Fills in the sparse route matrix to get a dense matrix of travel times."""
+    m = route_matrix_to_array(route_matrix)
+
+    # Run the Floyd-Warshall algorithm to fill in the rest of the matrix.
+    m = floyd_warshall(m)
+
+    return travel_times_to_list(m)
+
+
+class DenseTravelTimes:
+    def __init__(self, m: np.ndarray):
+        """All-pairs travel times that can be updated as new routes arrive.
+
+        Args:
+            m: A symmetric matrix of shortest travel times in seconds, with `np.inf`
+                for pairs that aren't connected.
+        """
+        self.m = m
+
+    @staticmethod
+    def from_route_matrix(
+        route_matrix: list[RouteMatrixEntry], n_locations: Union[int, None] = None
+    ) -> "DenseTravelTimes":
+        return DenseTravelTimes(
+            floyd_warshall(route_matrix_to_array(route_matrix, n_locations))
+        )
+
+    def add_route(self, a: int, b: int, duration: float) -> bool:
+        """Add an edge between locations a and b and update all shortest paths.
+
+        A new shortest path uses the new edge at most once, so it's enough to check
+        the paths i -> a -> b -> j and i -> b -> a -> j. This is O(n^2) instead of
+        the O(n^3) of a full recomputation.
+
+        Returns whether the edge made any path shorter. Note that an edge that is
+        slower than the current travel time between a and b is ignored, so a route
+        that got slower needs a full recomputation.
+        """
+        m = self.m
+        if duration >= m[a, b]:
+            return False
+
+        np.minimum(m, m[:, a, None] + duration + m[None, b, :], out=m)
+        np.minimum(m, m[:, b, None] + duration + m[None, a, :], out=m)
+        return True
+
+    def add_routes(self, route_matrix: list[RouteMatrixEntry]) -> int:
+        """Add a batch of route matrix entries. Returns the number of useful ones."""
+        n_improved = 0
+        for route in route_matrix:
+            n_improved += self.add_route(
+                route["originIndex"],
+                route["destinationIndex"],
+                parse_duration(route["duration"]),
+            )
+        return n_improved
+
+    def to_list(self) -> list[list[Union[int, None]]]:
+        return travel_times_to_list(self.m)
+
+
+def linspace(a, b, n) -> np.ndarray:
+    return a + (b - a) / (n - 1) * np.arange(n)
 
 
 def get_map_dimensions(
@@ -232,10 +865,10 @@ def get_map_dimensions(
     return max_offset_lat, max_offset_lng
 
 
-def make_grid(
+def make_grid_array(
     center: Location, zoom: int, size: int = 5, size_pixels: int = 400
-) -> list[list[Location]]:
-    """Make a grid of locations around a center point."""
+) -> LocationArray:
+    """Make a grid of locations around a center point, row by row."""
     lat_offset, lng_offset = get_map_dimensions(center, zoom, size_pixels)
 
     lat_values = linspace(
@@ -245,14 +878,15 @@ def make_grid(
         center.lng - lng_offset / 2, center.lng + lng_offset / 2, size
     )
 
-    grid = []
-    for lat in lat_values:
-        row = []
-        for lng in lng_values:
-            row.append(Location(lat=lat, lng=lng))
-        grid.append(row)
+    return LocationArray.meshgrid(lat_values, lng_values)
+
 
-    return grid
+def make_grid(
+    center: Location, zoom: int, size: int = 5, size_pixels: int = 400
+) -> list[list[Location]]:
+    """Make a grid of locations around a center point."""
+    locations = make_grid_array(center, zoom, size, size_pixels).to_locations()
+    return [locations[i : i + size] for i in range(0, len(locations), size)]
 
 
 def generate_grid(center: Location, radius_km: float, grid_size: int) -> list[Location]:
@@ -261,57 +895,100 @@ def generate_grid(center: Location, radius_km: float, grid_size: int) -> list[Lo
     # 1 degree lat ≈ 111 km, 1 degree lng varies by latitude
     lat_offset = radius_km / 111.0
     lng_offset = radius_km / (111.0 * math.cos(math.radians(center.lat)))
-    
-    # Create grid points
-    grid_points = []
-    for i in range(grid_size):
-        for j in range(grid_size):
-            # Normalize to [-1, 1] range
-            x_norm = (i / (grid_size - 1)) * 2 - 1
-            y_norm = (j / (grid_size - 1)) * 2 - 1
-            
-            # Apply to center with radius
-            lat = center.lat + y_norm * lat_offset
-            lng = center.lng + x_norm * lng_offset
-            
-            grid_points.append(Location(lat=lat, lng=lng))
-    
-    return grid_points
+
+    # Normalize to [-1, 1] range
+    norm = np.arange(grid_size) / (grid_size - 1) * 2 - 1
+
+    # Longitude is the outer axis
+    lng, lat = np.meshgrid(
+        center.lng + norm * lng_offset, center.lat + norm * lat_offset, indexing="ij"
+    )
+    return LocationArray(lat, lng).to_locations()
 
 
 def compute_spacetime_grid(
-    center: Location, 
-    grid_points: list[Location], 
-    travel_mode: TravelMode
+    center: Location, grid_points: list[Location], travel_mode: TravelMode
 ) -> dict:
     """Compute spacetime transformation for grid points."""
     try:
         # Get distance matrix from center to all grid points
-        distance_matrix = list(get_sparsified_distance_matrix(
-            [center], 
-            grid_points, 
-            should_include=lambda a, b: True,  # Include all points
-            travel_mode=travel_mode
-        ))
-        
-        # Process results into spacetime coordinates
-        spacetime_points = []
-        for i, point in enumerate(grid_points):
-            # Find corresponding matrix entry
-            travel_time = None
-            for entry in distance_matrix:
-                if (entry.get("originIndex") == 0 and 
-                    entry.get("destinationIndex") == i and
-                    entry.get("condition") == "ROUTE_EXISTS"):
-                    # Extract duration in seconds
-                    duration_str = entry.get("duration", "0s")
-                    travel_time = int(duration_str.rstrip('s'))
-                    break
-            
-            if travel_time is None:
-                travel_time = 0  # Fallback for unreachable points
-            
-            spacetime_points.append({
+        distance_matrix = list(
+            get_sparsified_distance_matrix(
+                [center],
+                grid_points,
+                should_include=lambda a, b: True,  # Include all points
+                travel_mode=travel_mode,
+            )
+        )
+        return spacetime_grid_from_route_matrix(
+            center, grid_points, travel_mode, distance_matrix
+        )
+    except Exception as e:
+        return get_spacetime_grid_fallback(center, grid_points, travel_mode, e)
+
+
+async def compute_spacetime_grid_async(
+    center: Location,
+    grid_points: list[Location],
+    travel_mode: TravelMode,
+    on_progress: Union[Callable[..., None], None] = None,
+    fallback: bool = True,
+) -> dict:
+    """Like compute_spacetime_grid(), but without blocking the event loop.
+
+    Args:
+        on_progress: Called as on_progress(stage, done, total) as the computation
+            goes through the "fetching" and "processing" stages.
+        fallback: If False, errors are raised instead of returning the grid
+            without travel times, e.g. so that a background job fails.
+    """
+
+    # Only the API server needs httpx, not the export CLI and the scripts
+    from backend import gmaps_async
+
+    def report(stage: str, done: int, total: int):
+        if on_progress is not None:
+            on_progress(stage, done, total)
+
+    try:
+        distance_matrix = await gmaps_async.get_distance_matrix(
+            [center],
+            grid_points,
+            travel_mode=travel_mode,
+            on_progress=lambda done, total: report("fetching", done, total),
+        )
+        report("processing", 0, 1)
+        return spacetime_grid_from_route_matrix(
+            center, grid_points, travel_mode, distance_matrix
+        )
+    except Exception as e:
+        if not fallback:
+            raise
+        return get_spacetime_grid_fallback(center, grid_points, travel_mode, e)
+
+
+def spacetime_grid_from_route_matrix(
+    center: Location,
+    grid_points: list[Location],
+    travel_mode: TravelMode,
+    distance_matrix: list[RouteMatrixEntry],
+) -> dict:
+    """Process the travel times from the center into spacetime coordinates."""
+    travel_times = {
+        entry["destinationIndex"]: parse_duration(entry.get("duration", "0s"))
+        for entry in distance_matrix
+        if entry.get("originIndex") == 0
+        and entry.get("condition") == "ROUTE_EXISTS"
+        and "destinationIndex" in entry
+    }
+
+    spacetime_points = []
+    for i, point in enumerate(grid_points):
+        # Fallback for unreachable points
+        travel_time = travel_times.get(i, 0)
+
+        spacetime_points.append(
+            {
                 "original_lat": point.lat,
                 "original_lng": point.lng,
                 "travel_time_seconds": travel_time,
@@ -319,36 +996,42 @@ def compute_spacetime_grid(
                 # For spacetime visualization, we can use travel time as a "distance"
                 "spacetime_x": point.lng,  # Keep original for now
                 "spacetime_y": point.lat,  # Keep original for now
-                "reachable": travel_time > 0
-            })
-        
-        return {
-            "points": spacetime_points,
-            "center": {"lat": center.lat, "lng": center.lng},
-            "travel_mode": str(travel_mode),
-            "total_points": len(spacetime_points),
-            "reachable_points": sum(1 for p in spacetime_points if p["reachable"])
-        }
-        
-    except Exception as e:
-        logger.error(f"Error computing spacetime grid: {e}")
-        # Return fallback data
-        return {
-            "points": [
-                {
-                    "original_lat": point.lat,
-                    "original_lng": point.lng,
-                    "travel_time_seconds": 0,
-                    "travel_time_minutes": 0,
-                    "spacetime_x": point.lng,
-                    "spacetime_y": point.lat,
-                    "reachable": False
-                }
-                for point in grid_points
-            ],
-            "center": {"lat": center.lat, "lng": center.lng},
-            "travel_mode": str(travel_mode),
-            "total_points": len(grid_points),
-            "reachable_points": 0,
-            "error": str(e)
-        }
+                "reachable": travel_time > 0,
+            }
+        )
+
+    return {
+        "points": spacetime_points,
+        "center": {"lat": center.lat, "lng": center.lng},
+        "travel_mode": str(travel_mode),
+        "total_points": len(spacetime_points),
+        "reachable_points": sum(1 for p in spacetime_points if p["reachable"]),
+    }
+
+
+def get_spacetime_grid_fallback(
+    center: Location,
+    grid_points: list[Location],
+    travel_mode: TravelMode,
+    error: Exception,
+) -> dict:
+    logger.error(f"Error computing spacetime grid: {error}")
+    return {
+        "points": [
+            {
+                "original_lat": point.lat,
+                "original_lng": point.lng,
+                "travel_time_seconds": 0,
+                "travel_time_minutes": 0,
+                "spacetime_x": point.lng,
+                "spacetime_y": point.lat,
+                "reachable": False,
+            }
+            for point in grid_points
+        ],
+        "center": {"lat": center.lat, "lng": center.lng},
+        "travel_mode": str(travel_mode),
+        "total_points": len(grid_points),
+        "reachable_points": 0,
+        "error": str(error),
+    }
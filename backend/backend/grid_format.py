@@ -0,0 +1,357 @@
+"""A compact binary format for grid data, as an alternative to grid_data.json.
+
+Layout, little-endian:
+
+    magic           b"STGD"
+    u8              format version
+    u8              compression of the payload: 0 = none, 1 = gzip, 2 = zstd
+    u16             reserved
+    payload
+
+The payload starts with a u32 header length and a JSON header. The header holds
+the metadata of the grid (center, zoom, locations, ...) and describes the typed
+arrays that follow it. Each array starts at an 8-byte aligned offset of the
+payload, so it can be viewed without copying, e.g. as a JS typed array.
+
+The route matrix is stored column by column, and the dense travel times as the
+upper triangle of the (symmetric) matrix. Durations are whole seconds, using
+the largest value of the dtype for missing ones.
+"""
+
+import gzip
+import json
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"STGD"
+FORMAT_VERSION = 1
+COMPRESSIONS = {"none": 0, "gzip": 1, "zstd": 2}
+PREAMBLE = struct.Struct("<4sBBH")
+ALIGNMENT = 8
+MISSING_U32 = int(np.iinfo(np.uint32).max)
+
+
+@dataclass
+class RouteMatrixColumns:
+    """A route matrix stored as one array per field."""
+
+    origin_index: np.ndarray
+    destination_index: np.ndarray
+    # In seconds, MISSING_U32 if the entry has no duration
+    duration: np.ndarray
+    # MISSING_U32 if the entry has no distance
+    distance_meters: np.ndarray
+    # Indices into `conditions`
+    condition: np.ndarray
+    conditions: list[str]
+    # Non-empty statuses, by entry index
+    statuses: dict[int, dict]
+
+    def __len__(self) -> int:
+        return len(self.origin_index)
+
+    @staticmethod
+    def from_entries(entries: list[dict]) -> "RouteMatrixColumns":
+        conditions = sorted({x.get("condition", "") for x in entries})
+        condition_codes = {condition: i for i, condition in enumerate(conditions)}
+
+        def column(values, dtype):
+            return np.array(list(values), dtype=dtype)
+
+        return RouteMatrixColumns(
+            origin_index=column((x["originIndex"] for x in entries), np.uint32),
+            destination_index=column(
+                (x["destinationIndex"] for x in entries), np.uint32
+            ),
+            duration=column(
+                (
+                    int(x["duration"][:-1]) if "duration" in x else MISSING_U32
+                    for x in entries
+                ),
+                np.uint32,
+            ),
+            distance_meters=column(
+                (x.get("distanceMeters", MISSING_U32) for x in entries), np.uint32
+            ),
+            condition=column(
+                (condition_codes[x.get("condition", "")] for x in entries), np.uint8
+            ),
+            conditions=conditions,
+            statuses={
+                i: x["status"] for i, x in enumerate(entries) if x.get("status")
+            },
+        )
+
+    def to_entries(self) -> list[dict]:
+        entries = []
+        for i, (origin, destination, duration, distance, condition) in enumerate(
+            zip(
+                self.origin_index.tolist(),
+                self.destination_index.tolist(),
+                self.duration.tolist(),
+                self.distance_meters.tolist(),
+                self.condition.tolist(),
+            )
+        ):
+            entry = {
+                "originIndex": origin,
+                "destinationIndex": destination,
+                "status": self.statuses.get(i, {}),
+            }
+            if distance != MISSING_U32:
+                entry["distanceMeters"] = distance
+            if duration != MISSING_U32:
+                entry["duration"] = f"{duration}s"
+            if self.conditions[condition]:
+                entry["condition"] = self.conditions[condition]
+            entries.append(entry)
+        return entries
+
+
+def _smallest_uint(max_value: int) -> np.dtype:
+    """The smallest unsigned dtype that can hold `max_value` plus a sentinel."""
+    for dtype in (np.uint16, np.uint32):
+        if max_value < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f"Value too large to store: {max_value}")
+
+
+def _compress(payload: bytes, compression: str) -> bytes:
+    if compression == "none":
+        return payload
+    elif compression == "gzip":
+        return gzip.compress(payload, mtime=0)
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ImportError("Install the zstandard package to use zstd compression")
+        return zstandard.ZstdCompressor(level=19).compress(payload)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def _decompress(payload: bytes, compression_code: int) -> bytes:
+    if compression_code == COMPRESSIONS["none"]:
+        return payload
+    elif compression_code == COMPRESSIONS["gzip"]:
+        return gzip.decompress(payload)
+    elif compression_code == COMPRESSIONS["zstd"]:
+        if zstandard is None:
+            raise ImportError("Install the zstandard package to read zstd files")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f"Unknown compression code: {compression_code}")
+
+
+def dense_to_array(dense_travel_times: Union[list, np.ndarray]) -> np.ndarray:
+    """Convert dense travel times (lists with None, or an array) to floats with inf."""
+    if isinstance(dense_travel_times, np.ndarray):
+        return dense_travel_times.astype(np.float64)
+    return np.array(
+        [[np.inf if x is None else x for x in row] for row in dense_travel_times],
+        dtype=np.float64,
+    ).reshape(len(dense_travel_times), -1)
+
+
+def encode_grid_data(grid_data: dict, compression: str = "gzip") -> bytes:
+    """Encode grid data, as produced by Grid.to_json(), into the binary format."""
+    metadata = {
+        k: v
+        for k, v in grid_data.items()
+        if k not in ("route_matrix", "dense_travel_times")
+    }
+    arrays: dict[str, np.ndarray] = {}
+    header: dict = {"metadata": metadata}
+
+    route_matrix = grid_data.get("route_matrix")
+    if route_matrix is not None:
+        if not isinstance(route_matrix, RouteMatrixColumns):
+            route_matrix = RouteMatrixColumns.from_entries(route_matrix)
+
+        max_index = max(
+            int(route_matrix.origin_index.max(initial=0)),
+            int(route_matrix.destination_index.max(initial=0)),
+        )
+        index_dtype = _smallest_uint(max_index)
+        arrays["route_origin_index"] = route_matrix.origin_index.astype(index_dtype)
+        arrays["route_destination_index"] = route_matrix.destination_index.astype(
+            index_dtype
+        )
+        arrays["route_duration"] = route_matrix.duration
+        arrays["route_distance_meters"] = route_matrix.distance_meters
+        arrays["route_condition"] = route_matrix.condition
+        header["route_conditions"] = route_matrix.conditions
+        header["route_statuses"] = {
+            str(k): v for k, v in route_matrix.statuses.items()
+        }
+
+    dense_travel_times = grid_data.get("dense_travel_times")
+    if dense_travel_times is not None:
+        m = dense_to_array(dense_travel_times)
+        finite = m[np.isfinite(m)]
+        if not np.array_equal(finite, np.round(finite)):
+            raise ValueError("Dense travel times must be whole seconds")
+
+        dtype = _smallest_uint(int(finite.max(initial=0)))
+        missing = np.iinfo(dtype).max
+        stored = np.where(np.isfinite(m), m, missing).astype(dtype)
+
+        if np.array_equal(stored, stored.T) and np.all(np.diag(stored) == 0):
+            header["dense_layout"] = "upper_triangle"
+            stored = stored[np.triu_indices(len(m), k=1)]
+        else:
+            header["dense_layout"] = "full"
+        header["dense_size"] = len(m)
+        arrays["dense_travel_times"] = stored
+
+    # The header contains the offsets of the arrays, which depend on the length of
+    # the header itself, so compute the layout relative to the end of the header
+    # and pad the header so that the first array is aligned.
+    header["arrays"] = []
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"].append(
+            {
+                "name": name,
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+                "offset": offset,
+            }
+        )
+        offset += _padded(array.nbytes)
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode()
+    header_bytes += b" " * (_padded(4 + len(header_bytes)) - 4 - len(header_bytes))
+
+    chunks = [struct.pack("<I", len(header_bytes)), header_bytes]
+    for array in arrays.values():
+        data = np.ascontiguousarray(array).astype(array.dtype.newbyteorder("<"))
+        data = data.tobytes()
+        chunks.append(data + b"\0" * (_padded(len(data)) - len(data)))
+
+    payload = _compress(b"".join(chunks), compression)
+    preamble = PREAMBLE.pack(MAGIC, FORMAT_VERSION, COMPRESSIONS[compression], 0)
+    return preamble + payload
+
+
+def _padded(n: int) -> int:
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def decode_grid_data(data: bytes, columnar: bool = False) -> dict:
+    """Decode grid data from the binary format.
+
+    Args:
+        data: The encoded grid data.
+        columnar: If False, the result has the same structure as grid_data.json.
+            If True, skip the conversion to Python objects: the route matrix is
+            a RouteMatrixColumns and the dense travel times a float array with
+            `np.inf` for unreachable pairs. This is much faster.
+    """
+    magic, version, compression_code, _ = PREAMBLE.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a binary grid data file")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported grid data format version: {version}")
+
+    payload = _decompress(data[PREAMBLE.size :], compression_code)
+    (header_length,) = struct.unpack_from("<I", payload)
+    header = json.loads(payload[4 : 4 + header_length])
+    arrays_start = 4 + header_length
+
+    arrays = {}
+    for spec in header["arrays"]:
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"]))
+        arrays[spec["name"]] = np.frombuffer(
+            payload, dtype=dtype, count=count, offset=arrays_start + spec["offset"]
+        ).reshape(spec["shape"])
+
+    grid_data = dict(header["metadata"])
+
+    if "route_origin_index" in arrays:
+        route_matrix = RouteMatrixColumns(
+            origin_index=arrays["route_origin_index"].astype(np.uint32),
+            destination_index=arrays["route_destination_index"].astype(np.uint32),
+            duration=arrays["route_duration"],
+            distance_meters=arrays["route_distance_meters"],
+            condition=arrays["route_condition"],
+            conditions=header["route_conditions"],
+            statuses={int(k): v for k, v in header["route_statuses"].items()},
+        )
+        grid_data["route_matrix"] = (
+            route_matrix if columnar else route_matrix.to_entries()
+        )
+
+    if "dense_travel_times" in arrays:
+        stored = arrays["dense_travel_times"]
+        missing = np.iinfo(stored.dtype).max
+        n = header["dense_size"]
+
+        if header["dense_layout"] == "upper_triangle":
+            m = np.zeros((n, n), dtype=np.float64)
+            rows, cols = np.triu_indices(n, k=1)
+            m[rows, cols] = stored
+            m[cols, rows] = stored
+            is_missing = np.zeros((n, n), dtype=bool)
+            is_missing[rows, cols] = stored == missing
+            is_missing[cols, rows] = stored == missing
+        else:
+            m = stored.astype(np.float64)
+            is_missing = stored == missing
+        m[is_missing] = np.inf
+
+        if columnar:
+            grid_data["dense_travel_times"] = m
+        else:
+            dense_list = np.where(is_missing, 0, m).astype(np.int64).tolist()
+            for i, j in np.argwhere(is_missing):
+                dense_list[i][j] = None
+            grid_data["dense_travel_times"] = dense_list
+
+    return grid_data
+
+
+def is_binary_grid_data(path: Union[str, Path]) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_grid_data(path: Union[str, Path], columnar: bool = False) -> dict:
+    """Load grid data from either a JSON or a binary file."""
+    if is_binary_grid_data(path):
+        with open(path, "rb") as f:
+            return decode_grid_data(f.read(), columnar=columnar)
+
+    with open(path) as f:
+        grid_data = json.load(f)
+
+    if columnar:
+        if "route_matrix" in grid_data:
+            grid_data["route_matrix"] = RouteMatrixColumns.from_entries(
+                grid_data["route_matrix"]
+            )
+        if "dense_travel_times" in grid_data:
+            grid_data["dense_travel_times"] = dense_to_array(
+                grid_data["dense_travel_times"]
+            )
+    return grid_data
+
+
+def save_grid_data(
+    grid_data: dict, path: Union[str, Path], compression: str = "gzip"
+) -> None:
+    """Save grid data, in the binary format if the suffix is .bin, else as JSON."""
+    path = Path(path)
+    if path.suffix == ".bin":
+        with open(path, "wb") as f:
+            f.write(encode_grid_data(grid_data, compression=compression))
+    else:
+        with open(path, "w") as f:
+            json.dump(grid_data, f)
@@ -0,0 +1,206 @@
+"""Background jobs for long-running API requests, with progress events.
+
+A job is submitted to a JobQueue, which runs a bounded number of jobs at a time
+on the event loop and keeps the results of finished jobs around so that they
+can be retrieved later. A job keeps running if the client that submitted it
+disconnects. Progress is reported as events that clients can follow, e.g. as
+server-sent events.
+
+Jobs live in the memory of one process, so with several API workers, clients
+have to be routed to the worker that has their job.
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from enum import Enum
+from typing import Any, AsyncIterator, Awaitable, Callable, Union
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_JOBS = 2
+MAX_QUEUED_JOBS = 100
+# How many finished jobs to keep the results of
+MAX_FINISHED_JOBS = 100
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class Job:
+    def __init__(self, kind: str):
+        """A unit of background work and its progress.
+
+        Args:
+            kind: What the job does, e.g. "spacetime-grid".
+        """
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = JobStatus.QUEUED
+        self.created_at = time.time()
+        self.finished_at: Union[float, None] = None
+        self.result: Any = None
+        self.error: Union[str, None] = None
+
+        self.events: list[dict] = []
+        # Replaced by a new event every time something is added to self.events
+        self._changed = asyncio.Event()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (JobStatus.DONE, JobStatus.FAILED)
+
+    def _add_event(self, event: dict) -> None:
+        self.events.append(event)
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _set_status(self, status: JobStatus) -> None:
+        self.status = status
+        if self.is_finished:
+            self.finished_at = time.time()
+
+        event = {"type": "status", "status": status.value}
+        if status == JobStatus.FAILED:
+            event["error"] = self.error
+        self._add_event(event)
+
+    def report(
+        self,
+        stage: str,
+        done: Union[int, None] = None,
+        total: Union[int, None] = None,
+    ) -> None:
+        """Report progress, e.g. report("fetching", 3, 10)."""
+        self._add_event(
+            {"type": "progress", "stage": stage, "done": done, "total": total}
+        )
+
+    async def follow(self) -> AsyncIterator[dict]:
+        """Yield all events of the job, past and future, until it finishes."""
+        i = 0
+        while True:
+            changed = self._changed
+            while i < len(self.events):
+                yield self.events[i]
+                i += 1
+            if self.is_finished:
+                return
+            await changed.wait()
+
+    def to_json(self, include_result: bool = True) -> dict:
+        res = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status.value,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "progress": next(
+                (x for x in reversed(self.events) if x["type"] == "progress"), None
+            ),
+        }
+        if self.error is not None:
+            res["error"] = self.error
+        if include_result and self.status == JobStatus.DONE:
+            res["result"] = self.result
+        return res
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class JobQueue:
+    def __init__(
+        self,
+        max_workers: int = MAX_CONCURRENT_JOBS,
+        max_queued: int = MAX_QUEUED_JOBS,
+        max_finished: int = MAX_FINISHED_JOBS,
+    ):
+        """Runs submitted jobs on a bounded pool of asyncio workers.
+
+        Args:
+            max_workers: How many jobs run at the same time.
+            max_queued: How many jobs can wait before submit() refuses new ones.
+            max_finished: How many finished jobs to keep. The oldest are dropped.
+        """
+        self.max_workers = max_workers
+        self.max_finished = max_finished
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.workers: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        """Start the workers. Must be called from the running event loop."""
+        if not self.workers:
+            self.workers = [
+                asyncio.create_task(self._work()) for _ in range(self.max_workers)
+            ]
+
+    async def stop(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, kind: str, fn: Callable[[Job], Awaitable[Any]]) -> Job:
+        """Queue `fn(job)` to run in the background. Its return value is the result.
+
+        Raises JobQueueFullError if too many jobs are waiting.
+        """
+        job = Job(kind)
+        try:
+            self.queue.put_nowait((job, fn))
+        except asyncio.QueueFull:
+            raise JobQueueFullError(
+                f"Too many queued jobs ({self.queue.maxsize}), try again later."
+            )
+
+        self.jobs[job.id] = job
+        job._set_status(JobStatus.QUEUED)
+        self._drop_old_jobs()
+        return job
+
+    def get(self, job_id: str) -> Union[Job, None]:
+        return self.jobs.get(job_id)
+
+    def _drop_old_jobs(self) -> None:
+        finished = [job_id for job_id, job in self.jobs.items() if job.is_finished]
+        for job_id in finished[: max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    async def _work(self) -> None:
+        while True:
+            job, fn = await self.queue.get()
+            try:
+                await self._run(job, fn)
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, job: Job, fn: Callable[[Job], Awaitable[Any]]) -> None:
+        job._set_status(JobStatus.RUNNING)
+        try:
+            job.result = await fn(job)
+        except asyncio.CancelledError:
+            job.error = "The job was cancelled."
+            job._set_status(JobStatus.FAILED)
+            raise
+        except Exception as e:
+            logger.exception(f"Job {job.id} ({job.kind}) failed")
+            job.error = str(e)
+            job._set_status(JobStatus.FAILED)
+        else:
+            job._set_status(JobStatus.DONE)
+        self._drop_old_jobs()
+
+
+def format_sse(event: dict) -> str:
+    """Format an event as a server-sent event, named by its type."""
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
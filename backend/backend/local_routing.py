@@ -0,0 +1,638 @@
+"""Offline routing on a local road network, instead of the Routes API.
+
+A road network, e.g. an OpenStreetMap extract converted with
+scripts/convert_osm_graph.py, is stored as a RoadGraph file. For every travel
+mode, a SpeedProfile gives the speed on each kind of road (its OSM highway tag),
+and the graph is turned into a compact CSR (compressed sparse row) graph of
+travel times: the edges leaving node i are `targets[offsets[i]:offsets[i + 1]]`.
+
+Route matrices are computed by running Dijkstra from every origin until all the
+destinations are settled, or from every destination on the reversed graph if
+there are fewer of them. The entries have the format of the Routes API, so a
+LocalRouter can replace it, see gmaps.set_routing_provider():
+
+    gmaps.set_routing_provider(LocalRouter(RoadGraph.load("prague.npz")))
+"""
+
+import gzip
+import heapq
+import logging
+import math
+import xml.etree.ElementTree as ElementTree
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+
+from backend.gmaps import ResolvedLocation, RoutingProvider, TravelMode
+from backend.location import (
+    EARTH_RADIUS_METERS,
+    Location,
+    LocationArray,
+    haversine_distance,
+)
+
+# Locations farther than this from the road network have no routes
+MAX_SNAP_METERS = 500
+# How many nearest nodes of locations to remember, by travel mode
+MAX_CACHED_SNAPS = 100_000
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SpeedProfile:
+    """How fast a travel mode goes on each kind of road.
+
+    Args:
+        speeds_kmh: The speed on each OSM highway type. Other roads are forbidden.
+        respects_oneway: Whether one-way roads can only be used in their direction.
+        access_speed_kmh: The speed from a location to the nearest node and back.
+    """
+
+    speeds_kmh: dict[str, float]
+    respects_oneway: bool
+    access_speed_kmh: float
+
+
+def _speeds(kmh: float, highways: list[str]) -> dict[str, float]:
+    return {highway: kmh for highway in highways}
+
+
+FOOT_HIGHWAYS = [
+    "footway",
+    "pedestrian",
+    "path",
+    "track",
+    "cycleway",
+    "living_street",
+    "residential",
+    "service",
+    "unclassified",
+    "tertiary",
+    "tertiary_link",
+    "secondary",
+    "secondary_link",
+    "primary",
+    "primary_link",
+]
+BICYCLE_HIGHWAYS = [
+    "cycleway",
+    "living_street",
+    "residential",
+    "service",
+    "unclassified",
+    "tertiary",
+    "tertiary_link",
+    "secondary",
+    "secondary_link",
+    "primary",
+    "primary_link",
+]
+
+SPEED_PROFILES: dict[TravelMode, SpeedProfile] = {
+    TravelMode.WALK: SpeedProfile(
+        speeds_kmh={**_speeds(5, FOOT_HIGHWAYS), "steps": 3},
+        respects_oneway=False,
+        access_speed_kmh=5,
+    ),
+    TravelMode.RUN: SpeedProfile(
+        speeds_kmh={**_speeds(10, FOOT_HIGHWAYS), "steps": 5},
+        respects_oneway=False,
+        access_speed_kmh=10,
+    ),
+    TravelMode.BICYCLE: SpeedProfile(
+        speeds_kmh={
+            **_speeds(16, BICYCLE_HIGHWAYS),
+            "living_street": 10,
+            "path": 12,
+            "track": 12,
+            # Walking the bike
+            "footway": 5,
+            "pedestrian": 5,
+        },
+        respects_oneway=True,
+        access_speed_kmh=5,
+    ),
+    TravelMode.DRIVE: SpeedProfile(
+        speeds_kmh={
+            "motorway": 100,
+            "motorway_link": 60,
+            "trunk": 80,
+            "trunk_link": 50,
+            "primary": 60,
+            "primary_link": 40,
+            "secondary": 50,
+            "secondary_link": 40,
+            "tertiary": 40,
+            "tertiary_link": 30,
+            "unclassified": 30,
+            "residential": 30,
+            "living_street": 10,
+            "service": 15,
+        },
+        respects_oneway=True,
+        access_speed_kmh=5,
+    ),
+}
+
+
+@dataclass
+class CsrGraph:
+    """A directed graph with the outgoing edges of each node stored contiguously."""
+
+    offsets: np.ndarray
+    targets: np.ndarray
+    seconds: np.ndarray
+    meters: np.ndarray
+    # The same arrays as lists, which are much faster to index one by one
+    _lists: Union[tuple[list, list, list, list], None] = field(default=None, repr=False)
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.offsets) - 1
+
+    @staticmethod
+    def from_edges(
+        n_nodes: int,
+        sources: np.ndarray,
+        targets: np.ndarray,
+        seconds: np.ndarray,
+        meters: np.ndarray,
+    ) -> "CsrGraph":
+        order = np.argsort(sources, kind="stable")
+        offsets = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=n_nodes), out=offsets[1:])
+        return CsrGraph(
+            offsets=offsets,
+            targets=targets[order].astype(np.int32),
+            seconds=seconds[order].astype(np.float64),
+            meters=meters[order].astype(np.float64),
+        )
+
+    def get_sources(self) -> np.ndarray:
+        """The source node of every edge."""
+        return np.repeat(np.arange(self.n_nodes), np.diff(self.offsets))
+
+    def reversed(self) -> "CsrGraph":
+        return CsrGraph.from_edges(
+            self.n_nodes, self.targets, self.get_sources(), self.seconds, self.meters
+        )
+
+    def dijkstra(
+        self, source: int, targets: set[int]
+    ) -> dict[int, tuple[float, float]]:
+        """The (seconds, meters) of the fastest paths from `source` to `targets`.
+
+        The search stops as soon as all the targets are settled. Unreachable
+        targets are missing from the result.
+        """
+        if self._lists is None:
+            self._lists = (
+                self.offsets.tolist(),
+                self.targets.tolist(),
+                self.seconds.tolist(),
+                self.meters.tolist(),
+            )
+        offsets, edge_targets, edge_seconds, edge_meters = self._lists
+
+        best = {source: 0.0}
+        lengths = {source: 0.0}
+        remaining = set(targets)
+        res = {}
+        heap = [(0.0, source)]
+        while heap and remaining:
+            seconds, node = heapq.heappop(heap)
+            if seconds > best[node]:
+                continue
+            if node in remaining:
+                remaining.remove(node)
+                res[node] = (seconds, lengths[node])
+
+            for k in range(offsets[node], offsets[node + 1]):
+                target = edge_targets[k]
+                new_seconds = seconds + edge_seconds[k]
+                if new_seconds < best.get(target, math.inf):
+                    best[target] = new_seconds
+                    lengths[target] = lengths[node] + edge_meters[k]
+                    heapq.heappush(heap, (new_seconds, target))
+        return res
+
+
+class NodeIndex:
+    def __init__(
+        self, lat: np.ndarray, lng: np.ndarray, nodes: np.ndarray, radius: float
+    ):
+        """Find the nearest node within `radius` meters, like find_pairs_within_radius().
+
+        The nodes are put into buckets of at least `radius` meters on each side,
+        so the nearest node within the radius is in the bucket of the location
+        or in one of its 8 neighbors.
+
+        Args:
+            lat: The latitudes of all the nodes of the graph.
+            lng: The longitudes of all the nodes of the graph.
+            nodes: The nodes to index.
+            radius: The maximum distance to a node, in meters.
+        """
+        self.lat = lat
+        self.lng = lng
+        self.cell_degrees = math.degrees(radius / EARTH_RADIUS_METERS)
+        # A degree of longitude is shortest at the highest latitude, so the
+        # buckets are wide enough everywhere.
+        max_lat = float(np.abs(lat[nodes]).max()) if len(nodes) else 0.0
+        self.lng_scale = max(math.cos(math.radians(max_lat)), 1e-3)
+
+        cells, inverse = np.unique(
+            self.get_cells(lat[nodes], lng[nodes]), axis=0, return_inverse=True
+        )
+        order = np.argsort(inverse.ravel(), kind="stable")
+        counts = np.bincount(inverse.ravel(), minlength=len(cells))
+        self.buckets: dict[tuple[int, int], np.ndarray] = dict(
+            zip(
+                map(tuple, cells.tolist()),
+                np.split(nodes[order], np.cumsum(counts)[:-1]),
+            )
+        )
+
+    def get_cells(self, lat: np.ndarray, lng: np.ndarray) -> np.ndarray:
+        # Without a radius, everything is in one bucket
+        if not math.isfinite(self.cell_degrees):
+            return np.zeros((len(lat), 2), dtype=np.int64)
+        return np.floor(
+            np.stack([lat, lng * self.lng_scale], axis=1) / self.cell_degrees
+        ).astype(np.int64)
+
+    def get_nearest(
+        self, lat: np.ndarray, lng: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """The nearest node of each location and the distance to it, in meters.
+
+        Locations without a node in the neighboring buckets get -1 and inf.
+        """
+        nodes = np.full(len(lat), -1, dtype=np.int64)
+        meters = np.full(len(lat), np.inf)
+        if len(lat) == 0:
+            return nodes, meters
+
+        cells, inverse = np.unique(
+            self.get_cells(lat, lng), axis=0, return_inverse=True
+        )
+        inverse = inverse.ravel()
+        for k, (x, y) in enumerate(cells.tolist()):
+            neighbors = [
+                self.buckets[x + dx, y + dy]
+                for dx in (-1, 0, 1)
+                for dy in (-1, 0, 1)
+                if (x + dx, y + dy) in self.buckets
+            ]
+            if not neighbors:
+                continue
+            candidates = np.concatenate(neighbors)
+            ix = np.flatnonzero(inverse == k)
+            distances = haversine_distance(
+                lat[ix, np.newaxis],
+                lng[ix, np.newaxis],
+                self.lat[candidates],
+                self.lng[candidates],
+            )
+            nearest = np.argmin(distances, axis=1)
+            nodes[ix] = candidates[nearest]
+            meters[ix] = distances[np.arange(len(ix)), nearest]
+        return nodes, meters
+
+
+@dataclass
+class RoadGraph:
+    """Road segments between nodes, independent of the travel mode.
+
+    Every segment can be traveled in both directions unless it's one-way, in
+    which case it goes from `edge_from` to `edge_to`.
+    """
+
+    lat: np.ndarray
+    lng: np.ndarray
+    edge_from: np.ndarray
+    edge_to: np.ndarray
+    edge_meters: np.ndarray
+    # Indices into highway_types
+    edge_highway: np.ndarray
+    edge_oneway: np.ndarray
+    highway_types: list[str]
+
+    @staticmethod
+    def from_segments(
+        lat: np.ndarray,
+        lng: np.ndarray,
+        segments: list[tuple[int, int, str, bool]],
+    ) -> "RoadGraph":
+        """Make a graph from (from node, to node, highway type, oneway) segments."""
+        highway_types = sorted({highway for _, _, highway, _ in segments})
+        highway_index = {highway: i for i, highway in enumerate(highway_types)}
+
+        edge_from = np.array([x[0] for x in segments], dtype=np.int32)
+        edge_to = np.array([x[1] for x in segments], dtype=np.int32)
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        return RoadGraph(
+            lat=lat,
+            lng=lng,
+            edge_from=edge_from,
+            edge_to=edge_to,
+            edge_meters=haversine_distance(
+                lat[edge_from], lng[edge_from], lat[edge_to], lng[edge_to]
+            ).astype(np.float32),
+            edge_highway=np.array(
+                [highway_index[x[2]] for x in segments], dtype=np.uint8
+            ),
+            edge_oneway=np.array([x[3] for x in segments], dtype=bool),
+            highway_types=highway_types,
+        )
+
+    @staticmethod
+    def from_osm_xml(path: Union[str, Path]) -> "RoadGraph":
+        """Read the roads of an OpenStreetMap XML extract, .osm or .osm.gz."""
+        open_fn = gzip.open if str(path).endswith(".gz") else open
+        # The locations of all the nodes, since ways come after them
+        node_locations: dict[int, tuple[float, float]] = {}
+        ways: list[tuple[list[int], str, bool]] = []
+        profile_highways = {
+            highway
+            for profile in SPEED_PROFILES.values()
+            for highway in profile.speeds_kmh
+        }
+
+        with open_fn(path, "rb") as f:
+            events = ElementTree.iterparse(f, events=("start", "end"))
+            _, root = next(events)
+            for event, element in events:
+                if event != "end" or element.tag not in ("node", "way", "relation"):
+                    continue
+                if element.tag == "node":
+                    node_locations[int(element.get("id"))] = (
+                        float(element.get("lat")),
+                        float(element.get("lon")),
+                    )
+                elif element.tag == "way":
+                    tags = {x.get("k"): x.get("v") for x in element.iter("tag")}
+                    highway = tags.get("highway")
+                    if highway in profile_highways:
+                        refs = [int(x.get("ref")) for x in element.iter("nd")]
+                        oneway = tags.get("oneway")
+                        if oneway == "-1":
+                            refs.reverse()
+                        is_oneway = (
+                            oneway in ("yes", "true", "1", "-1")
+                            or tags.get("junction") == "roundabout"
+                            or highway == "motorway"
+                        )
+                        ways.append((refs, highway, is_oneway))
+                # Everything needed was read, so free the element and its tags.
+                # The root would otherwise keep every element of the extract.
+                element.clear()
+                root.clear()
+
+        node_index: dict[int, int] = {}
+        segments = []
+        for refs, highway, is_oneway in ways:
+            refs = [x for x in refs if x in node_locations]
+            for a, b in zip(refs, refs[1:]):
+                for ref in (a, b):
+                    node_index.setdefault(ref, len(node_index))
+                segments.append((node_index[a], node_index[b], highway, is_oneway))
+
+        locations = np.array(
+            [node_locations[x] for x in node_index], dtype=np.float64
+        ).reshape(-1, 2)
+        return RoadGraph.from_segments(locations[:, 0], locations[:, 1], segments)
+
+    @staticmethod
+    def load(path: Union[str, Path]) -> "RoadGraph":
+        with np.load(path, allow_pickle=False) as data:
+            return RoadGraph(
+                lat=data["lat"],
+                lng=data["lng"],
+                edge_from=data["edge_from"],
+                edge_to=data["edge_to"],
+                edge_meters=data["edge_meters"],
+                edge_highway=data["edge_highway"],
+                edge_oneway=data["edge_oneway"],
+                highway_types=data["highway_types"].tolist(),
+            )
+
+    def save(self, path: Union[str, Path]) -> None:
+        """Save as a compressed .npz file."""
+        with open(path, "wb") as f:
+            np.savez_compressed(
+                f,
+                lat=self.lat,
+                lng=self.lng,
+                edge_from=self.edge_from,
+                edge_to=self.edge_to,
+                edge_meters=self.edge_meters,
+                edge_highway=self.edge_highway,
+                edge_oneway=self.edge_oneway,
+                highway_types=np.array(self.highway_types),
+            )
+
+    def to_csr(self, profile: SpeedProfile) -> CsrGraph:
+        """The directed graph of the travel times of a speed profile."""
+        speeds_kmh = np.array(
+            [profile.speeds_kmh.get(x, 0) for x in self.highway_types],
+            dtype=np.float64,
+        )[self.edge_highway]
+        allowed = speeds_kmh > 0
+        seconds = self.edge_meters[allowed] / (speeds_kmh[allowed] / 3.6)
+        meters = self.edge_meters[allowed]
+        edge_from, edge_to = self.edge_from[allowed], self.edge_to[allowed]
+
+        if profile.respects_oneway:
+            backward = ~self.edge_oneway[allowed]
+        else:
+            backward = np.ones(len(edge_from), dtype=bool)
+        return CsrGraph.from_edges(
+            len(self.lat),
+            np.concatenate([edge_from, edge_to[backward]]),
+            np.concatenate([edge_to, edge_from[backward]]),
+            np.concatenate([seconds, seconds[backward]]),
+            np.concatenate([meters, meters[backward]]),
+        )
+
+
+class LocalRouter(RoutingProvider):
+    travel_modes = list(SPEED_PROFILES)
+
+    def __init__(self, graph: RoadGraph, max_snap_meters: float = MAX_SNAP_METERS):
+        """Route matrices from a local road network, see the module docstring.
+
+        Args:
+            graph: The road network.
+            max_snap_meters: Locations farther than this from the nearest road
+                usable by the travel mode have no routes.
+        """
+        self.graph = graph
+        self.max_snap_meters = max_snap_meters
+        # Built on first use, by travel mode, or None for all the nodes
+        self._csr: dict[TravelMode, tuple[CsrGraph, CsrGraph]] = {}
+        self._indices: dict[Union[TravelMode, None], NodeIndex] = {}
+        self._snaps: dict[
+            Union[TravelMode, None], dict[tuple[float, float], tuple[int, float]]
+        ] = {}
+
+    @staticmethod
+    def load(path: Union[str, Path]) -> "LocalRouter":
+        return LocalRouter(RoadGraph.load(path))
+
+    def get_csr(self, travel_mode: TravelMode) -> tuple[CsrGraph, CsrGraph]:
+        """The graph of a travel mode and its reverse."""
+        if travel_mode not in SPEED_PROFILES:
+            raise ValueError(f"Local routing doesn't support {travel_mode}.")
+        if travel_mode not in self._csr:
+            csr = self.graph.to_csr(SPEED_PROFILES[travel_mode])
+            self._csr[travel_mode] = (csr, csr.reversed())
+        return self._csr[travel_mode]
+
+    def get_node_index(self, travel_mode: Union[TravelMode, None]) -> NodeIndex:
+        """The index of the nodes with edges usable by `travel_mode`, or all nodes."""
+        if travel_mode not in self._indices:
+            if travel_mode is None:
+                nodes = np.arange(len(self.graph.lat))
+            else:
+                csr, reverse_csr = self.get_csr(travel_mode)
+                has_edges = (np.diff(csr.offsets) > 0) | (
+                    np.diff(reverse_csr.offsets) > 0
+                )
+                nodes = np.flatnonzero(has_edges)
+            self._indices[travel_mode] = NodeIndex(
+                self.graph.lat, self.graph.lng, nodes, self.max_snap_meters
+            )
+        return self._indices[travel_mode]
+
+    def get_nearest_nodes(
+        self, locations: list[Location], travel_mode: Union[TravelMode, None] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """The nearest node of each location and the distance to it, in meters.
+
+        Only nodes with edges usable by `travel_mode` count, or all nodes if
+        it's None. Locations without a node within max_snap_meters get -1.
+        """
+        snaps = self._snaps.setdefault(travel_mode, {})
+        keys = [(x.lat, x.lng) for x in locations]
+        missing = list({key for key in keys if key not in snaps})
+        if missing:
+            lat, lng = np.array(missing, dtype=np.float64).reshape(-1, 2).T
+            nodes, meters = self.get_node_index(travel_mode).get_nearest(lat, lng)
+            nodes[meters > self.max_snap_meters] = -1
+            if len(snaps) + len(missing) > MAX_CACHED_SNAPS:
+                snaps.clear()
+            snaps.update(zip(missing, zip(nodes.tolist(), meters.tolist())))
+
+        res = [snaps[key] for key in keys]
+        return (
+            np.array([x[0] for x in res], dtype=np.int64),
+            np.array([x[1] for x in res], dtype=np.float64),
+        )
+
+    def snap_to_road(self, location: Location) -> ResolvedLocation:
+        [node], _ = self.get_nearest_nodes([location])
+        if node < 0:
+            raise ValueError(f"No road found near {location}.")
+        return {
+            "location": Location(
+                lat=float(self.graph.lat[node]), lng=float(self.graph.lng[node])
+            ),
+            "place_id": f"node:{node}",
+            "types": ["route"],
+        }
+
+    def get_route_matrix(
+        self,
+        origins: list[Location],
+        destinations: list[Location],
+        travel_mode: TravelMode = TravelMode.DRIVE,
+    ) -> list[dict]:
+        """Get the entries for all pairs, like gmaps.call_distance_matrix_api().
+
+        The travel time of a route includes the straight lines from the origin to
+        its nearest node and from the destination's nearest node to it.
+        """
+        pairs = np.argwhere(np.ones((len(origins), len(destinations)), dtype=bool))
+        return self.get_route_matrix_pairs(origins, destinations, pairs, travel_mode)
+
+    def get_route_matrix_pairs(
+        self,
+        origins: list[Location],
+        destinations: list[Location],
+        pairs: np.ndarray,
+        travel_mode: TravelMode = TravelMode.DRIVE,
+    ) -> list[dict]:
+        """Like get_route_matrix(), but only for (origin, destination) index pairs.
+
+        Every node is searched from once, until the nodes it's paired with are
+        settled, so nearby pairs only explore their neighborhood.
+        """
+        csr, reverse_csr = self.get_csr(travel_mode)
+        access_speed = SPEED_PROFILES[travel_mode].access_speed_kmh / 3.6
+        origin_nodes, origin_meters = self.get_nearest_nodes(origins, travel_mode)
+        destination_nodes, destination_meters = self.get_nearest_nodes(
+            destinations, travel_mode
+        )
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2).tolist()
+
+        node_pairs = {
+            (int(origin_nodes[i]), int(destination_nodes[j])) for i, j in pairs
+        }
+        node_pairs = {(a, b) for a, b in node_pairs if a >= 0 and b >= 0}
+        targets_by_source: dict[int, set[int]] = {}
+        sources_by_target: dict[int, set[int]] = {}
+        for a, b in node_pairs:
+            targets_by_source.setdefault(a, set()).add(b)
+            sources_by_target.setdefault(b, set()).add(a)
+
+        # Searching from the smaller side is faster, and gives the same paths.
+        if len(targets_by_source) <= len(sources_by_target):
+            paths = {
+                source: csr.dijkstra(source, targets)
+                for source, targets in targets_by_source.items()
+            }
+
+            def get_path(a: int, b: int) -> Union[tuple[float, float], None]:
+                return paths[a].get(b)
+
+        else:
+            paths = {
+                target: reverse_csr.dijkstra(target, sources)
+                for target, sources in sources_by_target.items()
+            }
+
+            def get_path(a: int, b: int) -> Union[tuple[float, float], None]:
+                return paths[b].get(a)
+
+        entries = []
+        for i, j in pairs:
+            entry = {"originIndex": i, "destinationIndex": j, "status": {}}
+            a, b = int(origin_nodes[i]), int(destination_nodes[j])
+            path = get_path(a, b) if a >= 0 and b >= 0 else None
+
+            if path is None:
+                entry["condition"] = "ROUTE_NOT_FOUND"
+                entries.append(entry)
+                continue
+
+            seconds, meters = path
+            access_meters = float(origin_meters[i] + destination_meters[j])
+            if a == b:
+                # Don't go to the node and back
+                origin, destination = origins[i], destinations[j]
+                access_meters = float(
+                    haversine_distance(
+                        origin.lat, origin.lng, destination.lat, destination.lng
+                    )
+                )
+            entry["distanceMeters"] = round(meters + access_meters)
+            entry["duration"] = f"{round(seconds + access_meters / access_speed)}s"
+            entry["condition"] = "ROUTE_EXISTS"
+            entries.append(entry)
+
+        return entries
@@ -1,6 +1,7 @@
 import math
+from typing import Iterator, Union
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 import numpy as np
 
 
@@ -62,59 +63,243 @@ def get_mercator_scale_factor(lat: float):
     return 1 / math.cos(deg_to_rad(lat))
 
 
+# Earth's mean radius, in meters
+EARTH_RADIUS_METERS = 6371.0 * 1000
+
+
 def spherical_distance(location1: Location, location2: Location) -> float:
     # https://en.wikipedia.org/wiki/Haversine_formula
-    # Convert latitude and longitude from degrees to radians
-    lat1, lng1, lat2, lng2 = np.radians(
-        [location1.lat, location1.lng, location2.lat, location2.lng]
+    lat1, lng1 = math.radians(location1.lat), math.radians(location1.lng)
+    lat2, lng2 = math.radians(location2.lat), math.radians(location2.lng)
+
+    dlng = lng2 - lng1
+    dlat = lat2 - lat1
+    a = (
+        math.sin(dlat / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin(dlng / 2) ** 2
     )
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return EARTH_RADIUS_METERS * c
+
 
-    # Radius of the Earth in meters
-    radius = 6371.0 * 1000  # Earth's mean radius
+def haversine_distance(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """Vectorized spherical_distance(), in meters. The arguments are broadcast."""
+    lat1, lng1, lat2, lng2 = (np.radians(x) for x in (lat1, lng1, lat2, lng2))
 
-    # Haversine formula
     dlng = lng2 - lng1
     dlat = lat2 - lat1
     a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
     c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-    distance = radius * c
+    return EARTH_RADIUS_METERS * c
+
+
+class LocationArray:
+    def __init__(self, lat, lng):
+        """Many locations stored as two arrays, for vectorized geometry.
+
+        Args:
+            lat: Latitudes, in degrees.
+            lng: Longitudes, in degrees. Must have the same length as `lat`.
+        """
+        self.lat = np.asarray(lat, dtype=np.float64).reshape(-1)
+        self.lng = np.asarray(lng, dtype=np.float64).reshape(-1)
+        if self.lat.shape != self.lng.shape:
+            raise ValueError(
+                f"Got {len(self.lat)} latitudes but {len(self.lng)} longitudes."
+            )
+
+    @staticmethod
+    def from_locations(locations: list[Location]) -> "LocationArray":
+        return LocationArray([x.lat for x in locations], [x.lng for x in locations])
+
+    @staticmethod
+    def meshgrid(lat_values, lng_values) -> "LocationArray":
+        """All combinations of the given values, row by row (one row per lat)."""
+        lat, lng = np.meshgrid(lat_values, lng_values, indexing="ij")
+        return LocationArray(lat, lng)
 
-    return distance
+    def to_locations(self) -> list[Location]:
+        return [
+            Location(lat=lat, lng=lng)
+            for lat, lng in zip(self.lat.tolist(), self.lng.tolist())
+        ]
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    def __getitem__(self, index) -> Union[Location, "LocationArray"]:
+        if isinstance(index, (int, np.integer)):
+            return Location(lat=float(self.lat[index]), lng=float(self.lng[index]))
+        return LocationArray(self.lat[index], self.lng[index])
+
+    def __iter__(self) -> Iterator[Location]:
+        return iter(self.to_locations())
+
+    def __repr__(self) -> str:
+        return f"<LocationArray of {len(self)} locations>"
+
+    def to_normalized(self, center: Location, max_offset_lng: float) -> np.ndarray:
+        """Project onto a Mercator map around `center`, normalized to [0, 1].
+
+        Matches the scalar projection with get_mercator_scale_factor() up to
+        floating-point rounding, about 1e-12 relative, not bit-for-bit.
+
+        Args:
+            center: The center of the map, which maps to (0.5, 0.5).
+            max_offset_lng: Half of the width of the map, in degrees of longitude.
+
+        Returns:
+            An array of shape (N, 2) of (x, y), with y pointing south.
+        """
+        # Dividing by the Mercator scale factor, see get_mercator_scale_factor()
+        max_offset_lat = max_offset_lng * np.cos(np.radians(self.lat))
+
+        x = (self.lng - center.lng + max_offset_lng) / (2 * max_offset_lng)
+        y = (-self.lat + center.lat + max_offset_lat) / (2 * max_offset_lat)
+        return np.stack([x, y], axis=1)
+
+    def distances_to(self, other: "LocationArray") -> np.ndarray:
+        """Element-wise spherical distances to `other`, in meters."""
+        return haversine_distance(self.lat, self.lng, other.lat, other.lng)
+
+    def distance_matrix(self, other: Union["LocationArray", None] = None) -> np.ndarray:
+        """All-pairs spherical distances in meters, of shape (len(self), len(other)).
+
+        Args:
+            other: The destinations. Defaults to the locations themselves.
+        """
+        if other is None:
+            other = self
+        return haversine_distance(
+            self.lat[:, None], self.lng[:, None], other.lat[None, :], other.lng[None, :]
+        )
+
+    def segment_lengths(self) -> np.ndarray:
+        """Spherical distances between consecutive locations, in meters."""
+        return haversine_distance(
+            self.lat[:-1], self.lng[:-1], self.lat[1:], self.lng[1:]
+        )
+
+
+def find_pairs_within_radius(points: np.ndarray, radius: float) -> np.ndarray:
+    """Find all pairs of points closer than `radius` to each other.
+
+    Uses a uniform grid of buckets of size `radius`, so that each point is only
+    compared with points in its own and the neighboring buckets. This is roughly
+    O(N * neighbors) instead of O(N^2).
+
+    Args:
+        points: An array of shape (N, 2).
+        radius: The maximum Euclidean distance, exclusive.
+
+    Returns:
+        An array of shape (M, 2) of index pairs (i, j) with i < j, sorted.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    buckets: dict[tuple[int, int], list[int]] = {}
+    for i, cell in enumerate(np.floor(points / radius).astype(np.int64).tolist()):
+        buckets.setdefault(tuple(cell), []).append(i)
+    buckets_arrays = {cell: np.array(ix) for cell, ix in buckets.items()}
+
+    # Compare each bucket with itself and half of its neighbors, so that every
+    # pair of buckets is only visited once.
+    offsets = [(1, -1), (1, 0), (1, 1), (0, 1)]
+
+    pairs = []
+    for (cx, cy), a in buckets_arrays.items():
+        candidates = [(a, a)] + [
+            (a, buckets_arrays[(cx + dx, cy + dy)])
+            for dx, dy in offsets
+            if (cx + dx, cy + dy) in buckets_arrays
+        ]
+        for a_ix, b_ix in candidates:
+            diff = points[a_ix, None, :] - points[None, b_ix, :]
+            close = np.hypot(diff[..., 0], diff[..., 1]) < radius
+            i, j = np.nonzero(close)
+            i, j = a_ix[i], b_ix[j]
+            pairs.append(np.stack([np.minimum(i, j), np.maximum(i, j)], axis=1))
+
+    pairs = np.concatenate(pairs)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    # Pairs within the same bucket were found twice
+    return np.unique(pairs, axis=0)
 
 
 class Polyline(BaseModel):
     points: list[Location]
 
+    # Lazily computed by get_point_array() and get_cumulative_lengths(). The points
+    # are assumed not to be modified after the first query.
+    _point_array: Union["LocationArray", None] = PrivateAttr(default=None)
+    _cumulative_lengths: Union[np.ndarray, None] = PrivateAttr(default=None)
+
+    def get_point_array(self) -> "LocationArray":
+        if self._point_array is None:
+            self._point_array = LocationArray.from_locations(self.points)
+        return self._point_array
+
+    def get_cumulative_lengths(self) -> np.ndarray:
+        """The distance in meters from the start to each point, starting with 0."""
+        if self._cumulative_lengths is None:
+            segment_lengths = self.get_point_array().segment_lengths()
+            self._cumulative_lengths = np.concatenate(
+                [[0.0], np.cumsum(segment_lengths)]
+            )
+        return self._cumulative_lengths
+
     def total_length(self) -> float:
-        total = 0
-        for i in range(len(self.points) - 1):
-            total += spherical_distance(self.points[i], self.points[i + 1])
-        return total
+        return float(self.get_cumulative_lengths()[-1])
 
     def get_point_at_fraction(self, fraction: float) -> Location:
         """
         Args:
             fraction: How far along the polyline, from 0 to 1
         """
-        assert 0 <= fraction <= 1
-        total_length = self.total_length()
-        target_length = fraction * total_length
-        current_length = 0
-        for i in range(len(self.points) - 1):
-            segment_length = spherical_distance(self.points[i], self.points[i + 1])
-            if current_length + segment_length >= target_length:
-                remaining_length = target_length - current_length
-                fraction_along_segment = remaining_length / segment_length
-                return Location(
-                    lat=self.points[i].lat
-                    + fraction_along_segment
-                    * (self.points[i + 1].lat - self.points[i].lat),
-                    lng=self.points[i].lng
-                    + fraction_along_segment
-                    * (self.points[i + 1].lng - self.points[i].lng),
-                )
-            current_length += segment_length
-        return self.points[-1]
+        return self.get_points_at_fractions([fraction])[0]
+
+    def get_points_at_fractions(self, fractions) -> LocationArray:
+        """Batched get_point_at_fraction(), O(log n) per point.
+
+        Args:
+            fractions: An array of how far along the polyline, each from 0 to 1
+        """
+        fractions = np.asarray(fractions, dtype=np.float64).reshape(-1)
+        if np.any((fractions < 0) | (fractions > 1)):
+            raise ValueError("The fractions must be between 0 and 1.")
+
+        points = self.get_point_array()
+        if len(points) < 2:
+            return points[np.zeros(len(fractions), dtype=np.int64)]
+
+        cumulative_lengths = self.get_cumulative_lengths()
+        target_lengths = fractions * cumulative_lengths[-1]
+
+        # The first segment whose end is at or after the target length
+        segment = np.searchsorted(cumulative_lengths[1:], target_lengths, side="left")
+        segment = np.minimum(segment, len(points) - 2)
+
+        segment_start = cumulative_lengths[segment]
+        segment_length = cumulative_lengths[segment + 1] - segment_start
+        fraction_along_segment = np.divide(
+            target_lengths - segment_start,
+            segment_length,
+            out=np.zeros_like(target_lengths),
+            where=segment_length > 0,
+        )
+
+        a, b = points[segment], points[segment + 1]
+        return LocationArray(
+            a.lat + fraction_along_segment * (b.lat - a.lat),
+            a.lng + fraction_along_segment * (b.lng - a.lng),
+        )
+
+    def resample(self, n_points: int) -> "Polyline":
+        """Get `n_points` points evenly spaced along the polyline, by distance."""
+        fractions = np.linspace(0, 1, n_points)
+        return Polyline(points=self.get_points_at_fractions(fractions).to_locations())
 
     @staticmethod
     def from_route_response(route_response: dict) -> "Polyline":
@@ -0,0 +1,266 @@
+"""Static maps larger than the 640px limit of the Static Maps API.
+
+A mosaic is stitched from several static maps (tiles) whose centers are placed
+exactly one tile apart in Web Mercator pixel space, so the result looks like a
+single static map of `size_pixels` around the center. That means a Grid with the
+same `size_pixels` normalizes locations onto the mosaic the same way as onto a
+single image, see Grid.location_to_normalized and STATIC_MAP_SIZE_COEF.
+
+Every tile goes through the static map cache, and the tiles are fetched
+concurrently. Stitching needs Pillow.
+"""
+
+import asyncio
+import math
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Union
+
+from . import gmaps
+from .location import Location
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# The Static Maps API limit
+MAX_TILE_SIZE_PIXELS = 640
+# Cropped from every side of a tile, so that the Google logo and the copyright
+# notice don't repeat at every seam. The full mosaic still has them at its edges.
+TILE_MARGIN_PIXELS = 32
+MAX_MOSAIC_SIZE_PIXELS = 4096
+MAX_CONCURRENT_TILES = 8
+# Markers this far outside of a tile are still drawn on it, so that the part of
+# the icon that sticks into the tile is there too.
+MARKER_MARGIN_PIXELS = 64
+# The width of the whole world at zoom 0
+WORLD_SIZE_PIXELS = 256
+
+
+@dataclass
+class MosaicTile:
+    """One static map request of a mosaic.
+
+    `x` and `y` are where the top left corner of the cropped tile goes in the
+    mosaic, in pixels at scale 1.
+    """
+
+    center: Location
+    x: int
+    y: int
+    size_pixels: int
+    margin_pixels: int
+    markers: list[Location]
+
+
+def location_to_world_pixels(location: Location, zoom: int) -> tuple[float, float]:
+    """Project a location to Web Mercator pixel coordinates at the given zoom."""
+    world_size = WORLD_SIZE_PIXELS * 2**zoom
+    sin_lat = math.sin(math.radians(location.lat))
+    x = (location.lng + 180) / 360 * world_size
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * world_size
+    return x, y
+
+
+def world_pixels_to_location(x: float, y: float, zoom: int) -> Location:
+    """The inverse of location_to_world_pixels(), wrapping around in longitude."""
+    world_size = WORLD_SIZE_PIXELS * 2**zoom
+    lng = (x / world_size * 360) % 360 - 180
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / world_size))))
+    return Location(lat=lat, lng=lng)
+
+
+def plan_mosaic_tiles(
+    center: Location,
+    zoom: int,
+    size_pixels: int,
+    markers: Union[list[Location], None] = None,
+    tile_size_pixels: int = MAX_TILE_SIZE_PIXELS,
+    margin_pixels: int = TILE_MARGIN_PIXELS,
+) -> list[MosaicTile]:
+    """Split a square static map into tiles, row by row.
+
+    A map that fits into a single tile is a single uncropped tile.
+
+    Args:
+        center: The center of the whole mosaic.
+        zoom: The zoom level of all the tiles.
+        size_pixels: The width and height of the mosaic, in pixels at scale 1.
+        markers: Locations to mark. Each tile only gets the nearby ones.
+        tile_size_pixels: The size of the requested tiles.
+        margin_pixels: How much to crop from every side of a tile.
+    """
+    if not 0 < size_pixels <= MAX_MOSAIC_SIZE_PIXELS:
+        raise ValueError(f"Size must be between 1 and {MAX_MOSAIC_SIZE_PIXELS}")
+    if markers is None:
+        markers = []
+
+    if size_pixels <= tile_size_pixels:
+        return [MosaicTile(center, 0, 0, size_pixels, 0, markers)]
+
+    step = tile_size_pixels - 2 * margin_pixels
+    n_tiles = math.ceil(size_pixels / step)
+
+    center_x, center_y = location_to_world_pixels(center, zoom)
+    left, top = center_x - size_pixels / 2, center_y - size_pixels / 2
+    marker_pixels = [location_to_world_pixels(x, zoom) for x in markers]
+
+    def is_near(world_x: float, world_y: float, x: int, y: int) -> bool:
+        dx, dy = world_x - left - x, world_y - top - y
+        lo, hi = -MARKER_MARGIN_PIXELS, step + MARKER_MARGIN_PIXELS
+        return lo <= dx < hi and lo <= dy < hi
+
+    tiles = []
+    for row in range(n_tiles):
+        for col in range(n_tiles):
+            x, y = col * step, row * step
+            tiles.append(
+                MosaicTile(
+                    center=world_pixels_to_location(
+                        left + x + step / 2, top + y + step / 2, zoom
+                    ),
+                    x=x,
+                    y=y,
+                    size_pixels=tile_size_pixels,
+                    margin_pixels=margin_pixels,
+                    markers=[
+                        marker
+                        for marker, (world_x, world_y) in zip(markers, marker_pixels)
+                        if is_near(world_x, world_y, x, y)
+                    ],
+                )
+            )
+    return tiles
+
+
+def stitch_tiles(
+    tiles: list[MosaicTile], images: list[bytes], size_pixels: int, scale: int
+) -> bytes:
+    """Crop the tile images and paste them into a single PNG image."""
+    if Image is None:
+        raise ImportError("Install the Pillow package to stitch static map mosaics")
+
+    size = size_pixels * scale
+    mosaic = Image.new("RGB", (size, size))
+    for tile, image_bytes in zip(tiles, images):
+        with Image.open(BytesIO(image_bytes)) as image:
+            margin = tile.margin_pixels * scale
+            tile_size = tile.size_pixels * scale
+            cropped = image.convert("RGB").crop(
+                (margin, margin, tile_size - margin, tile_size - margin)
+            )
+        # Tiles on the right and bottom edges stick out of the mosaic, and paste()
+        # clips them.
+        mosaic.paste(cropped, (tile.x * scale, tile.y * scale))
+
+    output = BytesIO()
+    mosaic.save(output, format="PNG")
+    return output.getvalue()
+
+
+def get_mosaic_cache_key(
+    center: Location,
+    zoom: int,
+    markers: Union[list[Location], None],
+    size_pixels: int,
+    scale: int,
+) -> str:
+    params = gmaps.get_static_map_params(
+        center, zoom, markers, size_pixels=MAX_TILE_SIZE_PIXELS, scale=scale
+    )
+    params["size"] = f"{size_pixels}x{size_pixels}"
+    params["tiles"] = f"{MAX_TILE_SIZE_PIXELS}-{TILE_MARGIN_PIXELS}"
+    return gmaps.get_static_map_cache_key(params)
+
+
+def get_mosaic_with_digest(
+    center: Location,
+    zoom: int,
+    markers: Union[list[Location], None] = None,
+    size_pixels: int = 1280,
+    scale: int = 2,
+    max_concurrency: int = MAX_CONCURRENT_TILES,
+) -> tuple[bytes, str]:
+    """Get a static map of any size up to MAX_MOSAIC_SIZE_PIXELS and its digest.
+
+    Maps that fit the API limit are plain static maps. Larger ones are stitched
+    from tiles fetched in parallel, and the result is cached like a static map.
+    """
+    tiles = plan_mosaic_tiles(center, zoom, size_pixels, markers)
+    if len(tiles) == 1:
+        return gmaps.get_static_map_with_digest(
+            center, zoom, markers, size_pixels, scale
+        )
+
+    cache_key = get_mosaic_cache_key(center, zoom, markers, size_pixels, scale)
+
+    def fetch_tile(tile: MosaicTile) -> bytes:
+        return gmaps.get_static_map(
+            tile.center, zoom, tile.markers, tile.size_pixels, scale
+        )
+
+    def fetch() -> tuple[bytes, str]:
+        cached = gmaps.load_cached_static_map(cache_key)
+        if cached is not None:
+            return cached
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            images = list(executor.map(fetch_tile, tiles))
+        image = stitch_tiles(tiles, images, size_pixels, scale)
+        return image, gmaps.store_static_map(cache_key, image)
+
+    return gmaps.single_flight.do(cache_key, fetch)
+
+
+def get_mosaic(
+    center: Location,
+    zoom: int,
+    markers: Union[list[Location], None] = None,
+    size_pixels: int = 1280,
+    scale: int = 2,
+) -> bytes:
+    image, _ = get_mosaic_with_digest(center, zoom, markers, size_pixels, scale)
+    return image
+
+
+async def get_mosaic_with_digest_async(
+    center: Location,
+    zoom: int,
+    markers: Union[list[Location], None] = None,
+    size_pixels: int = 1280,
+    scale: int = 2,
+    max_concurrency: int = MAX_CONCURRENT_TILES,
+) -> tuple[bytes, str]:
+    """The asyncio version of get_mosaic_with_digest(), for the API server."""
+    # Only the API server needs httpx, not the export CLI
+    from . import gmaps_async
+
+    tiles = plan_mosaic_tiles(center, zoom, size_pixels, markers)
+    if len(tiles) == 1:
+        return await gmaps_async.get_static_map_with_digest(
+            center, zoom, markers, size_pixels, scale
+        )
+
+    cache_key = get_mosaic_cache_key(center, zoom, markers, size_pixels, scale)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch_tile(tile: MosaicTile) -> bytes:
+        async with semaphore:
+            return await gmaps_async.get_static_map(
+                tile.center, zoom, tile.markers, tile.size_pixels, scale
+            )
+
+    async def fetch() -> tuple[bytes, str]:
+        cached = await asyncio.to_thread(gmaps.load_cached_static_map, cache_key)
+        if cached is not None:
+            return cached
+
+        images = await asyncio.gather(*(fetch_tile(tile) for tile in tiles))
+        # Decoding and encoding the images takes a while, keep the event loop free.
+        image = await asyncio.to_thread(stitch_tiles, tiles, images, size_pixels, scale)
+        digest = await asyncio.to_thread(gmaps.store_static_map, cache_key, image)
+        return image, digest
+
+    return await gmaps.single_flight.do_async(cache_key, fetch)
@@ -0,0 +1,336 @@
+"""Quadtree grids, with more locations where travel times are irregular.
+
+A uniform Grid spends as many locations on parks and water as on a dense
+downtown. A quadtree grid starts as a coarse lattice and keeps splitting the
+cells whose pace, the travel time per meter along their edges, varies the most,
+until it has `max_points` locations.
+
+The locations lie on the lattice of a uniform grid with 2**max_depth + 1 rows,
+so they have grid_x and grid_y like the locations of that grid. The lattice
+isn't full though, so the Grid comes with the triangles of its mesh.
+
+Neighboring cells differ by at most one level (the quadtree is 2:1 balanced),
+so a cell has at most one extra point in the middle of each edge, where the
+neighbor is split. These points are part of the triangles of the cell, so the
+mesh has no cracks.
+"""
+
+import logging
+from typing import Union
+
+import numpy as np
+
+from backend.gmaps import (
+    TravelMode,
+    confirm_if_expensive_from_n,
+    get_sparsified_distance_matrix,
+)
+from backend.grid import (
+    Grid,
+    RouteMatrixEntry,
+    get_map_dimensions,
+    linspace,
+    parse_duration,
+)
+from backend.location import Location, LocationArray
+
+# As many locations as the default 19x19 grid
+DEFAULT_MAX_POINTS = 361
+# 5x5 locations
+INITIAL_DEPTH = 2
+# A 65x65 lattice
+MAX_DEPTH = 6
+# How many cells to split between two rounds of Routes API queries
+SPLITS_PER_ROUND = 16
+# Cells whose pace varies less than this, as a coefficient of variation, are
+# good enough and never split
+MIN_PACE_VARIATION = 0.02
+
+logger = logging.getLogger(__name__)
+
+# (depth, column, row)
+Cell = tuple[int, int, int]
+
+
+class Quadtree:
+    def __init__(self, max_depth: int = MAX_DEPTH, initial_depth: int = INITIAL_DEPTH):
+        """The leaf cells of a quadtree over a square and their corner points.
+
+        Cells are (depth, column, row). Points are (x, y) on the lattice of the
+        cells at `max_depth`. They are numbered in the order they were added, so
+        splitting cells doesn't renumber the existing points.
+
+        Args:
+            max_depth: How many times the square can be split.
+            initial_depth: The depth of all the cells to begin with.
+        """
+        if not 0 <= initial_depth <= max_depth:
+            raise ValueError("The initial depth must be between 0 and max_depth.")
+
+        self.max_depth = max_depth
+        self.leaves: set[Cell] = set()
+        self.points: dict[tuple[int, int], int] = {}
+
+        n = 2**initial_depth
+        for row in range(n):
+            for column in range(n):
+                self._add_leaf((initial_depth, column, row))
+
+    def copy(self) -> "Quadtree":
+        res = Quadtree.__new__(Quadtree)
+        res.max_depth = self.max_depth
+        res.leaves = set(self.leaves)
+        res.points = dict(self.points)
+        return res
+
+    def get_lattice_size(self) -> int:
+        return 2**self.max_depth + 1
+
+    def get_corners(self, cell: Cell) -> list[tuple[int, int]]:
+        """The corners of a cell on the lattice, counterclockwise from the lowest."""
+        depth, column, row = cell
+        step = 2 ** (self.max_depth - depth)
+        x, y = column * step, row * step
+        return [(x, y), (x + step, y), (x + step, y + step), (x, y + step)]
+
+    def _add_leaf(self, cell: Cell) -> None:
+        self.leaves.add(cell)
+        for point in self.get_corners(cell):
+            self.points.setdefault(point, len(self.points))
+
+    def _get_coarser_leaf(self, depth: int, column: int, row: int) -> Union[Cell, None]:
+        """The leaf that covers the cell (depth, column, row), if it's larger."""
+        if not (0 <= column < 2**depth and 0 <= row < 2**depth):
+            return None
+        for ancestor_depth in range(depth - 1, -1, -1):
+            shift = depth - ancestor_depth
+            ancestor = (ancestor_depth, column >> shift, row >> shift)
+            if ancestor in self.leaves:
+                return ancestor
+        return None
+
+    def split(self, cell: Cell) -> None:
+        """Split a leaf into four. Coarser neighbors are split first, for balance."""
+        if cell not in self.leaves:
+            raise ValueError(f"{cell} is not a leaf.")
+        depth, column, row = cell
+        if depth >= self.max_depth:
+            raise ValueError(f"{cell} is already at the maximum depth.")
+
+        for neighbor_column, neighbor_row in [
+            (column - 1, row),
+            (column + 1, row),
+            (column, row - 1),
+            (column, row + 1),
+        ]:
+            while True:
+                coarser = self._get_coarser_leaf(depth, neighbor_column, neighbor_row)
+                if coarser is None:
+                    break
+                self.split(coarser)
+
+        self.leaves.remove(cell)
+        for child_row in (2 * row, 2 * row + 1):
+            for child_column in (2 * column, 2 * column + 1):
+                self._add_leaf((depth + 1, child_column, child_row))
+
+    def get_cell_triangles(self) -> dict[Cell, list[tuple[int, int, int]]]:
+        """Triangulate every leaf, including the points in the middle of its edges.
+
+        A leaf without such points is split along a diagonal. Otherwise, its
+        triangles fan out from one of the middle points, which never gives a
+        degenerate triangle.
+        """
+        res = {}
+        for cell in sorted(self.leaves):
+            corners = self.get_corners(cell)
+            polygon = []
+            for a, b in zip(corners, corners[1:] + corners[:1]):
+                polygon.append(a)
+                # At the maximum depth, neighbors are never finer
+                if cell[0] < self.max_depth:
+                    middle = ((a[0] + b[0]) // 2, (a[1] + b[1]) // 2)
+                    if middle in self.points:
+                        polygon.append(middle)
+
+            if len(polygon) > 4:
+                start = next(i for i, x in enumerate(polygon) if x not in corners)
+                polygon = polygon[start:] + polygon[:start]
+
+            indices = [self.points[x] for x in polygon]
+            res[cell] = [
+                (indices[0], indices[i], indices[i + 1])
+                for i in range(1, len(indices) - 1)
+            ]
+        return res
+
+    def get_triangles(self) -> list[tuple[int, int, int]]:
+        return [
+            x for triangles in self.get_cell_triangles().values() for x in triangles
+        ]
+
+    def to_grid(
+        self,
+        center: Location,
+        zoom: int,
+        snap_to_roads: bool = True,
+        size_pixels: int = 400,
+        travel_mode: TravelMode = TravelMode.DRIVE,
+    ) -> Grid:
+        """Place the points on a map like the locations of a uniform Grid."""
+        size = self.get_lattice_size()
+        lat_offset, lng_offset = get_map_dimensions(center, zoom, size_pixels)
+        lat_values = linspace(
+            center.lat - lat_offset / 2, center.lat + lat_offset / 2, size
+        )
+        lng_values = linspace(
+            center.lng - lng_offset / 2, center.lng + lng_offset / 2, size
+        )
+
+        # The points are in the order of their indices
+        grid_xy = np.array(list(self.points), dtype=np.int64).reshape(-1, 2)
+        grid_x, grid_y = grid_xy[:, 0], grid_xy[:, 1]
+        return Grid.from_locations(
+            center,
+            zoom,
+            size,
+            LocationArray(lat_values[grid_y], lng_values[grid_x]),
+            grid_x,
+            grid_y,
+            triangles=self.get_triangles(),
+            snap_to_roads=snap_to_roads,
+            size_pixels=size_pixels,
+            travel_mode=travel_mode,
+        )
+
+
+def get_paces(
+    durations: dict[tuple[int, int], int], snapped: LocationArray
+) -> dict[tuple[int, int], float]:
+    """The travel time per meter of spherical distance, for pairs of locations."""
+    pairs = np.array(list(durations), dtype=np.int64).reshape(-1, 2)
+    distances = snapped[pairs[:, 0]].distances_to(snapped[pairs[:, 1]])
+    return {
+        pair: duration / distance
+        for (pair, duration), distance in zip(durations.items(), distances.tolist())
+        if distance > 0
+    }
+
+
+def get_pace_variation(paces: list[float]) -> float:
+    """The coefficient of variation of the paces along the edges of a cell."""
+    if len(paces) < 2 or np.mean(paces) == 0:
+        return 0.0
+    return float(np.std(paces) / np.mean(paces))
+
+
+def make_quadtree_grid(
+    center: Location,
+    zoom: int,
+    max_points: int = DEFAULT_MAX_POINTS,
+    snap_to_roads: bool = True,
+    size_pixels: int = 400,
+    travel_mode: TravelMode = TravelMode.DRIVE,
+    max_depth: int = MAX_DEPTH,
+    initial_depth: int = INITIAL_DEPTH,
+    splits_per_round: int = SPLITS_PER_ROUND,
+) -> Grid:
+    """Make a grid with more locations where the pace varies, see the module docs.
+
+    In every round, the travel times along the new edges of the mesh are
+    queried, and then the cells whose pace varies the most, weighted by their
+    size, are split. This goes on until the next split would exceed
+    `max_points` or no cell varies by more than MIN_PACE_VARIATION.
+
+    The route matrix of the grid has the travel times along all the edges that
+    were ever in the mesh. The grid can be used as it is, or e.g. with
+    Grid.compute_adaptive_distance_matrix(), which starts from the mesh edges.
+
+    Args:
+        center: The center of the grid.
+        zoom: The zoom level of the grid.
+        max_points: The maximum number of locations.
+        max_depth: How many times the map can be split in four.
+        initial_depth: The depth of the cells of the coarse starting lattice.
+        splits_per_round: How many cells to split at most between queries.
+    """
+    quadtree = Quadtree(max_depth, initial_depth)
+    if len(quadtree.points) > max_points:
+        raise ValueError(
+            f"The initial lattice already has {len(quadtree.points)} locations."
+        )
+    # A mesh of N points has fewer than 3N edges, and the split cells had about
+    # one more edge per point inside them. Confirm the cost once, not every round.
+    confirm_if_expensive_from_n(4 * max_points)
+
+    route_matrix: list[RouteMatrixEntry] = []
+    queried: set[tuple[int, int]] = set()
+    durations: dict[tuple[int, int], int] = {}
+    n_rounds = 0
+
+    while True:
+        grid = quadtree.to_grid(center, zoom, snap_to_roads, size_pixels, travel_mode)
+        snapped = grid.get_snapped_locations()
+        # Pairs that snapped to the same point have no pace and aren't edges
+        edges = set(map(tuple, grid.get_backbone_pairs().tolist()))
+        new_pairs = sorted(edges - queried)
+        if new_pairs:
+            queried.update(new_pairs)
+            for entry in get_sparsified_distance_matrix(
+                snapped,
+                snapped,
+                pairs=np.array(new_pairs, dtype=np.int64),
+                travel_mode=travel_mode,
+                confirm=False,
+            ):
+                if entry["condition"] != "ROUTE_EXISTS":
+                    continue
+                route_matrix.append(entry)
+                i, j = sorted((entry["originIndex"], entry["destinationIndex"]))
+                durations[i, j] = parse_duration(entry["duration"])
+        n_rounds += 1
+
+        paces = get_paces(durations, grid.get_snapped_location_array())
+        scores = {}
+        for cell, triangles in quadtree.get_cell_triangles().items():
+            cell_edges = {
+                (min(a, b), max(a, b))
+                for triangle in triangles
+                for a, b in zip(triangle, triangle[1:] + triangle[:1])
+            } & edges
+            # Edges without a route likely go into the water, where more
+            # locations would be wasted.
+            if cell[0] >= max_depth or not cell_edges <= paces.keys():
+                continue
+            variation = get_pace_variation([paces[x] for x in sorted(cell_edges)])
+            if variation > MIN_PACE_VARIATION:
+                # A large cell with the same variation hides more detail
+                scores[cell] = variation * 2.0 ** -cell[0]
+
+        n_splits = 0
+        for cell in sorted(scores, key=lambda x: -scores[x]):
+            if n_splits == splits_per_round:
+                break
+            # Splitting a neighbor for balance may have split this one already
+            if cell not in quadtree.leaves:
+                continue
+            split = quadtree.copy()
+            split.split(cell)
+            if len(split.points) > max_points:
+                continue
+            quadtree = split
+            n_splits += 1
+
+        logger.info(
+            f"Round {n_rounds}: {len(grid.locations)} locations, "
+            f"{len(queried)} elements queried, splitting {n_splits} cells."
+        )
+        if n_splits == 0:
+            break
+
+    grid.route_matrix = route_matrix
+    logger.info(
+        f"Quadtree grid has {len(grid.locations)} locations and "
+        f"{len(grid.triangles)} triangles after {n_rounds} rounds."
+    )
+    return grid
@@ -0,0 +1,297 @@
+"""A server-side port of the spring-mesh simulation in frontend/src/springs.ts.
+
+Each grid location is a vertex, connected by an anchor spring to a pinned copy
+of itself and by route springs to the locations it has travel times to. Instead
+of stepping the simulation every frame in the browser, we relax it until it
+converges and return the vertex positions for a set of timeness levels.
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Literal, Union
+
+import numpy as np
+
+from backend.grid import Grid, parse_duration
+from backend.location import LocationArray
+
+# These mirror frontend/src/settings.ts
+USE_RELATIVE_STRENGTH = False
+SPEED_AVERAGING_TYPE: Literal["mean", "median"] = "median"
+QUADRATIC_PENALTY = False
+STRENGTH_MULTIPLIER = 30.0
+
+# The browser steps once per frame
+DEFAULT_DELTA_SECONDS = 1 / 60
+DEFAULT_MAX_ITERATIONS = 10_000
+# In normalized units, i.e. a fraction of the map size
+DEFAULT_TOLERANCE = 1e-7
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Springs:
+    """Springs stored as one array per field, like the Spring type of springs.ts."""
+
+    from_index: np.ndarray
+    to_index: np.ndarray
+    length: np.ndarray
+    strength: np.ndarray
+    is_anchor: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.from_index)
+
+    @staticmethod
+    def concatenate(springs: list["Springs"]) -> "Springs":
+        return Springs(
+            from_index=np.concatenate([x.from_index for x in springs]),
+            to_index=np.concatenate([x.to_index for x in springs]),
+            length=np.concatenate([x.length for x in springs]),
+            strength=np.concatenate([x.strength for x in springs]),
+            is_anchor=np.concatenate([x.is_anchor for x in springs]),
+        )
+
+
+def get_initial_positions(grid: Grid) -> np.ndarray:
+    """The normalized positions of the snapped locations, of shape (N, 2)."""
+    return grid.locations_to_normalized(grid.get_snapped_location_array())
+
+
+def get_anchor_springs(n_locations: int) -> Springs:
+    """Springs that tie vertex i to its pinned copy, vertex i + n_locations."""
+    indices = np.arange(n_locations)
+    return Springs(
+        from_index=indices,
+        to_index=indices + n_locations,
+        length=np.zeros(n_locations),
+        strength=np.ones(n_locations),
+        is_anchor=np.ones(n_locations, dtype=bool),
+    )
+
+
+def route_matrix_to_springs(grid: Grid) -> Springs:
+    """Turn the route matrix of the grid into springs, see routeMatrixToSprings."""
+    n_locations = len(grid.locations)
+    snapped = grid.get_snapped_location_array()
+
+    entries = [
+        entry
+        for entry in grid.route_matrix or []
+        if entry["condition"] == "ROUTE_EXISTS"
+        # Only include each pair once
+        and entry["originIndex"] < entry["destinationIndex"]
+    ]
+    origins = np.array([x["originIndex"] for x in entries], dtype=np.int64)
+    destinations = np.array([x["destinationIndex"] for x in entries], dtype=np.int64)
+
+    # If two locations are snapped to the same point, skip the corresponding spring.
+    a, b = snapped[origins], snapped[destinations]
+    valid = (a.lat != b.lat) | (a.lng != b.lng)
+
+    # For some pairs of locations, the route matrix returns a duration of 0s.
+    # Probably because they resolve into the same location on the road.
+    durations = np.array(
+        [parse_duration(x.get("duration", "0s")) for x in entries], dtype=np.float64
+    )
+    if np.any(valid & (durations == 0)):
+        logger.warning(
+            f"Skipping {np.sum(valid & (durations == 0))} routes with invalid duration."
+        )
+    valid &= durations > 0
+
+    origins, destinations, durations = (
+        origins[valid],
+        destinations[valid],
+        durations[valid],
+    )
+    if len(origins) == 0:
+        raise ValueError("The grid has no valid routes to build springs from.")
+
+    spherical_distances = snapped[origins].distances_to(snapped[destinations])
+    meters_per_second = spherical_distances / durations
+
+    points = get_initial_positions(grid)
+    normalized_distances = np.linalg.norm(
+        points[origins] - points[destinations], axis=1
+    )
+
+    if SPEED_AVERAGING_TYPE == "median":
+        # Not np.median, to pick the same element as the frontend
+        average_speed = np.sort(meters_per_second)[len(meters_per_second) // 2]
+    else:
+        average_speed = np.mean(meters_per_second)
+    logger.info(
+        f"Average speed: {average_speed * 3.6:.1f} km/h "
+        f"(averaged using {SPEED_AVERAGING_TYPE})"
+    )
+
+    if USE_RELATIVE_STRENGTH:
+        strength = STRENGTH_MULTIPLIER / normalized_distances / n_locations
+    else:
+        strength = np.full(len(origins), STRENGTH_MULTIPLIER / n_locations)
+
+    return Springs(
+        from_index=origins,
+        to_index=destinations,
+        # If the speed (aerial m)/(road s) is exactly equal to the average, the
+        # spring is "happy". If the speed is lower, it wants to expand (the length
+        # is larger), and vice versa.
+        length=normalized_distances * average_speed / meters_per_second,
+        strength=strength,
+        is_anchor=np.zeros(len(origins), dtype=bool),
+    )
+
+
+def get_grid_springs(grid: Grid) -> Springs:
+    """All the springs of the grid: anchors first, then the route springs."""
+    return Springs.concatenate(
+        [get_anchor_springs(len(grid.locations)), route_matrix_to_springs(grid)]
+    )
+
+
+def get_force(distance: np.ndarray, length: np.ndarray) -> np.ndarray:
+    delta = distance - length
+    if QUADRATIC_PENALTY:
+        return np.sign(delta) * delta**2
+    return delta
+
+
+def step_springs(
+    positions: np.ndarray,
+    pinned: np.ndarray,
+    springs: Springs,
+    delta_seconds: float,
+    timeness: float,
+    timeness_scale: float,
+) -> tuple[np.ndarray, float]:
+    """One step of the simulation for all springs at once, see stepSprings.
+
+    Args:
+        positions: The vertex positions, of shape (n_vertices, 2).
+        pinned: Which vertices don't move, of shape (n_vertices,).
+        springs: The springs between the vertices.
+        delta_seconds: The time step.
+        timeness: How much the travel times matter, from 0 to 1.
+        timeness_scale: The maxTimeness of the city, scales the route springs.
+
+    Returns:
+        The new positions and the loss, the sum of the squared forces.
+    """
+    diff = positions[springs.to_index] - positions[springs.from_index]
+    distance = np.hypot(diff[:, 0], diff[:, 1])
+
+    force = get_force(distance, springs.length)
+    loss = float(np.sum(force**2))
+
+    # As timeness increases, give anchor springs less weight and give more to the
+    # time constraint ones.
+    anchor_weight = 5 + (1.5 - 5) * timeness
+    force = force * (
+        springs.strength
+        * delta_seconds
+        * np.where(springs.is_anchor, anchor_weight, timeness * timeness_scale)
+    )
+
+    angle = np.arctan2(diff[:, 1], diff[:, 0])
+    dx = np.cos(angle) * force
+    dy = np.sin(angle) * force
+
+    n_vertices = len(positions)
+    delta = np.stack(
+        [
+            np.bincount(springs.from_index, dx, n_vertices)
+            - np.bincount(springs.to_index, dx, n_vertices),
+            np.bincount(springs.from_index, dy, n_vertices)
+            - np.bincount(springs.to_index, dy, n_vertices),
+        ],
+        axis=1,
+    )
+    delta[pinned] = 0
+
+    return positions + delta, loss
+
+
+def solve_springs(
+    positions: np.ndarray,
+    pinned: np.ndarray,
+    springs: Springs,
+    timeness: float,
+    timeness_scale: float,
+    delta_seconds: float = DEFAULT_DELTA_SECONDS,
+    max_iterations: int = DEFAULT_MAX_ITERATIONS,
+    tolerance: float = DEFAULT_TOLERANCE,
+) -> tuple[np.ndarray, float]:
+    """Step the simulation until no vertex moves by more than `tolerance`.
+
+    Returns the final positions and loss.
+    """
+    loss = float("inf")
+    for iteration in range(max_iterations):
+        new_positions, loss = step_springs(
+            positions, pinned, springs, delta_seconds, timeness, timeness_scale
+        )
+        max_step = np.max(np.abs(new_positions - positions), initial=0)
+        positions = new_positions
+        if max_step < tolerance:
+            logger.debug(f"Springs converged after {iteration + 1} iterations.")
+            break
+    else:
+        logger.warning(
+            f"Springs didn't converge after {max_iterations} iterations "
+            f"(timeness={timeness})."
+        )
+    return positions, loss
+
+
+def compute_layouts(
+    grid: Grid,
+    timeness_levels: list[float],
+    timeness_scale: float,
+    delta_seconds: float = DEFAULT_DELTA_SECONDS,
+    max_iterations: int = DEFAULT_MAX_ITERATIONS,
+    tolerance: float = DEFAULT_TOLERANCE,
+) -> dict[str, Union[list, float]]:
+    """Precompute the deformed vertex positions of the grid for each timeness level.
+
+    The levels are solved in increasing order, each starting from the layout of
+    the previous one, which converges much faster than starting from scratch.
+
+    Args:
+        grid: A grid with a route matrix.
+        timeness_levels: Values between 0 and 1, like the timeness slider.
+        timeness_scale: The maxTimeness of the city.
+
+    Returns:
+        A dict with the levels and, for each level, the normalized (x, y)
+        positions of the grid locations, in the order of grid.locations.
+    """
+    springs = get_grid_springs(grid)
+    initial_positions = get_initial_positions(grid)
+    n_locations = len(initial_positions)
+
+    # The vertices n_locations... are the pinned ends of the anchor springs.
+    positions = np.concatenate([initial_positions, initial_positions])
+    pinned = np.arange(2 * n_locations) >= n_locations
+
+    layouts = {}
+    for timeness in sorted(set(timeness_levels)):
+        positions, loss = solve_springs(
+            positions,
+            pinned,
+            springs,
+            timeness,
+            timeness_scale,
+            delta_seconds=delta_seconds,
+            max_iterations=max_iterations,
+            tolerance=tolerance,
+        )
+        layouts[timeness] = (positions[:n_locations].tolist(), loss)
+
+    return {
+        "timeness_levels": list(timeness_levels),
+        "timeness_scale": timeness_scale,
+        "positions": [layouts[x][0] for x in timeness_levels],
+        "losses": [layouts[x][1] for x in timeness_levels],
+    }
@@ -5,36 +5,56 @@ FastAPI server for Google Maps integration and data processing
 """
 
 import os
+import json
 import logging
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from typing import List, Optional
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Path, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 
 from backend.location import Location
+from backend import gmaps_async, mosaic
 from backend.gmaps import (
-    get_distance_matrix, 
-    get_static_map, 
     TravelMode,
     get_cache_stats,
-    clear_expired_cache
+    clear_expired_cache,
+    get_cache,
+    set_routing_provider,
+    get_supported_travel_modes,
 )
-from backend.grid import generate_grid, compute_spacetime_grid
-from backend.cache import FileBasedCache
+from backend.grid import Grid, generate_grid, compute_spacetime_grid_async
+from backend.springs import compute_layouts
+from backend.export import ASSETS_DIR
+from backend.jobs import Job, JobQueue, JobQueueFullError, format_sse
+from backend.local_routing import LocalRouter
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global job_queue
+    job_queue = JobQueue()
+    job_queue.start()
+    yield
+    await job_queue.stop()
+    # Close the connections of the async Maps client
+    await gmaps_async.client.aclose()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Soft Mobility Spacetime Maps API",
     description="Backend API for generating spacetime maps using Google Maps data",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    lifespan=lifespan,
 )
 
 # Configure CORS
@@ -46,8 +66,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize cache
-cache = FileBasedCache()
+# Initialize cache. Set CACHE_BACKEND=sqlite to share one database between workers.
+# It's the same instance the Maps API calls use, created now so that a bad
+# configuration fails at startup.
+get_cache()
+
+# Route offline on a road graph made with scripts/convert_osm_graph.py, if given
+routing_graph = os.getenv("ROUTING_GRAPH")
+if routing_graph:
+    set_routing_provider(LocalRouter.load(routing_graph))
+    logger.info(f"Routing offline on {routing_graph}")
+
+def is_supported_travel_mode(travel_mode: str) -> bool:
+    return travel_mode in [x.value for x in get_supported_travel_modes()]
+
+# How long browsers and proxies may reuse a static map image without revalidating
+STATIC_MAP_MAX_AGE = 24 * 3600
+
+# Runs long spacetime grid generations in the background, created on startup
+job_queue: Optional[JobQueue] = None
 
 # Pydantic models
 class LocationRequest(BaseModel):
@@ -69,6 +106,7 @@ class StaticMapRequest(BaseModel):
     center: LocationRequest
     zoom: int = 13
     size_pixels: int = 400
+    scale: int = 2
     markers: Optional[List[LocationRequest]] = None
 
 # API Routes
@@ -89,15 +127,24 @@ async def health_check():
     return {
         "status": "healthy",
         "api_key_configured": bool(api_key),
-        "cache_stats": get_cache_stats()
+        # The cache blocks on locks and disk, keep it off the event loop
+        "cache_stats": await run_in_threadpool(get_cache_stats)
     }
 
 @app.post("/api/distance-matrix")
-async def compute_distance_matrix(request: DistanceMatrixRequest):
+async def compute_distance_matrix(
+    request: DistanceMatrixRequest,
+    stream: bool = Query(
+        False, description="Stream the entries as NDJSON as soon as they arrive"
+    ),
+):
     """Compute travel time matrix between origins and destinations"""
+    if stream:
+        return stream_distance_matrix(request)
+
     try:
         # Validate travel mode
-        if request.travel_mode not in ["WALK", "DRIVE", "TRANSIT"]:
+        if not is_supported_travel_mode(request.travel_mode):
             raise HTTPException(status_code=400, detail="Invalid travel mode")
         
         # Convert to Location objects
@@ -107,8 +154,10 @@ async def compute_distance_matrix(request: DistanceMatrixRequest):
         # Get travel mode enum
         travel_mode = TravelMode(request.travel_mode)
         
-        # Compute distance matrix
-        matrix_entries = list(get_distance_matrix(origins, destinations))
+        # Compute distance matrix, without blocking other requests while waiting
+        matrix_entries = await gmaps_async.get_distance_matrix(
+            origins, destinations, travel_mode=travel_mode
+        )
         
         return {
             "origins": len(origins),
@@ -121,83 +170,265 @@ async def compute_distance_matrix(request: DistanceMatrixRequest):
         logger.error(f"Distance matrix error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def stream_distance_matrix(request: DistanceMatrixRequest) -> StreamingResponse:
+    """Stream the matrix entries as newline-delimited JSON, one entry per line.
+
+    Entries come in the order the API requests finish. If something fails midway,
+    the last line is an object with an "error" key.
+    """
+    if not is_supported_travel_mode(request.travel_mode):
+        raise HTTPException(status_code=400, detail="Invalid travel mode")
+
+    origins = [Location(lat=loc.lat, lng=loc.lng) for loc in request.origins]
+    destinations = [Location(lat=loc.lat, lng=loc.lng) for loc in request.destinations]
+    travel_mode = TravelMode(request.travel_mode)
+
+    async def lines():
+        try:
+            async for entry in gmaps_async.iter_distance_matrix(
+                origins, destinations, travel_mode=travel_mode
+            ):
+                yield json.dumps(entry) + "\n"
+        except Exception as e:
+            logger.error(f"Distance matrix error: {e}")
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no"},
+    )
+
 @app.post("/api/spacetime-grid")
 async def generate_spacetime_grid(request: SpacetimeGridRequest):
     """Generate spacetime grid data for visualization"""
     try:
         # Validate travel mode
-        if request.travel_mode not in ["WALK", "DRIVE", "TRANSIT"]:
+        if not is_supported_travel_mode(request.travel_mode):
             raise HTTPException(status_code=400, detail="Invalid travel mode")
         
-        center = Location(lat=request.center.lat, lng=request.center.lng)
-        travel_mode = TravelMode(request.travel_mode)
-        
-        # Generate grid points
-        grid_points = generate_grid(center, request.radius_km, request.grid_size)
-        
-        # Compute spacetime transformation
-        spacetime_data = compute_spacetime_grid(
-            center, grid_points, travel_mode
-        )
-        
-        return {
-            "center": {"lat": center.lat, "lng": center.lng},
-            "radius_km": request.radius_km,
-            "grid_size": request.grid_size,
-            "travel_mode": request.travel_mode,
-            "grid_data": spacetime_data
-        }
+        return await run_spacetime_grid(request)
         
     except Exception as e:
         logger.error(f"Spacetime grid error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def run_spacetime_grid(request: SpacetimeGridRequest, job: Optional[Job] = None):
+    """Generate the spacetime grid, reporting progress to the job if given"""
+    center = Location(lat=request.center.lat, lng=request.center.lng)
+    travel_mode = TravelMode(request.travel_mode)
+
+    # Generate grid points
+    if job is not None:
+        job.report("generating")
+    grid_points = generate_grid(center, request.radius_km, request.grid_size)
+
+    # Compute spacetime transformation. Jobs fail instead of returning the
+    # grid without travel times.
+    spacetime_data = await compute_spacetime_grid_async(
+        center,
+        grid_points,
+        travel_mode,
+        on_progress=job.report if job else None,
+        fallback=job is None,
+    )
+
+    return {
+        "center": {"lat": center.lat, "lng": center.lng},
+        "radius_km": request.radius_km,
+        "grid_size": request.grid_size,
+        "travel_mode": request.travel_mode,
+        "grid_data": spacetime_data
+    }
+
+@app.post("/api/jobs/spacetime-grid", status_code=202)
+async def submit_spacetime_grid_job(request: SpacetimeGridRequest):
+    """Generate spacetime grid data in the background and return a job id"""
+    if not is_supported_travel_mode(request.travel_mode):
+        raise HTTPException(status_code=400, detail="Invalid travel mode")
+
+    try:
+        job = job_queue.submit(
+            "spacetime-grid", lambda job: run_spacetime_grid(request, job)
+        )
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    return {
+        "job_id": job.id,
+        "status": job.status.value,
+        "status_url": f"/api/jobs/{job.id}",
+        "events_url": f"/api/jobs/{job.id}/events",
+    }
+
+def get_job_or_404(job_id: str) -> Job:
+    job = job_queue.get(job_id) if job_queue is not None else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Get the status of a job, and its result once it's done"""
+    return get_job_or_404(job_id).to_json()
+
+@app.get("/api/jobs/{job_id}/events")
+async def follow_job(job_id: str):
+    """Stream the progress of a job as server-sent events, until it finishes"""
+    job = get_job_or_404(job_id)
+
+    async def stream():
+        async for event in job.follow():
+            yield format_sse(event)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@lru_cache(maxsize=32)
+def get_city_layouts(
+    city: str, timeness_levels: tuple[float, ...], timeness_scale: float
+) -> dict:
+    """Compute the spring layouts of a grid exported by backend/export.py"""
+    with open(ASSETS_DIR / city / "grid_data.json") as f:
+        grid = Grid.from_json(json.load(f))
+    return compute_layouts(grid, list(timeness_levels), timeness_scale)
+
+@app.get("/api/spring-layout/{city}")
+async def get_spring_layout(
+    city: str = Path(
+        ..., pattern=r"^[\w-]+$", description="An exported grid, like newyork_cyclist"
+    ),
+    timeness_levels: List[float] = Query([0.0, 0.25, 0.5, 0.75, 1.0]),
+    timeness_scale: float = Query(0.08, description="The maxTimeness of the city"),
+):
+    """Precompute the deformed grid of a city for a set of timeness levels"""
+    if not all(0 <= x <= 1 for x in timeness_levels):
+        raise HTTPException(
+            status_code=400, detail="Timeness levels must be between 0 and 1"
+        )
+    if not (ASSETS_DIR / city / "grid_data.json").is_file():
+        raise HTTPException(status_code=404, detail=f"Unknown city: {city}")
+    try:
+        # The solver is CPU-bound, don't block the event loop
+        return await run_in_threadpool(
+            get_city_layouts, city, tuple(timeness_levels), timeness_scale
+        )
+    except Exception as e:
+        logger.error(f"Spring layout error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/api/static-map")
-async def get_map_image(request: StaticMapRequest):
+async def get_map_image(request: StaticMapRequest, http_request: Request):
     """Get static map image from Google Maps"""
+    center = Location(lat=request.center.lat, lng=request.center.lng)
+    markers = None
+    if request.markers:
+        markers = [Location(lat=m.lat, lng=m.lng) for m in request.markers]
+
+    return await static_map_response(
+        http_request, center, request.zoom, request.size_pixels, request.scale, markers
+    )
+
+@app.get("/api/static-map")
+async def get_map_image_by_query(
+    http_request: Request,
+    lat: float,
+    lng: float,
+    zoom: int = 13,
+    size_pixels: int = 400,
+    scale: int = 2,
+    markers: Optional[str] = Query(
+        None, description='Marker locations as "lat,lng|lat,lng|..."'
+    ),
+):
+    """Get static map image from Google Maps, cacheable by browsers and proxies"""
+    marker_locations = None
+    if markers:
+        try:
+            marker_locations = [
+                Location(lat=float(lat_s), lng=float(lng_s))
+                for lat_s, lng_s in (m.split(",") for m in markers.split("|"))
+            ]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid markers")
+
+    return await static_map_response(
+        http_request,
+        Location(lat=lat, lng=lng),
+        zoom,
+        size_pixels,
+        scale,
+        marker_locations,
+    )
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header, which can list several (weak) ETags"""
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+async def static_map_response(
+    http_request: Request,
+    center: Location,
+    zoom: int,
+    size_pixels: int,
+    scale: int,
+    markers: Optional[List[Location]],
+) -> Response:
+    """The map image, with an ETag of its content digest for conditional requests.
+
+    Maps larger than 640 pixels are stitched from several static maps.
+    """
     try:
-        center = Location(lat=request.center.lat, lng=request.center.lng)
-        markers = None
-        if request.markers:
-            markers = [Location(lat=m.lat, lng=m.lng) for m in request.markers]
-        
-        image_bytes = get_static_map(
+        image_bytes, digest = await mosaic.get_mosaic_with_digest_async(
             center=center,
-            zoom=request.zoom,
+            zoom=zoom,
             markers=markers,
-            size_pixels=request.size_pixels
+            size_pixels=size_pixels,
+            scale=scale,
         )
-        
-        return JSONResponse(
-            content={"image_size": len(image_bytes)},
-            headers={"Content-Type": "application/json"}
-        )
-        
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Static map error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+    etag = f'"{digest}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={STATIC_MAP_MAX_AGE}",
+    }
+    if etag_matches(http_request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=image_bytes, media_type="image/png", headers=headers)
+
 @app.get("/api/cache/stats")
 async def cache_statistics():
     """Get cache statistics"""
-    return get_cache_stats()
+    return await run_in_threadpool(get_cache_stats)
 
 @app.post("/api/cache/clear")
 async def clear_cache():
     """Clear expired cache entries"""
-    removed = clear_expired_cache()
+    removed = await run_in_threadpool(clear_expired_cache)
     return {"removed_entries": removed}
 
 @app.get("/api/travel-modes")
 async def get_travel_modes():
     """Get available travel modes"""
-    return {
-        "modes": [
-            {"value": "WALK", "label": "Walking", "speed_kmh": 5},
-            {"value": "DRIVE", "label": "Driving", "speed_kmh": 30},
-            {"value": "TRANSIT", "label": "Public Transit", "speed_kmh": 20}
-        ]
-    }
+    modes = [
+        {"value": "WALK", "label": "Walking", "speed_kmh": 5},
+        {"value": "DRIVE", "label": "Driving", "speed_kmh": 30},
+        {"value": "TRANSIT", "label": "Public Transit", "speed_kmh": 20},
+        {"value": "BICYCLE", "label": "Cycling", "speed_kmh": 16},
+        {"value": "RUN", "label": "Running", "speed_kmh": 10},
+    ]
+    # Depends on whether routing is offline, see ROUTING_GRAPH
+    return {"modes": [x for x in modes if is_supported_travel_mode(x["value"])]}
 
 if __name__ == "__main__":
     # Check for API key
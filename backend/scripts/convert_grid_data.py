@@ -0,0 +1,58 @@
+import argparse
+from pathlib import Path
+
+from backend.export import ASSETS_DIR
+from backend.grid_format import COMPRESSIONS, load_grid_data, save_grid_data
+
+
+def convert(input_file: Path, output_file: Path, compression: str):
+    grid_data = load_grid_data(input_file)
+    save_grid_data(grid_data, output_file, compression=compression)
+
+    input_size = input_file.stat().st_size
+    output_size = output_file.stat().st_size
+    print(
+        f"{input_file} ({input_size / 1024:.0f} KiB) -> "
+        f"{output_file} ({output_size / 1024:.0f} KiB)"
+    )
+
+
+def main(input_files: list[Path], to_json: bool, compression: str):
+    if not input_files:
+        # Convert all the existing assets
+        pattern = "grid_data.bin" if to_json else "grid_data.json"
+        input_files = sorted(ASSETS_DIR.glob(f"*/{pattern}"))
+
+    for input_file in input_files:
+        output_file = input_file.with_suffix(".json" if to_json else ".bin")
+        if output_file == input_file:
+            print(f"Skipping {input_file}, it already has the target suffix.")
+            continue
+        convert(input_file, output_file, compression)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert grid_data.json files to the compact binary format "
+        "(grid_data.bin), or back."
+    )
+    parser.add_argument(
+        "input_files",
+        type=Path,
+        nargs="*",
+        help="The files to convert. If none are given, all grid data files in the "
+        "frontend assets dir are converted.",
+    )
+    parser.add_argument(
+        "--to-json",
+        action="store_true",
+        help="Convert binary files back to JSON.",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=list(COMPRESSIONS),
+        default="gzip",
+        help="zstd requires the zstandard package.",
+    )
+    args = parser.parse_args()
+    main(args.input_files, to_json=args.to_json, compression=args.compression)
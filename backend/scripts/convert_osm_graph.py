@@ -0,0 +1,38 @@
+import argparse
+from pathlib import Path
+
+from backend.local_routing import RoadGraph
+
+
+def main(input_file: Path, output_file: Path):
+    graph = RoadGraph.from_osm_xml(input_file)
+    graph.save(output_file)
+
+    input_size = input_file.stat().st_size
+    output_size = output_file.stat().st_size
+    print(
+        f"{input_file} ({input_size / 1024:.0f} KiB) -> "
+        f"{output_file} ({output_size / 1024:.0f} KiB): "
+        f"{len(graph.lat)} nodes, {len(graph.edge_from)} road segments"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert the roads of an OpenStreetMap extract (.osm or "
+        ".osm.gz) to a road graph for offline routing."
+    )
+    parser.add_argument("input_file", type=Path)
+    parser.add_argument(
+        "output_file",
+        type=Path,
+        nargs="?",
+        help="Defaults to the input file with the .npz suffix.",
+    )
+    args = parser.parse_args()
+    output_file = args.output_file
+    if output_file is None:
+        output_file = args.input_file.with_name(
+            args.input_file.name.removesuffix(".gz").removesuffix(".osm") + ".npz"
+        )
+    main(args.input_file, output_file)
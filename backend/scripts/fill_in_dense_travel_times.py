@@ -4,14 +4,20 @@ from pathlib import Path
 
 from backend.export import ASSETS_DIR
 from backend.grid import get_dense_travel_times
+from backend.grid_format import decode_grid_data, encode_grid_data, is_binary_grid_data
 
 
 def main(input_file: Path):
     if "/" not in str(input_file):
         input_file = ASSETS_DIR / input_file
 
-    with input_file.open() as f:
-        json_data = json.load(f)
+    binary = is_binary_grid_data(input_file)
+    if binary:
+        with input_file.open("rb") as f:
+            json_data = decode_grid_data(f.read(), columnar=True)
+    else:
+        with input_file.open() as f:
+            json_data = json.load(f)
 
     if "dense_travel_times" in json_data:
         print(f"{input_file} already has dense travel times. Overwrite? [y/N]")
@@ -22,8 +28,12 @@ def main(input_file: Path):
     travel_times = get_dense_travel_times(json_data["route_matrix"])
     json_data["dense_travel_times"] = travel_times
 
-    with input_file.open("w") as f:
-        json.dump(json_data, f)
+    if binary:
+        with input_file.open("wb") as f:
+            f.write(encode_grid_data(json_data))
+    else:
+        with input_file.open("w") as f:
+            json.dump(json_data, f)
 
     print(f"OK, written to {input_file}")
 
@@ -33,7 +43,8 @@ if __name__ == "__main__":
     parser.add_argument(
         "input_file",
         type=Path,
-        help="The input file. If it's a relative path, "
+        help="The input file, either grid_data.json or a binary grid_data.bin. "
+        "If it's a relative path, "
         "it's treated as relative to the frontend assets dir.",
     )
     args = parser.parse_args()
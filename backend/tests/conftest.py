@@ -0,0 +1,54 @@
+import pytest
+
+from backend import gmaps
+from backend import grid as grid_module
+from backend import quadtree as quadtree_module
+from backend.location import Location, LocationArray
+
+RIVER_CENTER = Location(lat=50.08, lng=14.42)
+# Between two rows of the grid, with a single bridge
+RIVER_LAT = RIVER_CENTER.lat + 0.0005
+BRIDGE = Location(lat=RIVER_LAT, lng=RIVER_CENTER.lng + 0.01)
+
+
+def river_city_duration(a: Location, b: Location, has_river: bool) -> float:
+    """Drive at 10 m/s on a 20% longer road, crossing the river on the bridge."""
+    if has_river and (a.lat - RIVER_LAT) * (b.lat - RIVER_LAT) < 0:
+        path = LocationArray.from_locations([a, BRIDGE, b])
+    else:
+        path = LocationArray.from_locations([a, b])
+    return path.segment_lengths().sum() / 10 * 1.2
+
+
+@pytest.fixture
+def river_city_api(monkeypatch):
+    """Routes API answers from river_city_duration(), for any locations.
+
+    Returns the options of the fake API: "has_river" can be turned off, and
+    "n_elements" counts the queried elements.
+    """
+    options = {"has_river": True, "n_elements": 0}
+
+    def fake_call_distance_matrix_api(
+        origins, destinations, confirm=True, travel_mode=gmaps.TravelMode.DRIVE
+    ):
+        options["n_elements"] += len(origins) * len(destinations)
+        return [
+            {
+                "originIndex": i,
+                "destinationIndex": j,
+                "status": {},
+                "distanceMeters": 0,
+                "duration": f"{round(river_city_duration(a, b, options['has_river']))}s",
+                "condition": "ROUTE_EXISTS",
+            }
+            for i, a in enumerate(origins)
+            for j, b in enumerate(destinations)
+        ]
+
+    monkeypatch.setattr(
+        gmaps, "call_distance_matrix_api", fake_call_distance_matrix_api
+    )
+    for module in (gmaps, grid_module, quadtree_module):
+        monkeypatch.setattr(module, "confirm_if_expensive_from_n", lambda n: None)
+    return options
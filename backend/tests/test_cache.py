@@ -0,0 +1,277 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from backend.cache import (
+    BaseCache,
+    BlobStore,
+    FileBasedCache,
+    MemoryCache,
+    SQLiteCache,
+    create_cache,
+)
+from backend.location import Location
+
+
+@pytest.fixture(params=["file", "sqlite", "memory"])
+def cache(request, tmp_path):
+    if request.param == "file":
+        return FileBasedCache(str(tmp_path))
+    elif request.param == "sqlite":
+        return SQLiteCache(str(tmp_path / "cache.sqlite3"))
+    return MemoryCache(SQLiteCache(str(tmp_path / "cache.sqlite3")))
+
+
+def test_get_set(cache):
+    origins = [Location(lat=40.7589, lng=-73.9851)]
+    destinations = [Location(lat=40.7505, lng=-73.9934)]
+    data = [{"originIndex": 0, "destinationIndex": 0, "duration": "300s"}]
+
+    assert cache.get(origins, destinations, "DRIVE") is None
+    cache.set(origins, destinations, "DRIVE", data)
+    assert cache.get(origins, destinations, "DRIVE") == data
+    assert cache.get(origins, destinations, "WALK") is None
+
+    stats = cache.get_stats()
+    assert stats["total_entries"] == 1
+    assert stats["total_size_bytes"] > 0
+
+
+def test_expired_entries_are_removed(cache):
+    cache.set_by_key("a", {"x": 1}, ttl=-1)
+    cache.set_by_key("b", {"x": 2}, ttl=-1)
+    cache.set_by_key("c", {"x": 3})
+
+    assert cache.get_by_key("a") is None
+    assert cache.clear_expired() == 1
+    assert cache.get_by_key("c") == {"x": 3}
+    assert cache.get_stats()["total_entries"] == 1
+
+
+def test_sqlite_stats_follow_overwrites(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite3"))
+    cache.set_by_key("a", {"x": "short"})
+    cache.set_by_key("a", {"x": "much longer " * 100})
+    cache.set_by_key("b", {"x": 1})
+
+    stats = cache.get_stats()
+    assert stats["total_entries"] == 2
+
+    # A second instance, e.g. in another worker, sees the same entries.
+    other = SQLiteCache(str(tmp_path / "cache.sqlite3"))
+    assert other.get_by_key("a") == {"x": "much longer " * 100}
+    assert other.get_stats() == stats
+
+
+def test_sqlite_concurrent_writes(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite3"))
+
+    def write(worker):
+        for i in range(50):
+            cache.set_by_key(f"{worker}-{i}", {"i": i})
+
+    threads = [threading.Thread(target=write, args=(w,)) for w in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert cache.get_stats()["total_entries"] == 200
+    assert cache.get_by_key("3-49") == {"i": 49}
+
+
+def test_memory_cache_is_bounded_and_counts_hits(tmp_path):
+    backend = FileBasedCache(str(tmp_path))
+    cache = MemoryCache(backend, max_entries=2)
+
+    cache.set_by_key("a", {"x": 1})
+    cache.set_by_key("b", {"x": 2})
+    assert cache.get_by_key("a") == {"x": 1}
+    cache.set_by_key("c", {"x": 3})  # Evicts "b", the least recently used
+
+    stats = cache.get_stats()["memory"]
+    assert stats["entries"] == 2
+    assert (stats["hits"], stats["misses"]) == (1, 0)
+
+    # "b" is read through from the backend and kept in memory again.
+    assert cache.get_by_key("b") == {"x": 2}
+    assert cache.get_by_key("b") == {"x": 2}
+    assert cache.get_by_key("missing") is None
+    stats = cache.get_stats()
+    assert (stats["memory"]["hits"], stats["memory"]["misses"]) == (2, 2)
+    assert stats["total_entries"] == 3
+
+
+def test_memory_cache_bounds_bytes(tmp_path):
+    cache = MemoryCache(FileBasedCache(str(tmp_path)), max_bytes=100)
+    for i in range(10):
+        cache.set_by_key(str(i), {"payload": "x" * 30})
+
+    stats = cache.get_stats()["memory"]
+    assert 0 < stats["size_bytes"] <= 100
+    assert stats["entries"] < 10
+
+
+def test_incomplete_backends_fail_at_construction():
+    class ReadOnlyCache(BaseCache):
+        def get_by_key(self, cache_key):
+            return None
+
+    with pytest.raises(TypeError):
+        ReadOnlyCache()
+
+
+def test_create_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("CACHE_DIR", str(tmp_path))
+    assert isinstance(create_cache("sqlite").backend, SQLiteCache)
+    monkeypatch.setenv("CACHE_BACKEND", "file")
+    monkeypatch.setenv("CACHE_MEMORY_MAX_MB", "0")
+    assert isinstance(create_cache(), FileBasedCache)
+    with pytest.raises(ValueError):
+        create_cache("redis")
+
+
+@pytest.mark.parametrize("eviction_policy", ["lru", "lfu"])
+def test_file_cache_evicts_to_fit_budget(tmp_path, eviction_policy):
+    cache = FileBasedCache(
+        str(tmp_path), max_size_bytes=2000, eviction_policy=eviction_policy
+    )
+    cache.set_by_key("hot", {"payload": "x" * 100})
+    for i in range(20):
+        cache.set_by_key(str(i), {"payload": "x" * 100})
+        # Keep "hot" both recently and frequently used
+        assert cache.get_by_key("hot") is not None
+
+    stats = cache.get_stats()
+    assert stats["total_size_bytes"] <= 2000
+    assert stats["total_entries"] < 21
+    assert len(list(tmp_path.glob("*.json"))) == stats["total_entries"]
+    assert cache.get_by_key("0") is None
+
+
+def test_file_cache_budget_counts_other_workers(tmp_path):
+    worker = FileBasedCache(str(tmp_path), max_size_bytes=1000)
+    other = FileBasedCache(str(tmp_path), manifest_flush_interval=1)
+    for i in range(10):
+        other.set_by_key(str(i), {"payload": "x" * 100})
+    assert worker.get_stats()["total_entries"] == 0
+
+    worker.set_by_key("a", {"payload": "x" * 100})
+    worker.flush()
+    worker.set_by_key("b", {"payload": "x" * 100})
+    assert sum(f.stat().st_size for f in tmp_path.glob("*.json")) <= 1000
+    assert worker.get_by_key("b") is not None
+
+
+def test_file_cache_flushes_once_per_eviction(tmp_path, monkeypatch):
+    cache = FileBasedCache(str(tmp_path), manifest_flush_interval=10)
+    for i in range(200):
+        cache.set_by_key(str(i), {"x": i}, ttl=-1 if i % 2 else 3600)
+    cache.flush()
+    entry_size = cache.get_stats()["total_size_bytes"] // 200
+
+    n_flushes = 0
+    flush = cache.flush
+
+    def counting_flush(force=False):
+        nonlocal n_flushes
+        n_flushes += 1
+        flush(force)
+
+    monkeypatch.setattr(cache, "flush", counting_flush)
+    cache.max_size_bytes = 10 * entry_size
+    cache.set_by_key("new", {"x": 0})
+    assert cache.get_stats()["total_entries"] <= 10
+    assert n_flushes == 1
+
+    cache.max_size_bytes = None
+    for i in range(50):
+        cache.set_by_key(f"expired{i}", {"x": i}, ttl=-1)
+    n_flushes = 0
+    assert cache.clear_expired() == 50
+    assert n_flushes == 1
+
+
+def test_file_cache_manifest_survives_restart(tmp_path):
+    cache = FileBasedCache(str(tmp_path))
+    cache.set_by_key("a", {"x": 1})
+    cache.set_by_key("b", {"x": 2}, ttl=-1)
+    cache.flush()
+    stats = cache.get_stats()
+
+    reopened = FileBasedCache(str(tmp_path))
+    assert reopened.get_stats() == stats
+    assert reopened.clear_expired() == 1
+
+    # Without a manifest, it's rebuilt from the entries.
+    (tmp_path / FileBasedCache.MANIFEST_NAME).unlink()
+    rebuilt = FileBasedCache(str(tmp_path))
+    assert rebuilt.get_stats()["total_entries"] == 1
+    assert rebuilt.get_by_key("a") == {"x": 1}
+
+
+def test_file_caches_on_one_directory_merge_manifests(tmp_path):
+    seed = FileBasedCache(str(tmp_path))
+    for i in range(3):
+        seed.set_by_key(f"seed{i}", {"x": i})
+    assert not (tmp_path / FileBasedCache.MANIFEST_NAME).exists()
+
+    live = FileBasedCache(str(tmp_path))
+    stale = FileBasedCache(str(tmp_path))
+    for i in range(5):
+        live.set_by_key(f"live{i}", {"x": i})
+    live.clear_expired()
+    live._remove("seed0")
+    live.flush()
+    # Flushed last, like an unused cache at exit
+    stale.flush(force=True)
+
+    manifest = json.loads((tmp_path / FileBasedCache.MANIFEST_NAME).read_text())
+    assert sorted(manifest["entries"]) == (
+        [f"live{i}" for i in range(5)] + ["seed1", "seed2"]
+    )
+    assert stale.get_stats()["total_entries"] == 7
+
+
+def test_file_cache_reads_dont_write_the_manifest(tmp_path):
+    cache_dir = tmp_path / "cache"
+    cache = FileBasedCache(str(cache_dir), manifest_flush_interval=10)
+    # Opening a cache doesn't touch the disk
+    assert not cache_dir.exists()
+
+    cache.set_by_key("a", {"x": 1})
+    cache.flush()
+    manifest_file = cache_dir / FileBasedCache.MANIFEST_NAME
+    manifest = manifest_file.read_text()
+    for _ in range(100):
+        assert cache.get_by_key("a") == {"x": 1}
+    assert manifest_file.read_text() == manifest
+
+    # The usage is kept in memory until the next flush
+    cache.flush()
+    entries = json.loads(manifest_file.read_text())["entries"]
+    assert entries["a"]["hits"] == 100
+    # No temporary files are left behind
+    assert sorted(x.name for x in cache_dir.iterdir()) == ["MANIFEST", "a.json"]
+
+
+def test_blob_store(tmp_path):
+    store = BlobStore(str(tmp_path), suffix=".png")
+
+    digest = store.put(b"image")
+    assert store.put(b"image") == digest
+    assert store.get(digest) == b"image"
+    assert store.get("0" * 64) is None
+    assert store.get_stats()["blobs"] == 1
+
+    old_digest = store.put(b"old image")
+    old_path = next(tmp_path.glob(f"*/{old_digest}.png"))
+    an_hour_ago = time.time() - 3600
+    os.utime(old_path, (an_hour_ago, an_hour_ago))
+
+    assert store.clear_unused(max_age=60) == 1
+    assert not store.contains(old_digest)
+    assert store.contains(digest)
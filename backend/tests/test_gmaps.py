@@ -0,0 +1,362 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from backend import gmaps
+from backend.cache import BlobStore, FileBasedCache
+from backend.gmaps import get_snap_cache_key
+from backend.location import Location
+
+
+def fake_duration(origin: Location, destination: Location) -> str:
+    seconds = abs(origin.lat - destination.lat) + abs(origin.lng - destination.lng)
+    return f"{round(seconds * 1e4)}s"
+
+
+def fake_route_matrix(origins, destinations):
+    return [
+        {
+            "originIndex": i,
+            "destinationIndex": j,
+            "status": {},
+            "distanceMeters": 0,
+            "duration": fake_duration(origin, destination),
+            "condition": "ROUTE_EXISTS",
+        }
+        for i, origin in enumerate(origins)
+        for j, destination in enumerate(destinations)
+    ]
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    """Replace the Routes API by a deterministic fake and record the calls."""
+    calls = []
+
+    def fake_call_distance_matrix_api(
+        origins, destinations, confirm=True, travel_mode=gmaps.TravelMode.DRIVE
+    ):
+        calls.append((origins, destinations))
+        return fake_route_matrix(origins, destinations)
+
+    monkeypatch.setattr(
+        gmaps, "call_distance_matrix_api", fake_call_distance_matrix_api
+    )
+    monkeypatch.setattr(gmaps, "confirm_if_expensive_from_n", lambda n: None)
+    return calls
+
+
+def make_locations(n):
+    return [Location(lat=50 + i * 0.001, lng=14 + (i % 7) * 0.002) for i in range(n)]
+
+
+def test_token_bucket_limits_rate():
+    bucket = gmaps.TokenBucket(rate=100, capacity=10)
+    start = time.monotonic()
+    for _ in range(3):
+        bucket.acquire(10)
+    # The first 10 tokens are free, the next 20 take 0.2s to refill.
+    assert time.monotonic() - start >= 0.18
+
+    with pytest.raises(ValueError):
+        bucket.acquire(11)
+
+
+def test_distance_matrix_is_reindexed(fake_api):
+    origins = make_locations(30)
+    destinations = make_locations(27)
+
+    entries = list(gmaps.get_distance_matrix(origins, destinations))
+
+    assert len(entries) == len(origins) * len(destinations)
+    for entry in entries:
+        origin = origins[entry["originIndex"]]
+        destination = destinations[entry["destinationIndex"]]
+        assert entry["duration"] == fake_duration(origin, destination)
+
+
+def test_sparsified_distance_matrix_is_reindexed(fake_api):
+    locations = make_locations(20)
+
+    def should_include(a, b):
+        return a != b and abs(a.lat - b.lat) < 0.0035
+
+    entries = list(
+        gmaps.get_sparsified_distance_matrix(locations, locations, should_include)
+    )
+
+    pairs = sorted((x["originIndex"], x["destinationIndex"]) for x in entries)
+    expected_pairs = [
+        (i, j)
+        for i in range(len(locations))
+        for j in range(i + 1, len(locations))
+        if should_include(locations[i], locations[j])
+    ]
+    assert pairs == expected_pairs
+    for entry in entries:
+        origin = locations[entry["originIndex"]]
+        destination = locations[entry["destinationIndex"]]
+        assert entry["duration"] == fake_duration(origin, destination)
+
+
+@pytest.mark.parametrize("max_elements", [100, 625])
+@pytest.mark.parametrize("symmetric", [False, True])
+def test_plan_route_matrix_requests_covers_mask_exactly(max_elements, symmetric):
+    rng = np.random.default_rng(0)
+    mask = rng.random((60, 60)) < 0.2
+    np.fill_diagonal(mask, False)
+    if symmetric:
+        mask = np.triu(mask) | np.triu(mask).T
+
+    blocks = gmaps.plan_route_matrix_requests(
+        mask, max_elements=max_elements, symmetric=symmetric
+    )
+
+    covered = np.zeros(mask.shape, dtype=int)
+    for origins, destinations in blocks:
+        assert len(origins) * len(destinations) <= max_elements
+        assert len(origins) + len(destinations) <= gmaps.ROUTE_MATRIX_MAX_WAYPOINTS
+        assert mask[np.ix_(origins, destinations)].all()
+        covered[np.ix_(origins, destinations)] += 1
+
+    if symmetric:
+        covered = covered + covered.T
+    assert (covered == mask).all()
+
+
+def test_plan_route_matrix_requests_fills_requests():
+    mask = np.ones((50, 50), dtype=bool)
+
+    assert len(gmaps.plan_route_matrix_requests(mask, max_elements=625)) == 4
+    # The optimum is 25, the greedy planner leaves one small block at the end.
+    assert len(gmaps.plan_route_matrix_requests(mask, max_elements=100)) <= 26
+
+
+class FakeHTTPResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def test_client_retries_and_honors_retry_after(monkeypatch):
+    client = gmaps.MapsClient(max_retries=3)
+    responses = [
+        FakeHTTPResponse(429, {"Retry-After": "7"}),
+        FakeHTTPResponse(503),
+        FakeHTTPResponse(200),
+    ]
+    monkeypatch.setattr(
+        client.session, "request", lambda *args, **kwargs: responses.pop(0)
+    )
+    sleeps = []
+    monkeypatch.setattr(gmaps.time, "sleep", sleeps.append)
+
+    response = client.get("https://example.com", timeout=(1, 1))
+
+    assert response.status_code == 200
+    assert sleeps[0] == 7
+    assert 0 <= sleeps[1] <= client.backoff_base * 2
+
+
+def test_client_gives_up_after_max_retries(monkeypatch):
+    client = gmaps.MapsClient(max_retries=2)
+    monkeypatch.setattr(
+        client.session, "request", lambda *args, **kwargs: FakeHTTPResponse(429)
+    )
+    sleeps = []
+    monkeypatch.setattr(gmaps.time, "sleep", sleeps.append)
+
+    response = client.get("https://example.com", timeout=(1, 1))
+
+    assert response.status_code == 429
+    assert len(sleeps) == 2
+
+
+def test_snap_results_are_cached_by_quantized_location(monkeypatch, tmp_path):
+    monkeypatch.setattr(gmaps, "cache", FileBasedCache(str(tmp_path)))
+    calls = []
+
+    def fake_call_geocoding_api(location):
+        calls.append(location)
+        if location.lat > 51:
+            return None
+        return {
+            "location": {"lat": location.lat + 0.001, "lng": location.lng},
+            "place_id": "abc",
+            "types": ["route"],
+        }
+
+    monkeypatch.setattr(gmaps, "call_geocoding_api", fake_call_geocoding_api)
+
+    locations = [
+        Location(lat=50.00001, lng=14.0),
+        Location(lat=50.00002, lng=14.0),
+        Location(lat=52.0, lng=14.0),
+    ]
+    # One worker, so that the first two locations don't race for the cache.
+    results = gmaps.snap_locations_to_road(locations, max_workers=1)
+    results_again = gmaps.snap_locations_to_road(locations)
+
+    assert results[0]["location"] == results[1]["location"]
+    assert results[2] is None
+    assert results_again == results
+    # The first two locations round to the same key, and failures are cached too.
+    assert len({get_snap_cache_key(x) for x in calls}) == len(calls) == 2
+
+
+def test_route_matrix_elements_are_cached_individually(monkeypatch, tmp_path):
+    monkeypatch.setattr(gmaps, "cache", FileBasedCache(str(tmp_path)))
+    requested = []
+
+    def fake_request_route_matrix(origins, destinations, travel_mode):
+        requested.extend((o, d) for o in origins for d in destinations)
+        return fake_route_matrix(origins, destinations)
+
+    monkeypatch.setattr(gmaps, "request_route_matrix", fake_request_route_matrix)
+
+    locations = make_locations(12)
+    gmaps.call_distance_matrix_api(locations[:8], locations[:8], confirm=False)
+    assert len(requested) == 64
+
+    # Overlaps with the first request except for the last 4 locations.
+    requested.clear()
+    origins, destinations = locations[2:], locations[4:]
+    entries = gmaps.call_distance_matrix_api(origins, destinations, confirm=False)
+
+    assert len(requested) == len(origins) * len(destinations) - 6 * 4
+    assert sorted((x["originIndex"], x["destinationIndex"]) for x in entries) == [
+        (i, j) for i in range(len(origins)) for j in range(len(destinations))
+    ]
+    for entry in entries:
+        origin = origins[entry["originIndex"]]
+        destination = destinations[entry["destinationIndex"]]
+        assert entry["duration"] == fake_duration(origin, destination)
+
+
+def test_concurrent_identical_calls_are_coalesced(monkeypatch, tmp_path):
+    monkeypatch.setattr(gmaps, "cache", FileBasedCache(str(tmp_path)))
+    monkeypatch.setattr(gmaps, "single_flight", gmaps.SingleFlight())
+    n_requests = 0
+
+    def fake_request_route_matrix(origins, destinations, travel_mode):
+        nonlocal n_requests
+        n_requests += 1
+        time.sleep(0.2)
+        return fake_route_matrix(origins, destinations)
+
+    monkeypatch.setattr(gmaps, "request_route_matrix", fake_request_route_matrix)
+
+    locations = make_locations(8)
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        results = list(
+            executor.map(
+                lambda _: gmaps.call_distance_matrix_api(
+                    locations, locations, confirm=False
+                ),
+                range(6),
+            )
+        )
+
+    assert n_requests == 1
+    assert gmaps.single_flight.n_shared == 5
+    assert all(x == results[0] for x in results)
+    # Each caller gets its own copy of the entries
+    results[0][0]["originIndex"] = 100
+    assert results[1][0]["originIndex"] != 100
+
+
+def test_cache_is_created_once_on_first_use(monkeypatch, tmp_path):
+    monkeypatch.setattr(gmaps, "cache", None)
+    created = []
+
+    def create_cache():
+        created.append(FileBasedCache(str(tmp_path)))
+        return created[-1]
+
+    monkeypatch.setattr(gmaps, "create_cache", create_cache)
+
+    assert gmaps.get_cache() is gmaps.get_cache() is created[0]
+    assert len(created) == 1
+    other = FileBasedCache(str(tmp_path / "other"))
+    gmaps.set_cache(other)
+    assert gmaps.get_cache() is other
+
+
+def test_single_flight_shares_exceptions():
+    single_flight = gmaps.SingleFlight()
+    n_calls = 0
+
+    def fail():
+        nonlocal n_calls
+        n_calls += 1
+        time.sleep(0.1)
+        raise RuntimeError("Rate limit exceeded")
+
+    def call(_):
+        with pytest.raises(RuntimeError):
+            single_flight.do("key", fail)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(call, range(4)))
+
+    assert n_calls == 1
+    assert single_flight.in_flight == {}
+
+
+def test_single_flight_survives_a_cancelled_leader():
+    single_flight = gmaps.SingleFlight()
+    n_calls = 0
+
+    async def fetch():
+        nonlocal n_calls
+        n_calls += 1
+        await asyncio.sleep(0.1)
+        return "result"
+
+    async def run():
+        leader = asyncio.create_task(single_flight.do_async("key", fetch))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(single_flight.do_async("key", fetch))
+        await asyncio.sleep(0.01)
+        # E.g. the client of a streamed route matrix disconnected
+        leader.cancel()
+        return leader, await follower
+
+    leader, result = asyncio.run(run())
+
+    assert leader.cancelled()
+    assert result == "result"
+    assert n_calls == 1
+    assert single_flight.in_flight == {}
+
+
+def test_static_maps_are_cached_by_content(monkeypatch, tmp_path):
+    monkeypatch.setattr(gmaps, "cache", FileBasedCache(str(tmp_path / "cache")))
+    monkeypatch.setattr(gmaps, "static_map_store", BlobStore(str(tmp_path / "maps")))
+    urls = []
+
+    class FakeImageResponse:
+        content = b"same image"
+
+        def raise_for_status(self):
+            pass
+
+    def fake_get(url, timeout):
+        urls.append(url)
+        return FakeImageResponse()
+
+    monkeypatch.setattr(gmaps.client, "get", fake_get)
+    center = Location(lat=50, lng=14)
+
+    image, digest = gmaps.get_static_map_with_digest(center, 13)
+    assert gmaps.get_static_map(center, 13) == image == b"same image"
+    assert len(urls) == 1
+
+    # A different request with the same content shares the stored image
+    _, other_digest = gmaps.get_static_map_with_digest(center, 13, markers=[center])
+    assert len(urls) == 2
+    assert other_digest == digest
+    assert gmaps.static_map_store.get_stats()["blobs"] == 1
@@ -0,0 +1,154 @@
+import asyncio
+import time
+
+import httpx
+
+from backend import gmaps, gmaps_async
+from backend.cache import BlobStore, SQLiteCache
+from tests.test_gmaps import fake_duration, fake_route_matrix, make_locations
+
+
+def test_distance_matrix_runs_requests_concurrently(monkeypatch, tmp_path):
+    monkeypatch.setattr(gmaps, "cache", SQLiteCache(str(tmp_path / "cache.sqlite3")))
+    n_requests = 0
+
+    async def fake_request_route_matrix(origins, destinations, travel_mode):
+        nonlocal n_requests
+        n_requests += 1
+        await asyncio.sleep(0.5)
+        return fake_route_matrix(origins, destinations)
+
+    monkeypatch.setattr(gmaps_async, "request_route_matrix", fake_request_route_matrix)
+
+    origins = make_locations(50)
+    destinations = make_locations(40)
+    start = time.monotonic()
+    entries = asyncio.run(gmaps_async.get_distance_matrix(origins, destinations))
+
+    # 2000 elements need several requests, which wait at the same time.
+    assert n_requests >= 4
+    # Sequential requests would take at least 0.5s * n_requests.
+    assert time.monotonic() - start < 0.5 * n_requests / 2
+    assert len(entries) == len(origins) * len(destinations)
+    for entry in entries:
+        origin = origins[entry["originIndex"]]
+        destination = destinations[entry["destinationIndex"]]
+        assert entry["duration"] == fake_duration(origin, destination)
+
+    # The elements are shared with the sync API through the cache.
+    n_requests = 0
+    entries_again = asyncio.run(gmaps_async.get_distance_matrix(origins, destinations))
+    assert n_requests == 0
+
+    def key(entry):
+        return entry["originIndex"], entry["destinationIndex"]
+
+    assert sorted(entries_again, key=key) == sorted(entries, key=key)
+
+
+def test_async_client_retries(monkeypatch):
+    statuses = [503, 429, 200]
+
+    def handler(request):
+        return httpx.Response(statuses.pop(0), headers={"Retry-After": "0"})
+
+    client = gmaps_async.AsyncMapsClient(max_retries=3)
+    client._session = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def fake_sleep(seconds):
+        pass
+
+    monkeypatch.setattr(gmaps_async.asyncio, "sleep", fake_sleep)
+
+    async def run():
+        try:
+            return await client.get("https://example.com", timeout=(1, 1))
+        finally:
+            await client.aclose()
+
+    response = asyncio.run(run())
+
+    assert response.status_code == 200
+    assert statuses == []
+
+
+def test_token_bucket_acquire_async():
+    bucket = gmaps.TokenBucket(rate=100, capacity=10)
+
+    async def run():
+        for _ in range(3):
+            await bucket.acquire_async(10)
+
+    start = time.monotonic()
+    asyncio.run(run())
+    assert time.monotonic() - start >= 0.18
+
+
+def test_static_maps_are_coalesced_across_tasks_and_threads(monkeypatch, tmp_path):
+    monkeypatch.setattr(gmaps, "single_flight", gmaps.SingleFlight())
+    monkeypatch.setattr(gmaps, "cache", SQLiteCache(str(tmp_path / "cache.sqlite3")))
+    monkeypatch.setattr(gmaps, "static_map_store", BlobStore(str(tmp_path / "maps")))
+    n_calls = 0
+
+    async def handler(request):
+        nonlocal n_calls
+        n_calls += 1
+        await asyncio.sleep(0.3)
+        return httpx.Response(200, content=b"png")
+
+    monkeypatch.setattr(gmaps_async, "client", gmaps_async.AsyncMapsClient())
+    gmaps_async.client._session = httpx.AsyncClient(
+        transport=httpx.MockTransport(handler)
+    )
+    monkeypatch.setattr(gmaps.client, "get", lambda *args, **kwargs: 1 / 0)
+    center = make_locations(1)[0]
+
+    async def run():
+        tasks = [gmaps_async.get_static_map(center, 13) for _ in range(4)]
+        # A sync caller in a worker thread joins the same flight
+        tasks.append(asyncio.to_thread(gmaps.get_static_map, center, 13))
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            await gmaps_async.client.aclose()
+
+    results = asyncio.run(run())
+
+    assert results == [b"png"] * 5
+    assert n_calls == 1
+
+
+def test_iter_distance_matrix_yields_entries_as_requests_finish(monkeypatch, tmp_path):
+    monkeypatch.setattr(gmaps, "cache", SQLiteCache(str(tmp_path / "cache.sqlite3")))
+    n_started = 0
+
+    async def fake_request_route_matrix(origins, destinations, travel_mode):
+        nonlocal n_started
+        n_started += 1
+        # The first request is the slowest
+        await asyncio.sleep(0.3 if n_started == 1 else 0.05)
+        return fake_route_matrix(origins, destinations)
+
+    monkeypatch.setattr(gmaps_async, "request_route_matrix", fake_request_route_matrix)
+
+    origins = make_locations(50)
+    destinations = make_locations(40)
+    n_requests = len(gmaps_async.make_full_route_matrix_requests(origins, destinations))
+
+    async def run():
+        start = time.monotonic()
+        first_entry_seconds = None
+        entries = []
+        async for entry in gmaps_async.iter_distance_matrix(origins, destinations):
+            if first_entry_seconds is None:
+                first_entry_seconds = time.monotonic() - start
+            entries.append(entry)
+        return first_entry_seconds, entries
+
+    first_entry_seconds, entries = asyncio.run(run())
+
+    assert n_started == n_requests
+    assert first_entry_seconds < 0.3
+    assert sorted((x["originIndex"], x["destinationIndex"]) for x in entries) == [
+        (i, j) for i in range(len(origins)) for j in range(len(destinations))
+    ]
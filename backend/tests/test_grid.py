@@ -0,0 +1,288 @@
+import json
+import random
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from backend.grid import (
+    DenseTravelTimes,
+    Grid,
+    estimate_fill_errors,
+    get_dense_travel_times,
+    get_triangle_lower_bounds,
+)
+from backend.location import Location
+
+from .conftest import RIVER_CENTER, RIVER_LAT, river_city_duration
+
+ASSETS_DIR = Path(__file__).parents[2] / "frontend" / "src" / "assets"
+
+
+def reference_dense_travel_times(route_matrix):
+    """The original pure-Python Floyd-Warshall, kept as a reference."""
+    n_locations = (
+        max(max(x["originIndex"], x["destinationIndex"]) for x in route_matrix) + 1
+    )
+    m = [
+        [None if i != j else 0 for j in range(n_locations)] for i in range(n_locations)
+    ]
+    for route in route_matrix:
+        origin = route["originIndex"]
+        destination = route["destinationIndex"]
+        duration = int(route["duration"][:-1])
+
+        m[origin][destination] = duration
+        m[destination][origin] = duration
+
+    for k in range(len(m)):
+        for i in range(len(m)):
+            for j in range(len(m)):
+                if m[i][k] is not None and m[k][j] is not None:
+                    if m[i][j] is None or m[i][j] > m[i][k] + m[k][j]:
+                        m[i][j] = m[i][k] + m[k][j]
+
+    return m
+
+
+def make_route_matrix(n_locations, n_entries, seed):
+    rng = random.Random(seed)
+    return [
+        {
+            "originIndex": rng.randrange(n_locations),
+            "destinationIndex": rng.randrange(n_locations),
+            "status": {},
+            "distanceMeters": 0,
+            "duration": f"{rng.randrange(0, 2000)}s",
+            "condition": "ROUTE_EXISTS",
+        }
+        for _ in range(n_entries)
+    ]
+
+
+@pytest.mark.parametrize(
+    "n_locations,n_entries,seed",
+    [(1, 1, 0), (5, 3, 1), (20, 15, 2), (30, 200, 3), (40, 60, 4)],
+)
+def test_dense_travel_times_matches_reference(n_locations, n_entries, seed):
+    route_matrix = make_route_matrix(n_locations, n_entries, seed)
+    assert get_dense_travel_times(route_matrix) == reference_dense_travel_times(
+        route_matrix
+    )
+
+
+def test_dense_travel_times_matches_exported_asset():
+    with (ASSETS_DIR / "newyork_runner" / "grid_data.json").open() as f:
+        grid_data = json.load(f)
+
+    dense = get_dense_travel_times(grid_data["route_matrix"])
+    assert dense == grid_data["dense_travel_times"]
+
+
+def test_incremental_travel_times_match_full_recompute():
+    n_locations = 30
+    rng = random.Random(5)
+    pairs = [(i, j) for i in range(n_locations) for j in range(i + 1, n_locations)]
+    rng.shuffle(pairs)
+    route_matrix = [
+        {
+            "originIndex": i,
+            "destinationIndex": j,
+            "status": {},
+            "distanceMeters": 0,
+            "duration": f"{rng.randrange(1, 2000)}s",
+            "condition": "ROUTE_EXISTS",
+        }
+        for i, j in pairs[:120]
+    ]
+    initial, new = route_matrix[:60], route_matrix[60:]
+
+    travel_times = DenseTravelTimes.from_route_matrix(initial, n_locations)
+    n_improved = travel_times.add_routes(new)
+
+    assert 0 < n_improved <= len(new)
+    assert travel_times.to_list() == get_dense_travel_times(route_matrix)
+
+
+def test_incremental_travel_times_ignore_slower_routes():
+    route_matrix = make_route_matrix(10, 30, seed=6)
+    travel_times = DenseTravelTimes.from_route_matrix(route_matrix)
+    before = travel_times.to_list()
+
+    assert not travel_times.add_route(0, 0, 10)
+    a, b = next(
+        (x["originIndex"], x["destinationIndex"])
+        for x in route_matrix
+        if x["originIndex"] != x["destinationIndex"]
+    )
+    assert not travel_times.add_route(a, b, before[a][b] + 1)
+    assert travel_times.to_list() == before
+
+
+@pytest.mark.parametrize("change", [-100, 100])
+def test_requeried_routes_replace_the_old_ones(change):
+    grid = Grid(Location(lat=40.75, lng=-73.98), zoom=12, size=4, snap_to_roads=False)
+    pairs = [(i, j) for i in range(16) for j in range(i + 1, 16)]
+    random.Random(7).shuffle(pairs)
+    grid.route_matrix = [
+        {
+            "originIndex": i,
+            "destinationIndex": j,
+            "status": {},
+            "distanceMeters": 0,
+            "duration": f"{200 + 10 * k}s",
+            "condition": "ROUTE_EXISTS",
+        }
+        for k, (i, j) in enumerate(pairs[:40])
+    ]
+    grid.get_travel_times()
+
+    # The same pair, in the other direction
+    i, j = pairs[0]
+    requeried = {**grid.route_matrix[0], "originIndex": j, "destinationIndex": i}
+    requeried["duration"] = f"{200 + change}s"
+    grid.add_route_matrix_entries([requeried])
+
+    assert len(grid.route_matrix) == 40
+    assert grid.route_matrix[0] == requeried
+    expected = DenseTravelTimes.from_route_matrix(grid.route_matrix, 16)
+    np.testing.assert_array_equal(grid.get_travel_times().m, expected.m)
+
+
+@pytest.mark.parametrize("max_normalized_distance", [0.05, 0.12, 0.3])
+def test_nearby_pairs_match_brute_force(max_normalized_distance):
+    grid = Grid(
+        Location(lat=40.75, lng=-73.98), zoom=12, size=11, snap_to_roads=False
+    )
+    # Simulate two locations that snapped to the same point
+    grid.locations[1].snapped_location = grid.locations[0].snapped_location
+
+    locations = grid.get_snapped_locations()
+    expected = [
+        [i, j]
+        for i in range(len(locations))
+        for j in range(i + 1, len(locations))
+        if locations[i] != locations[j]
+        and grid.get_normalized_distance(locations[i], locations[j])
+        < max_normalized_distance
+    ]
+
+    assert grid.get_nearby_pairs(max_normalized_distance).tolist() == expected
+
+
+@pytest.fixture
+def river_city(river_city_api):
+    """A grid whose Routes API answers come from river_city_duration()."""
+    grid = Grid(RIVER_CENTER, zoom=13, size=11, snap_to_roads=False)
+    locations = grid.get_snapped_locations()
+    options = river_city_api
+
+    def get_max_error(pairs):
+        m = grid.get_travel_times().m
+        true = np.array(
+            [
+                river_city_duration(locations[i], locations[j], options["has_river"])
+                for i, j in pairs
+            ]
+        )
+        return np.max(m[pairs[:, 0], pairs[:, 1]] / true - 1)
+
+    return grid, options, get_max_error
+
+
+def test_adaptive_sparsification_queries_fewer_elements(river_city):
+    grid, options, get_max_error = river_city
+    pairs = grid.get_nearby_pairs(0.4)
+
+    grid.compute_sparsified_distance_matrix(0.4)
+    n_fixed = options["n_elements"]
+    assert n_fixed == len(pairs)
+
+    # Only the backbone of neighboring pairs misses the detours around the river.
+    options["n_elements"] = 0
+    grid.compute_adaptive_distance_matrix(0.4, target_error=1)
+    n_backbone = options["n_elements"]
+    assert get_max_error(pairs) > 0.1
+
+    options["n_elements"] = 0
+    grid.compute_adaptive_distance_matrix(0.4, target_error=0.1)
+    n_adaptive = options["n_elements"]
+    assert n_backbone < n_adaptive < 0.6 * n_fixed
+    assert get_max_error(pairs) < 0.1
+
+
+def test_adaptive_sparsification_respects_the_budget(river_city):
+    grid, options, get_max_error = river_city
+
+    grid.compute_adaptive_distance_matrix(0.4, target_error=0, max_elements=500)
+
+    assert options["n_elements"] == 500
+    assert len(grid.route_matrix) == 500
+
+
+def test_adaptive_sparsification_of_a_regular_city(river_city):
+    grid, options, get_max_error = river_city
+    options["has_river"] = False
+
+    grid.compute_adaptive_distance_matrix(0.4)
+
+    # Neighbors and diagonal neighbors
+    assert options["n_elements"] == 2 * 10 * 11 + 2 * 10 * 10
+    assert get_max_error(grid.get_nearby_pairs(0.4)) < 0.1
+
+
+def test_fill_errors():
+    # 0 -- 1 -- 2 takes 20s when filled in, but 0 -- 3 -- 2 proves it's at least 18s
+    exact = np.full((4, 4), np.inf)
+    exact[0, 1] = exact[1, 0] = exact[1, 2] = exact[2, 1] = 10
+    exact[0, 3] = exact[3, 0] = 19
+    travel_times = np.array(
+        [[0, 10, 20, 19], [10, 0, 10, 1], [20, 10, 0, 1], [19, 1, 1, 0]], dtype=float
+    )
+    pairs = np.array([[0, 2]])
+
+    lower_bounds = get_triangle_lower_bounds(exact, travel_times, pairs)
+    assert lower_bounds.tolist() == [18]
+    errors = estimate_fill_errors(np.array([20.0, np.inf]), np.array([18.0, 5.0]))
+    assert errors == pytest.approx([0.1, 1])
+
+
+def test_landmark_travel_times_are_bounded(river_city):
+    grid, options, _ = river_city
+    locations = grid.get_snapped_locations()
+    n_locations = len(locations)
+    true = np.array(
+        [
+            [river_city_duration(a, b, has_river=True) for b in locations]
+            for a in locations
+        ]
+    )
+
+    mean_errors = []
+    for n_landmarks in [4, 16]:
+        options["n_elements"] = 0
+        grid.compute_landmark_distance_matrix(n_landmarks)
+        assert options["n_elements"] < n_landmarks * n_locations + 4 * n_locations
+
+        m = grid.get_travel_times().m
+        errors = grid.get_travel_time_errors()
+        assert (errors == errors.T).all()
+        assert np.isfinite(m).all()
+        # The filled-in times are upper bounds, and the errors say by how much at
+        # most, up to the rounding to whole seconds.
+        assert (m >= true - 1).all()
+        assert (m - true <= errors * m + 1.5).all()
+        mean_errors.append(errors.mean())
+
+    assert mean_errors[1] < mean_errors[0] < 0.15
+
+
+def test_landmarks_are_spread_out():
+    grid = Grid(RIVER_CENTER, zoom=13, size=11, snap_to_roads=False)
+    landmarks = grid.pick_landmarks(4)
+
+    corners = [(0, 0), (0, 10), (10, 0), (10, 10)]
+    assert (
+        sorted((grid.locations[i].grid_x, grid.locations[i].grid_y) for i in landmarks)
+        == corners
+    )
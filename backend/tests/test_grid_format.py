@@ -0,0 +1,80 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from backend.grid import Grid, get_dense_travel_times
+from backend.grid_format import (
+    RouteMatrixColumns,
+    decode_grid_data,
+    encode_grid_data,
+    load_grid_data,
+    save_grid_data,
+)
+
+ASSETS_DIR = Path(__file__).parents[2] / "frontend" / "src" / "assets"
+
+
+@pytest.fixture(scope="module")
+def grid_data():
+    with (ASSETS_DIR / "newyork_runner" / "grid_data.json").open() as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_round_trip(grid_data, compression):
+    encoded = encode_grid_data(grid_data, compression=compression)
+
+    assert decode_grid_data(encoded) == grid_data
+    assert len(encoded) < len(json.dumps(grid_data)) / 4
+
+
+def test_round_trip_with_missing_values():
+    grid_data = {
+        "center": {"lat": 1.0, "lng": 2.0},
+        "route_matrix": [
+            {
+                "originIndex": 0,
+                "destinationIndex": 1,
+                "status": {},
+                "distanceMeters": 10,
+                "duration": "70000s",
+                "condition": "ROUTE_EXISTS",
+            },
+            {
+                "originIndex": 1,
+                "destinationIndex": 2,
+                "status": {"code": 5},
+                "condition": "ROUTE_NOT_FOUND",
+            },
+        ],
+        "dense_travel_times": [[0, 70000, None], [70000, 0, None], [None, None, 0]],
+    }
+
+    assert decode_grid_data(encode_grid_data(grid_data)) == grid_data
+
+
+def test_columnar_loading(grid_data, tmp_path):
+    path = tmp_path / "grid_data.bin"
+    save_grid_data(grid_data, path)
+
+    columnar = load_grid_data(path, columnar=True)
+    assert isinstance(columnar["route_matrix"], RouteMatrixColumns)
+    assert get_dense_travel_times(columnar["route_matrix"]) == (
+        grid_data["dense_travel_times"]
+    )
+
+    dense = columnar["dense_travel_times"]
+    assert dense.shape == (361, 361)
+    assert np.array_equal(dense, np.array(grid_data["dense_travel_times"]))
+
+
+def test_grid_load(grid_data, tmp_path):
+    path = tmp_path / "grid_data.bin"
+    save_grid_data(grid_data, path)
+
+    grid = Grid.load(path)
+    assert len(grid.locations) == 361
+    assert grid.to_json()["dense_travel_times"] == grid_data["dense_travel_times"]
+    assert grid.route_matrix == grid_data["route_matrix"]
@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+from backend import gmaps_async
+from backend.gmaps import TravelMode
+from backend.grid import compute_spacetime_grid_async, generate_grid
+from backend.jobs import JobQueue, JobQueueFullError, JobStatus, format_sse
+from backend.location import Location
+
+
+def test_jobs_run_in_the_background_with_bounded_concurrency():
+    n_running = 0
+    max_running = 0
+
+    async def work(job):
+        nonlocal n_running, max_running
+        n_running += 1
+        max_running = max(max_running, n_running)
+        for i in range(3):
+            await asyncio.sleep(0.01)
+            job.report("working", i + 1, 3)
+        n_running -= 1
+        return job.id
+
+    async def run():
+        queue = JobQueue(max_workers=2)
+        queue.start()
+        jobs = [queue.submit("test", work) for _ in range(5)]
+        events = [[event async for event in job.follow()] for job in jobs]
+        await queue.stop()
+        return jobs, events
+
+    jobs, events = asyncio.run(run())
+
+    assert max_running == 2
+    for job, job_events in zip(jobs, events):
+        assert job.status == JobStatus.DONE
+        assert job.to_json()["result"] == job.id
+        assert [x.get("status") for x in job_events if x["type"] == "status"] == [
+            "queued",
+            "running",
+            "done",
+        ]
+        assert [x["done"] for x in job_events if x["type"] == "progress"] == [1, 2, 3]
+
+
+def test_failed_jobs_report_the_error():
+    async def work(job):
+        raise ValueError("No elements to include.")
+
+    async def run():
+        queue = JobQueue(max_workers=1)
+        queue.start()
+        job = queue.submit("test", work)
+        events = [event async for event in job.follow()]
+        await queue.stop()
+        return job, events
+
+    job, events = asyncio.run(run())
+
+    assert job.status == JobStatus.FAILED
+    assert "result" not in job.to_json()
+    assert events[-1] == {
+        "type": "status",
+        "status": "failed",
+        "error": "No elements to include.",
+    }
+    assert format_sse(events[-1]).startswith("event: status\ndata: {")
+
+
+def test_spacetime_grid_jobs_fail_when_the_routes_api_fails(monkeypatch):
+    async def fail(*args, **kwargs):
+        raise RuntimeError("Rate limit exceeded")
+
+    monkeypatch.setattr(gmaps_async, "get_distance_matrix", fail)
+    center = Location(lat=52.52, lng=13.405)
+    grid_points = generate_grid(center, radius_km=1, grid_size=3)
+
+    async def work(job):
+        return await compute_spacetime_grid_async(
+            center, grid_points, TravelMode.WALK, on_progress=job.report, fallback=False
+        )
+
+    async def run():
+        queue = JobQueue(max_workers=1)
+        queue.start()
+        job = queue.submit("spacetime-grid", work)
+        events = [event async for event in job.follow()]
+        await queue.stop()
+        return job, events
+
+    job, events = asyncio.run(run())
+
+    assert job.status == JobStatus.FAILED
+    assert events[-1]["error"] == "Rate limit exceeded"
+    # Requests without a job still get the grid without travel times
+    fallback = asyncio.run(
+        compute_spacetime_grid_async(center, grid_points, TravelMode.WALK)
+    )
+    assert len(fallback["points"]) == len(grid_points)
+
+
+def test_queue_is_bounded_and_forgets_old_jobs():
+    async def work(job):
+        return None
+
+    async def run():
+        queue = JobQueue(max_workers=1, max_queued=2, max_finished=1)
+        first = queue.submit("test", work)
+        queue.submit("test", work)
+        with pytest.raises(JobQueueFullError):
+            queue.submit("test", work)
+
+        queue.start()
+        await queue.queue.join()
+        await queue.stop()
+
+        last = queue.submit("test", work)
+        return queue, first, last
+
+    queue, first, last = asyncio.run(run())
+
+    assert queue.get(first.id) is None
+    assert len(queue.jobs) == 2
+    assert queue.get(last.id) is last
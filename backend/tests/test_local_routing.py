@@ -0,0 +1,331 @@
+import asyncio
+import random
+
+import numpy as np
+import pytest
+
+from backend import gmaps, gmaps_async
+from backend.gmaps import TravelMode
+from backend.grid import Grid, floyd_warshall, parse_duration
+from backend.local_routing import SPEED_PROFILES, LocalRouter, RoadGraph
+from backend.location import Location, LocationArray, haversine_distance
+
+CENTER = Location(lat=50.08, lng=14.42)
+# About 55 m between neighboring nodes
+SPACING = 0.0005
+SIZE = 24
+
+
+def make_street_grid(n_oneway: int = 30, seed: int = 0) -> RoadGraph:
+    """A lattice of residential streets, some of them one-way, and a few footways."""
+    rng = random.Random(seed)
+    ys, xs = np.divmod(np.arange(SIZE * SIZE), SIZE)
+    lat = CENTER.lat + (ys - SIZE / 2) * SPACING
+    lng = CENTER.lng + (xs - SIZE / 2) * SPACING / np.cos(np.radians(CENTER.lat))
+
+    segments = []
+    for i in range(SIZE * SIZE):
+        if i % SIZE < SIZE - 1:
+            segments.append((i, i + 1, "residential", False))
+        if i + SIZE < SIZE * SIZE:
+            segments.append((i, i + SIZE, "residential", False))
+    for k in rng.sample(range(len(segments)), n_oneway):
+        segments[k] = (*segments[k][:3], True)
+    # Diagonal shortcuts that only pedestrians and bikes can use
+    for i in rng.sample(range(SIZE * (SIZE - 1)), 20):
+        if i % SIZE < SIZE - 1:
+            segments.append((i, i + SIZE + 1, "footway", False))
+    return RoadGraph.from_segments(lat, lng, segments)
+
+
+def reference_travel_times(graph: RoadGraph, travel_mode: TravelMode) -> np.ndarray:
+    profile = SPEED_PROFILES[travel_mode]
+    m = np.full((len(graph.lat), len(graph.lat)), np.inf)
+    np.fill_diagonal(m, 0)
+    for a, b, meters, highway, oneway in zip(
+        graph.edge_from,
+        graph.edge_to,
+        graph.edge_meters,
+        graph.edge_highway,
+        graph.edge_oneway,
+    ):
+        speed = profile.speeds_kmh.get(graph.highway_types[highway])
+        if speed is None:
+            continue
+        seconds = meters / (speed / 3.6)
+        m[a, b] = min(m[a, b], seconds)
+        if not (oneway and profile.respects_oneway):
+            m[b, a] = min(m[b, a], seconds)
+    return floyd_warshall(m)
+
+
+def get_node_locations(graph: RoadGraph, nodes) -> list[Location]:
+    return [Location(lat=graph.lat[i], lng=graph.lng[i]) for i in nodes]
+
+
+def to_matrix(entries, shape) -> np.ndarray:
+    m = np.full(shape, np.inf)
+    for entry in entries:
+        if entry["condition"] == "ROUTE_EXISTS":
+            m[entry["originIndex"], entry["destinationIndex"]] = parse_duration(
+                entry["duration"]
+            )
+    return m
+
+
+@pytest.mark.parametrize("travel_mode", [TravelMode.DRIVE, TravelMode.WALK])
+@pytest.mark.parametrize("n_origins,n_destinations", [(5, 20), (20, 5)])
+def test_route_matrix_matches_all_pairs_shortest_paths(
+    travel_mode, n_origins, n_destinations
+):
+    graph = make_street_grid()
+    router = LocalRouter(graph)
+    rng = random.Random(1)
+    origins = rng.sample(range(len(graph.lat)), n_origins)
+    destinations = rng.sample(range(len(graph.lat)), n_destinations)
+
+    entries = router.get_route_matrix(
+        get_node_locations(graph, origins),
+        get_node_locations(graph, destinations),
+        travel_mode,
+    )
+
+    assert len(entries) == n_origins * n_destinations
+    expected = reference_travel_times(graph, travel_mode)[np.ix_(origins, destinations)]
+    # Durations are rounded to seconds, like the ones of the Routes API
+    np.testing.assert_allclose(
+        to_matrix(entries, expected.shape), expected, atol=0.5 + 1e-6
+    )
+
+
+def test_travel_modes_use_their_roads_and_speeds():
+    graph = make_street_grid(n_oneway=0)
+    router = LocalRouter(graph)
+    # Opposite corners, where the footway shortcuts help walking and cycling
+    locations = get_node_locations(graph, [0, SIZE * SIZE - 1])
+
+    def get_seconds(travel_mode):
+        [entry] = router.get_route_matrix(locations[:1], locations[1:], travel_mode)
+        return parse_duration(entry["duration"])
+
+    walk, run = get_seconds(TravelMode.WALK), get_seconds(TravelMode.RUN)
+    assert run == pytest.approx(walk / 2, abs=1)
+    assert get_seconds(TravelMode.BICYCLE) < walk
+    # Driving can't take the footways, but is faster on the streets anyway
+    manhattan_meters = sum(
+        graph.edge_meters[(graph.edge_from == i) & (graph.edge_to == i + 1)][0]
+        for i in range(SIZE - 1)
+    ) + sum(
+        graph.edge_meters[(graph.edge_from == i) & (graph.edge_to == i + SIZE)][0]
+        for i in range(0, SIZE * SIZE - SIZE, SIZE)
+    )
+    assert get_seconds(TravelMode.DRIVE) == round(manhattan_meters / (30 / 3.6))
+
+    with pytest.raises(ValueError):
+        router.get_route_matrix(locations, locations, TravelMode.TRANSIT)
+
+
+def test_one_way_streets_only_bind_vehicles():
+    lat = np.array([CENTER.lat, CENTER.lat, CENTER.lat + SPACING])
+    lng = np.array([CENTER.lng, CENTER.lng + SPACING, CENTER.lng])
+    graph = RoadGraph.from_segments(
+        lat,
+        lng,
+        [(0, 1, "residential", True), (1, 2, "residential", False)],
+    )
+    router = LocalRouter(graph)
+    locations = get_node_locations(graph, [0, 1])
+
+    for travel_mode, has_route_back in [
+        (TravelMode.DRIVE, False),
+        (TravelMode.BICYCLE, False),
+        (TravelMode.WALK, True),
+    ]:
+        entries = router.get_route_matrix(locations, locations, travel_mode)
+        back = next(
+            x for x in entries if x["originIndex"] == 1 and x["destinationIndex"] == 0
+        )
+        assert (back["condition"] == "ROUTE_EXISTS") == has_route_back
+
+
+def test_far_locations_have_no_routes():
+    router = LocalRouter(make_street_grid(), max_snap_meters=200)
+    near = CENTER.with_offset(lat=0.0002, lng=0.0003)
+    far = CENTER.with_offset(lat=0.05, lng=0)
+
+    entries = router.get_route_matrix([near], [near, far], TravelMode.WALK)
+
+    assert [x["condition"] for x in entries] == ["ROUTE_EXISTS", "ROUTE_NOT_FOUND"]
+    # Same place, so it's just the walk in between
+    assert entries[0]["duration"] == "0s"
+    with pytest.raises(ValueError):
+        router.snap_to_road(far)
+
+
+def test_nearest_nodes_match_brute_force():
+    graph = make_street_grid()
+    router = LocalRouter(graph, max_snap_meters=100)
+    rng = np.random.default_rng(2)
+    locations = [
+        CENTER.with_offset(lat=lat, lng=lng)
+        for lat, lng in rng.uniform(-0.008, 0.008, size=(200, 2))
+    ]
+
+    nodes, meters = router.get_nearest_nodes(locations, TravelMode.DRIVE)
+
+    array = LocationArray.from_locations(locations)
+    distances = haversine_distance(
+        array.lat[:, np.newaxis], array.lng[:, np.newaxis], graph.lat, graph.lng
+    )
+    expected_meters = distances.min(axis=1)
+    expected_nodes = np.where(expected_meters <= 100, distances.argmin(axis=1), -1)
+    np.testing.assert_array_equal(nodes, expected_nodes)
+    assert 0 < (nodes >= 0).sum() < len(nodes)
+    np.testing.assert_allclose(meters[nodes >= 0], expected_meters[nodes >= 0])
+
+    # Snapped locations are remembered
+    router._indices.clear()
+    router.get_node_index = None
+    again, _ = router.get_nearest_nodes(locations[::-1], TravelMode.DRIVE)
+    np.testing.assert_array_equal(again, nodes[::-1])
+
+
+OSM_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="10" lat="50.0800" lon="14.4200"/>
+  <node id="11" lat="50.0800" lon="14.4210">
+    <tag k="highway" v="traffic_signals"/>
+  </node>
+  <node id="12" lat="50.0810" lon="14.4210"/>
+  <node id="13" lat="50.0900" lon="14.4300"/>
+  <way id="1">
+    <nd ref="10"/><nd ref="11"/><nd ref="12"/>
+    <tag k="highway" v="residential"/>
+  </way>
+  <way id="2">
+    <nd ref="12"/><nd ref="10"/>
+    <tag k="highway" v="primary"/>
+    <tag k="oneway" v="-1"/>
+  </way>
+  <way id="3">
+    <nd ref="12"/><nd ref="13"/>
+    <tag k="waterway" v="river"/>
+  </way>
+</osm>
+"""
+
+
+def test_osm_extracts_round_trip_through_graph_files(tmp_path):
+    osm_path = tmp_path / "city.osm"
+    osm_path.write_text(OSM_XML)
+
+    graph = RoadGraph.from_osm_xml(osm_path)
+    graph.save(tmp_path / "city.npz")
+    loaded = RoadGraph.load(tmp_path / "city.npz")
+
+    # The river and its node aren't part of the road network
+    assert len(loaded.lat) == 3
+    assert loaded.highway_types == ["primary", "residential"]
+    segments = {
+        (int(a), int(b), loaded.highway_types[h], bool(oneway))
+        for a, b, h, oneway in zip(
+            loaded.edge_from, loaded.edge_to, loaded.edge_highway, loaded.edge_oneway
+        )
+    }
+    # oneway=-1 goes against the order of the nodes
+    assert segments == {
+        (0, 1, "residential", False),
+        (1, 2, "residential", False),
+        (0, 2, "primary", True),
+    }
+    assert loaded.edge_meters[0] == pytest.approx(71.5, abs=0.5)
+
+
+@pytest.fixture
+def local_routing(monkeypatch):
+    router = LocalRouter(make_street_grid())
+    monkeypatch.setattr(gmaps, "routing_provider", router)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The Google APIs must not be called")
+
+    monkeypatch.setattr(gmaps, "request_route_matrix", fail)
+    monkeypatch.setattr(gmaps, "call_geocoding_api", fail)
+    monkeypatch.setattr(gmaps, "confirm_if_expensive", fail)
+    return router
+
+
+def test_grids_can_be_computed_offline(local_routing):
+    grid = Grid(
+        CENTER,
+        zoom=15,
+        size=5,
+        snap_to_roads=True,
+        travel_mode=TravelMode.RUN,
+    )
+    grid.compute_sparsified_distance_matrix(max_normalized_distance=0.4)
+
+    # Snapped to the nodes of the street grid
+    graph = local_routing.graph
+    nodes = {(lat, lng) for lat, lng in zip(graph.lat.tolist(), graph.lng.tolist())}
+    assert all((x.lat, x.lng) in nodes for x in grid.get_snapped_locations())
+    assert np.isfinite(grid.get_travel_times().m).all()
+    assert gmaps.get_supported_travel_modes() == list(SPEED_PROFILES)
+
+
+def test_sparsified_distance_matrix_is_a_single_local_call(local_routing, monkeypatch):
+    locations = get_node_locations(local_routing.graph, range(0, 576, 4))
+    pairs = np.array(
+        [(i, j) for i in range(144) for j in range(i + 1, min(i + 8, 144))]
+    )
+    calls = []
+
+    def get_route_matrix_pairs(*args):
+        calls.append(args)
+        return LocalRouter.get_route_matrix_pairs(local_routing, *args)
+
+    monkeypatch.setattr(local_routing, "get_route_matrix_pairs", get_route_matrix_pairs)
+
+    entries = list(
+        gmaps.get_sparsified_distance_matrix(
+            locations, locations, pairs=pairs, travel_mode=TravelMode.WALK
+        )
+    )
+
+    # Without the chunking into Routes API requests
+    assert len(calls) == 1
+    assert sorted((x["originIndex"], x["destinationIndex"]) for x in entries) == (
+        sorted(map(tuple, pairs.tolist()))
+    )
+    full = local_routing.get_route_matrix(locations, locations, TravelMode.WALK)
+    by_pair = {(x["originIndex"], x["destinationIndex"]): x for x in full}
+    for entry in entries:
+        assert entry == by_pair[entry["originIndex"], entry["destinationIndex"]]
+
+
+def test_async_distance_matrix_uses_local_routing(local_routing):
+    locations = get_node_locations(local_routing.graph, [0, 5, 50])
+
+    entries = asyncio.run(
+        gmaps_async.get_distance_matrix(
+            locations, locations, travel_mode=TravelMode.BICYCLE
+        )
+    )
+
+    assert sorted(entries, key=lambda x: (x["originIndex"], x["destinationIndex"])) == (
+        local_routing.get_route_matrix(locations, locations, TravelMode.BICYCLE)
+    )
+
+
+def test_routes_api_rejects_local_only_travel_modes():
+    with pytest.raises(ValueError):
+        gmaps.get_distance_matrix_api_payload([CENTER], [CENTER], TravelMode.RUN)
+
+
+def test_incomplete_routing_providers_fail_at_construction():
+    class MatrixOnlyProvider(gmaps.RoutingProvider):
+        def get_route_matrix(self, origins, destinations, travel_mode):
+            return []
+
+    with pytest.raises(TypeError):
+        MatrixOnlyProvider()
@@ -0,0 +1,143 @@
+import numpy as np
+import pytest
+
+from backend.location import (
+    Location,
+    LocationArray,
+    Polyline,
+    get_mercator_scale_factor,
+    spherical_distance,
+)
+
+
+def make_locations(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        Location(lat=lat, lng=lng)
+        for lat, lng in zip(rng.uniform(-60, 60, n), rng.uniform(-180, 180, n))
+    ]
+
+
+def test_location_array_round_trip():
+    locations = make_locations(10)
+    array = LocationArray.from_locations(locations)
+
+    assert len(array) == 10
+    assert array.to_locations() == locations
+    assert array[3] == locations[3]
+    assert array[2:5].to_locations() == locations[2:5]
+    assert array[np.array([7, 1])].to_locations() == [locations[7], locations[1]]
+
+    with pytest.raises(ValueError):
+        LocationArray([1, 2], [3])
+
+
+def test_distance_matrix_matches_spherical_distance():
+    origins = make_locations(6, seed=1)
+    destinations = make_locations(4, seed=2)
+
+    m = LocationArray.from_locations(origins).distance_matrix(
+        LocationArray.from_locations(destinations)
+    )
+
+    assert m.shape == (6, 4)
+    for i, origin in enumerate(origins):
+        for j, destination in enumerate(destinations):
+            assert m[i, j] == pytest.approx(spherical_distance(origin, destination))
+
+
+def test_segment_lengths():
+    locations = make_locations(5, seed=3)
+    lengths = LocationArray.from_locations(locations).segment_lengths()
+
+    assert lengths == pytest.approx(
+        [spherical_distance(a, b) for a, b in zip(locations, locations[1:])]
+    )
+
+
+def test_to_normalized_matches_scalar_projection():
+    center = Location(lat=48.85, lng=2.35)
+    max_offset_lng = 0.05
+    locations = [
+        center.with_offset(lat, lng) for lat, lng in [(0.01, -0.02), (-0.03, 0.04)]
+    ]
+
+    points = LocationArray.from_locations(locations).to_normalized(
+        center, max_offset_lng
+    )
+
+    assert points.shape == (2, 2)
+    # Not bit-for-bit, the operations are ordered differently
+    for (x, y), location in zip(points, locations):
+        max_offset_lat = max_offset_lng / get_mercator_scale_factor(location.lat)
+        assert x == pytest.approx(
+            (location.lng - center.lng + max_offset_lng) / (2 * max_offset_lng),
+            rel=1e-12,
+        )
+        assert y == pytest.approx(
+            (center.lat - location.lat + max_offset_lat) / (2 * max_offset_lat),
+            rel=1e-12,
+        )
+    assert LocationArray.from_locations([center]).to_normalized(
+        center, max_offset_lng
+    ).tolist() == [[0.5, 0.5]]
+
+
+def reference_point_at_fraction(points, fraction):
+    """The original segment-walking implementation, kept as a reference."""
+    lengths = [spherical_distance(a, b) for a, b in zip(points, points[1:])]
+    target_length = fraction * sum(lengths)
+    current_length = 0
+    for i, segment_length in enumerate(lengths):
+        if current_length + segment_length >= target_length:
+            return points[i].interpolate(
+                points[i + 1], (target_length - current_length) / segment_length
+            )
+        current_length += segment_length
+    return points[-1]
+
+
+def test_polyline_fractions_match_reference():
+    points = make_locations(30, seed=4)
+    polyline = Polyline(points=points)
+    fractions = np.linspace(0, 1, 101)
+
+    batch = polyline.get_points_at_fractions(fractions)
+
+    for fraction, point in zip(fractions, batch):
+        expected = reference_point_at_fraction(points, fraction)
+        assert point.lat == pytest.approx(expected.lat)
+        assert point.lng == pytest.approx(expected.lng)
+    assert polyline.get_point_at_fraction(0) == points[0]
+    end = polyline.get_point_at_fraction(1)
+    assert (end.lat, end.lng) == pytest.approx((points[-1].lat, points[-1].lng))
+    assert polyline.total_length() == pytest.approx(
+        sum(spherical_distance(a, b) for a, b in zip(points, points[1:]))
+    )
+
+    with pytest.raises(ValueError):
+        polyline.get_point_at_fraction(1.5)
+
+
+def test_polyline_converts_its_points_once(monkeypatch):
+    polyline = Polyline(points=make_locations(30, seed=5))
+    first = polyline.get_point_at_fraction(0.3)
+
+    def fail(locations):
+        raise AssertionError("The points were converted again")
+
+    monkeypatch.setattr(LocationArray, "from_locations", staticmethod(fail))
+    assert polyline.get_point_at_fraction(0.3) == first
+    assert len(polyline.get_points_at_fractions([0.1, 0.9])) == 2
+
+
+def test_polyline_handles_repeated_points():
+    a, b = Location(lat=50, lng=14), Location(lat=50.01, lng=14)
+    polyline = Polyline(points=[a, a, b, b])
+
+    assert polyline.get_point_at_fraction(0) == a
+    assert polyline.get_point_at_fraction(0.5).lat == pytest.approx(50.005)
+    assert [x.lat for x in polyline.resample(3).points] == pytest.approx(
+        [50, 50.005, 50.01]
+    )
+    assert Polyline(points=[a]).get_point_at_fraction(0.3) == a
@@ -0,0 +1,162 @@
+import asyncio
+import math
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from backend import gmaps, gmaps_async, mosaic
+from backend.cache import BlobStore, FileBasedCache
+from backend.grid import Grid
+from backend.location import Location
+from backend.mosaic import (
+    location_to_world_pixels,
+    plan_mosaic_tiles,
+    world_pixels_to_location,
+)
+
+Image = pytest.importorskip("PIL.Image")
+
+ZOOM = 13
+
+
+def render_fake_map(center: Location, zoom: int, size_pixels: int, scale: int):
+    """An image whose pixels encode their Web Mercator coordinates, mod 256."""
+    center_x, center_y = location_to_world_pixels(center, zoom)
+    offsets = (np.arange(size_pixels * scale) + 0.5) / scale - size_pixels / 2
+    xs = np.floor(center_x + offsets).astype(np.int64) % 256
+    ys = np.floor(center_y + offsets).astype(np.int64) % 256
+    pixels = np.zeros((len(ys), len(xs), 3), dtype=np.uint8)
+    pixels[:, :, 0] = xs[np.newaxis, :]
+    pixels[:, :, 1] = ys[:, np.newaxis]
+    return pixels
+
+
+def to_png(pixels: np.ndarray) -> bytes:
+    output = BytesIO()
+    Image.fromarray(pixels).save(output, format="PNG")
+    return output.getvalue()
+
+
+def from_png(image: bytes) -> np.ndarray:
+    return np.array(Image.open(BytesIO(image)).convert("RGB"))
+
+
+@pytest.fixture
+def fake_tiles(monkeypatch, tmp_path):
+    monkeypatch.setattr(gmaps, "cache", FileBasedCache(str(tmp_path / "cache")))
+    monkeypatch.setattr(gmaps, "static_map_store", BlobStore(str(tmp_path / "maps")))
+    monkeypatch.setattr(gmaps, "single_flight", gmaps.SingleFlight())
+    requests = []
+
+    def fake_get_static_map(center, zoom, markers=None, size_pixels=400, scale=2):
+        requests.append((center, markers))
+        return to_png(render_fake_map(center, zoom, size_pixels, scale))
+
+    async def fake_get_static_map_async(*args, **kwargs):
+        return fake_get_static_map(*args, **kwargs)
+
+    monkeypatch.setattr(gmaps, "get_static_map", fake_get_static_map)
+    monkeypatch.setattr(gmaps_async, "get_static_map", fake_get_static_map_async)
+    return requests
+
+
+def get_center() -> Location:
+    # Avoid pixel boundaries, so that rounding errors don't flip the fake colors.
+    x, y = location_to_world_pixels(Location(lat=40.73, lng=-73.99), ZOOM)
+    return world_pixels_to_location(math.floor(x) + 0.1, math.floor(y) + 0.1, ZOOM)
+
+
+def test_world_pixels_round_trip():
+    location = Location(lat=-33.86, lng=151.21)
+    x, y = location_to_world_pixels(location, ZOOM)
+    assert world_pixels_to_location(x, y, ZOOM).lat == pytest.approx(location.lat)
+    assert world_pixels_to_location(x, y, ZOOM).lng == pytest.approx(location.lng)
+    # One tile at zoom 0 covers the whole world
+    assert location_to_world_pixels(Location(lat=0, lng=0), 0) == (128, 128)
+
+
+@pytest.mark.parametrize("scale", [1, 2])
+def test_mosaic_looks_like_a_single_large_map(fake_tiles, scale):
+    center = get_center()
+    size_pixels = 1500
+
+    image = mosaic.get_mosaic(center, ZOOM, size_pixels=size_pixels, scale=scale)
+
+    tiles = plan_mosaic_tiles(center, ZOOM, size_pixels)
+    assert len(fake_tiles) == len(tiles) == 9
+    expected = render_fake_map(center, ZOOM, size_pixels, scale)
+    assert (from_png(image) == expected).all()
+
+    # The stitched image is cached, no tiles are needed the second time.
+    assert mosaic.get_mosaic(center, ZOOM, size_pixels=size_pixels, scale=scale) == (
+        image
+    )
+    assert len(fake_tiles) == 9
+
+
+def test_async_mosaic_matches_sync(fake_tiles):
+    center = get_center()
+    image, digest = asyncio.run(
+        mosaic.get_mosaic_with_digest_async(center, ZOOM, size_pixels=700, scale=1)
+    )
+
+    assert len(fake_tiles) == 4
+    assert (from_png(image) == render_fake_map(center, ZOOM, 700, 1)).all()
+    assert mosaic.get_mosaic_with_digest(center, ZOOM, size_pixels=700, scale=1) == (
+        image,
+        digest,
+    )
+
+
+def test_small_mosaics_are_plain_static_maps(fake_tiles, monkeypatch):
+    calls = []
+
+    def fake_get_static_map_with_digest(*args):
+        calls.append(args)
+        return b"image", "digest"
+
+    monkeypatch.setattr(
+        gmaps, "get_static_map_with_digest", fake_get_static_map_with_digest
+    )
+    center = get_center()
+
+    assert mosaic.get_mosaic_with_digest(center, ZOOM, size_pixels=640) == (
+        b"image",
+        "digest",
+    )
+    assert calls == [(center, ZOOM, None, 640, 2)]
+
+    with pytest.raises(ValueError):
+        mosaic.get_mosaic(center, ZOOM, size_pixels=mosaic.MAX_MOSAIC_SIZE_PIXELS + 1)
+
+
+def test_tiles_only_get_nearby_markers():
+    center = get_center()
+    grid = Grid(center, ZOOM, size=5, snap_to_roads=False, size_pixels=2000)
+    markers = grid.get_raw_locations()
+
+    tiles = plan_mosaic_tiles(center, ZOOM, 2000, markers=markers)
+
+    assert len(tiles) == 16
+    assert all(0 < len(tile.markers) < len(markers) for tile in tiles)
+    assert {str(x) for tile in tiles for x in tile.markers} == {str(x) for x in markers}
+
+
+def test_grid_normalization_matches_mosaic_pixels():
+    center = get_center()
+    size_pixels = 2560
+    grid = Grid(center, ZOOM, size=5, snap_to_roads=False, size_pixels=size_pixels)
+    center_x, center_y = location_to_world_pixels(center, ZOOM)
+
+    for location in grid.get_raw_locations():
+        x, y = location_to_world_pixels(location, ZOOM)
+        normalized = grid.location_to_normalized(location)
+        # STATIC_MAP_SIZE_COEF and the linearized latitude are approximations, but
+        # they are the same ones as for a single static map.
+        assert normalized.x == pytest.approx(
+            0.5 + (x - center_x) / size_pixels, abs=0.01
+        )
+        assert normalized.y == pytest.approx(
+            0.5 + (y - center_y) / size_pixels, abs=0.01
+        )
@@ -0,0 +1,98 @@
+import random
+
+import numpy as np
+import pytest
+
+from backend.grid import Grid, get_mesh_edges
+from backend.quadtree import Quadtree, make_quadtree_grid
+
+from .conftest import RIVER_CENTER, RIVER_LAT
+
+ZOOM = 13
+
+
+def get_triangle_areas(quadtree: Quadtree) -> np.ndarray:
+    points = np.array(list(quadtree.points), dtype=np.float64)
+    triangles = np.array(quadtree.get_triangles())
+    a, b, c = points[triangles[:, 0]], points[triangles[:, 1]], points[triangles[:, 2]]
+    ab, ac = b - a, c - a
+    return (ab[:, 0] * ac[:, 1] - ab[:, 1] * ac[:, 0]) / 2
+
+
+def test_quadtree_stays_balanced_and_triangulated():
+    random.seed(0)
+    quadtree = Quadtree(max_depth=5, initial_depth=1)
+    for _ in range(30):
+        leaves = [x for x in sorted(quadtree.leaves) if x[0] < quadtree.max_depth]
+        quadtree.split(random.choice(leaves))
+
+    for depth, column, row in quadtree.leaves:
+        for neighbor in [
+            (column - 1, row),
+            (column + 1, row),
+            (column, row - 1),
+            (column, row + 1),
+        ]:
+            coarser = quadtree._get_coarser_leaf(depth, *neighbor)
+            assert coarser is None or coarser[0] == depth - 1
+
+    # The triangles are counterclockwise and tile the square without overlaps
+    areas = get_triangle_areas(quadtree)
+    assert (areas > 0).all()
+    assert areas.sum() == (quadtree.get_lattice_size() - 1) ** 2
+
+    # Every edge inside the square is shared by exactly two triangles
+    triangles = np.array(quadtree.get_triangles())
+    edges = np.sort(
+        np.concatenate(
+            [triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [0, 2]]]
+        ),
+        axis=1,
+    )
+    edges, counts = np.unique(edges, axis=0, return_counts=True)
+    assert set(counts.tolist()) == {1, 2}
+    points = np.array(list(quadtree.points))
+    boundary = edges[counts == 1]
+    lengths = np.abs(points[boundary[:, 0]] - points[boundary[:, 1]]).sum(axis=1)
+    assert lengths.sum() == 4 * (quadtree.get_lattice_size() - 1)
+
+
+def test_full_quadtree_is_a_uniform_grid():
+    quadtree = Quadtree(max_depth=3, initial_depth=3)
+    grid = quadtree.to_grid(RIVER_CENTER, ZOOM, snap_to_roads=False)
+    uniform = Grid(RIVER_CENTER, ZOOM, size=9, snap_to_roads=False)
+
+    assert grid.size == uniform.size
+    assert len(grid.triangles) == 2 * 8 * 8
+    by_xy = {(x.grid_x, x.grid_y): x.raw_location for x in uniform.locations}
+    for location in grid.locations:
+        assert location.raw_location == by_xy[location.grid_x, location.grid_y]
+
+
+def test_quadtree_grid_refines_near_the_river(river_city_api):
+    grid = make_quadtree_grid(RIVER_CENTER, ZOOM, max_points=150, snap_to_roads=False)
+
+    assert 140 <= len(grid.locations) <= 150
+    assert river_city_api["n_elements"] < 5 * 150
+    # The mesh edges were queried, so the travel times work like for any grid
+    assert np.isfinite(grid.get_travel_times().m).all()
+    assert len(grid.get_backbone_pairs()) == len(get_mesh_edges(grid.triangles))
+
+    # Most of the locations are in the rows next to the river
+    grid_y = np.array([x.grid_y for x in grid.locations])
+    lats = np.array([x.raw_location.lat for x in grid.locations])
+    slope, intercept = np.polyfit(grid_y, lats, 1)
+    river_y = (RIVER_LAT - intercept) / slope
+    assert (np.abs(grid_y - river_y) < (grid.size - 1) / 8).mean() > 0.5
+
+    round_tripped = Grid.from_json(grid.to_json())
+    assert round_tripped.triangles == grid.triangles
+
+
+def test_quadtree_grid_without_distortion_stays_coarse(river_city_api):
+    river_city_api["has_river"] = False
+    grid = make_quadtree_grid(RIVER_CENTER, ZOOM, max_points=150, snap_to_roads=False)
+
+    # Only the initial 4x4 cells, whose sides and diagonals were queried
+    assert len(grid.locations) == 25
+    assert river_city_api["n_elements"] == 2 * 4 * 5 + 4 * 4
@@ -0,0 +1,97 @@
+import math
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from backend.grid import Grid
+from backend.springs import (
+    STRENGTH_MULTIPLIER,
+    Springs,
+    compute_layouts,
+    get_grid_springs,
+    get_initial_positions,
+    step_springs,
+)
+
+ASSETS_DIR = Path(__file__).parents[2] / "frontend" / "src" / "assets"
+
+
+@pytest.fixture(scope="module")
+def grid():
+    return Grid.load(ASSETS_DIR / "newyork_runner" / "grid_data.json")
+
+
+def reference_step_springs(positions, pinned, springs, delta_seconds, timeness, scale):
+    """A line-by-line port of stepSprings from springs.ts, kept as a reference."""
+    new_positions = [[x, y, 0.0, 0.0] for x, y in positions]
+    for i in range(len(springs)):
+        from_ = new_positions[springs.from_index[i]]
+        to = new_positions[springs.to_index[i]]
+
+        distance = math.hypot(from_[0] - to[0], from_[1] - to[1])
+        force = distance - springs.length[i]
+        force *= (
+            springs.strength[i]
+            * delta_seconds
+            * (5 + (1.5 - 5) * timeness if springs.is_anchor[i] else timeness * scale)
+        )
+
+        angle = math.atan2(to[1] - from_[1], to[0] - from_[0])
+        from_[2] += math.cos(angle) * force
+        from_[3] += math.sin(angle) * force
+        to[2] -= math.cos(angle) * force
+        to[3] -= math.sin(angle) * force
+
+    return [
+        [x, y] if is_pinned else [x + dx, y + dy]
+        for (x, y, dx, dy), is_pinned in zip(new_positions, pinned)
+    ]
+
+
+def test_step_springs_matches_reference():
+    rng = np.random.default_rng(0)
+    n_vertices, n_springs = 12, 40
+    positions = rng.random((n_vertices, 2))
+    pinned = rng.random(n_vertices) < 0.3
+    springs = Springs(
+        from_index=rng.integers(0, n_vertices, n_springs),
+        to_index=rng.integers(0, n_vertices, n_springs),
+        length=rng.random(n_springs),
+        strength=rng.random(n_springs),
+        is_anchor=rng.random(n_springs) < 0.5,
+    )
+
+    new_positions, _ = step_springs(positions, pinned, springs, 0.1, 0.7, 0.5)
+
+    expected = reference_step_springs(positions, pinned, springs, 0.1, 0.7, 0.5)
+    assert new_positions == pytest.approx(np.array(expected))
+
+
+def test_grid_springs(grid):
+    springs = get_grid_springs(grid)
+    n_locations = len(grid.locations)
+
+    anchors = springs.is_anchor
+    assert anchors.sum() == n_locations
+    assert (
+        springs.to_index[anchors] == springs.from_index[anchors] + n_locations
+    ).all()
+    assert (springs.from_index[~anchors] < springs.to_index[~anchors]).all()
+    assert (springs.length[~anchors] > 0).all()
+    assert springs.strength[~anchors] == pytest.approx(
+        STRENGTH_MULTIPLIER / n_locations
+    )
+
+
+def test_layouts(grid):
+    layouts = compute_layouts(grid, [1.0, 0.0, 0.5], timeness_scale=0.08)
+
+    positions = np.array(layouts["positions"])
+    assert positions.shape == (3, len(grid.locations), 2)
+    assert layouts["timeness_levels"] == [1.0, 0.0, 0.5]
+
+    # Without timeness, only the anchors pull, so the grid stays undeformed.
+    assert positions[1] == pytest.approx(get_initial_positions(grid))
+    deformation = np.abs(positions - get_initial_positions(grid)).max(axis=(1, 2))
+    assert deformation[1] < deformation[2] < deformation[0]
@@ -47,6 +47,9 @@ export type GridData = {
     snap_result_place_id: string | null;
   }[];
   route_matrix: RouteMatrixAPIEntry[];
+  // Only for grids that aren't a full size x size lattice, like quadtree grids.
+  // Triples of location indices.
+  triangles?: [number, number, number][];
   // grid_data.dense_travel_times[i][j] is the number of seconds to get between
   // locations i and j.
   dense_travel_times?: number[][];
@@ -45,6 +45,10 @@ export const locationToNormalized = (
 };
 
 export const getMesh = (gridSize: number, gridData: GridData) => {
+  if (gridData.triangles) {
+    return getMeshFromTriangles(gridData, gridData.triangles);
+  }
+
   const grid: GridEntry[][] = new Array(gridSize);
   let index = 0;
 
@@ -88,3 +92,31 @@ export const getMesh = (gridSize: number, gridData: GridData) => {
     triangles: triangles.map((triangle) => new Float32Array(triangle)),
   };
 };
+
+/** For grids that come with their own mesh, e.g. quadtree grids. */
+const getMeshFromTriangles = (
+  gridData: GridData,
+  triangles: [number, number, number][]
+) => {
+  // The locations aren't a lattice, so every location is a row of its own.
+  const grid: GridEntry[][] = gridData.locations.map((location, index) => {
+    const normalized = locationToNormalized(
+      location.snapped_location,
+      gridData
+    );
+    return [
+      {
+        index: index,
+        uvX: normalized.x,
+        uvY: normalized.y,
+        x: normalized.x,
+        y: normalized.y,
+      },
+    ];
+  });
+
+  return {
+    grid: grid,
+    triangles: triangles.map((triangle) => new Float32Array(triangle)),
+  };
+};